@@ -1,9 +1,29 @@
 # -*- coding: utf-8 -*-
 
+from . import admission
+from . import aio
+from . import api
+from . import codec
 from . import config
 from . import common
 from . import connection
+from . import health
+from . import info
+from . import lease
 from . import listener
+from . import metrics
+from . import multiprocess
+from . import persistence
+from . import probe
+from . import protocol
 from . import registrant
+from . import registry
+from . import replication
+from . import resolver
+from . import simulation
+from . import timing_wheel
+from . import tls
+from . import udp
+from . import watcher
 
 __version__ = "0.0.5"
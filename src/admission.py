@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from tornado.ioloop import IOLoop
+
+from .metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+
+class AdmissionControl(object):
+    '''
+    listener side protection against reconnect storms:
+    rate is the new registrations per second allowed (a token bucket holding up
+    to burst registrations, rate by default), registrations over it are answered
+    with RETRY and a retry_after in seconds, then the connection is closed.
+    max_handshakes caps the connections accepted but not answered yet, connections
+    over it are closed right away before anything is read. a connection without
+    a reply after handshake_timeout seconds is closed, so idle sockets can't hold
+    the slots.
+    None disables a limit.
+    '''
+    def __init__(self, rate = None, burst = None, max_handshakes = None, retry_after = 1.0,
+                 handshake_timeout = 10.0, metrics = METRICS):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.max_handshakes = max_handshakes
+        self.retry_after = retry_after
+        self.handshake_timeout = handshake_timeout
+        self.handshakes = 0
+        self._tokens = self.burst
+        self._last = None
+        self.rejected_rate = metrics.counter(
+            "discovery_listener_admission_rejected_total", "registrations and connections refused", {"reason": "rate"}
+        )
+        self.rejected_handshakes = metrics.counter(
+            "discovery_listener_admission_rejected_total", "registrations and connections refused", {"reason": "handshakes"}
+        )
+        self.rejected_timeout = metrics.counter(
+            "discovery_listener_admission_rejected_total", "registrations and connections refused", {"reason": "handshake_timeout"}
+        )
+
+    def start_handshake(self):
+        '''
+        return False if the connection has to be refused
+        '''
+        if self.max_handshakes is not None and self.handshakes >= self.max_handshakes:
+            self.rejected_handshakes.inc()
+            return False
+        self.handshakes += 1
+        return True
+
+    def end_handshake(self):
+        self.handshakes -= 1
+
+    def admit(self, count = 1):
+        '''
+        take count registrations from the bucket, return None if admitted,
+        otherwise the seconds to wait before retrying
+        '''
+        if self.rate is None:
+            return None
+        now = IOLoop.current().time()
+        if self._last is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        # a batch larger than burst is admitted on a full bucket, the debt delays the next ones
+        if self._tokens >= min(count, self.burst):
+            self._tokens -= count
+            return None
+        self.rejected_rate.inc()
+        # spread the retries over the time the bucket needs to admit everyone waiting
+        return max(self.retry_after, (count - self._tokens) / float(self.rate))
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+from datetime import timedelta
+
+import tornado.iostream
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from .protocol import pack_frame, read_frame_async
+from .codec import encode_payload
+from .connection import BaseConnection
+from .listener import BaseListener
+from .registrant import BaseRegistrant
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncConnection(BaseConnection):
+    '''
+    BaseConnection served by native coroutines, on the IOLoop of its stream.
+    the protocol handling is shared with BaseConnection, only the read loop,
+    read_message and send_message are async def
+    '''
+    __slots__ = ()
+
+    def _on_connect(self):
+        self._stream.io_loop.add_callback(self._serve)
+
+    async def _serve(self):
+        try:
+            while True:
+                data = await self.read_message()
+                start = time.perf_counter() if self._metrics.handle_time.sample() else None
+                send_data, refuse_connect_flag = self._handle(data)
+                self._reply(send_data, refuse_connect_flag)
+                self._end_handshake()
+                if start is not None:
+                    self._metrics.handle_time.observe(time.perf_counter() - start)
+        except tornado.iostream.StreamClosedError:
+            LOG.info("Closed: %s", self._address)
+        except Exception as e:
+            LOG.exception(e)
+
+    async def read_message(self):
+        payload, flags = await read_frame_async(self._stream, self._header_buffer)
+        return self._decode(payload, flags)
+
+    async def send_message(self, data, refuse_connect_flag = False):
+        try:
+            LOG.debug("Send: %s", data)
+            await self._write(self.encode_frame(data))
+            if refuse_connect_flag:
+                self._refuse_connect()
+        except Exception as e:
+            LOG.exception(e)
+
+    def _reply(self, data, refuse_connect_flag):
+        '''
+        queue a reply without a coroutine per request, the read loop doesn't wait for the write
+        '''
+        try:
+            LOG.debug("Send: %s", data)
+            future = self._write(self.encode_frame(data))
+        except Exception as e:
+            LOG.exception(e)
+            return
+        if refuse_connect_flag:
+            future.add_done_callback(lambda future: self._refuse_connect())
+
+
+class AsyncListener(BaseListener):
+    '''
+    BaseListener accepting on io_loop, the current IOLoop by default, it works on
+    Tornado's asyncio IOLoop inside an asyncio application. sockets added from
+    another thread are added on io_loop.
+    '''
+    def __init__(self, connection_cls = AsyncConnection, ssl_options = None, io_loop = None, **kwargs):
+        self.io_loop = io_loop or IOLoop.current()
+        BaseListener.__init__(self, connection_cls, ssl_options = ssl_options, **kwargs)
+
+    def add_sockets(self, sockets):
+        if IOLoop.current(instance = False) is self.io_loop:
+            BaseListener.add_sockets(self, sockets)
+        else:
+            self.io_loop.add_callback(BaseListener.add_sockets, self, sockets)
+
+
+class AsyncRegistrant(BaseRegistrant):
+    '''
+    BaseRegistrant with native coroutines running on io_loop, the current IOLoop
+    when it is created by default, instead of the IOLoop current at every call.
+    start it with await registrant.connect() or io_loop.add_callback(registrant.connect)
+    '''
+    def __init__(self, host, port, config, io_loop = None, **kwargs):
+        BaseRegistrant.__init__(self, host, port, config, **kwargs)
+        self._io_loop = io_loop or IOLoop.current()
+
+    async def connect(self, delay = False):
+        try:
+            if delay == False:
+                stream = await self.tcpclient.connect(self.host, self.port)
+                if self.ssl_context is not None:
+                    stream = await self._start_tls(stream)
+                self._on_connect(stream)
+            else:
+                self._schedule_connect()
+        except Exception as e:
+            LOG.exception(e)
+            if self.reconnect == True:
+                self._failover()
+
+    async def read_message(self):
+        payload, flags = await read_frame_async(self._stream, self._header_buffer)
+        return self._decode(payload, flags)
+
+    async def send_message(self, data):
+        try:
+            await self._send(data)
+        except Exception as e:
+            LOG.exception(e)
+
+    def _send(self, data):
+        payload, flags = encode_payload(data, self._codec, self._compress_threshold)
+        LOG.debug("Send: %s", data)
+        return self._stream.write(pack_frame(payload, self._framing, flags))
+
+    async def request(self, data, timeout = None):
+        '''
+        send data with a new request id and wait for the matching reply,
+        several requests can be in flight on the connection at the same time
+        '''
+        request_id, future = self._new_request(data)
+        start = time.perf_counter()
+        try:
+            self._send(data)
+            result = await gen.with_timeout(timedelta(seconds = timeout or self.request_timeout), future)
+            self.rtt.observe(time.perf_counter() - start)
+        except Exception:
+            self.request_failures.inc()
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+        return result
+
+    async def _read_loop(self, stream):
+        try:
+            while stream is self._stream:
+                data = await self.read_message()
+                self._dispatch(data)
+        except tornado.iostream.StreamClosedError:
+            pass
+        except Exception as e:
+            LOG.exception(e)
+        self._fail_pending(stream)
+
+    async def register_service(self):
+        try:
+            data = await self.request(self._register_data())
+            self._on_register(data)
+        except Exception as e:
+            LOG.exception(e)
+
+    async def unregister_service(self):
+        try:
+            data = await self.request(self._unregister_data())
+            self._on_unregister(data)
+        except Exception as e:
+            LOG.exception(e)
+
+    async def heartbeat_service(self):
+        try:
+            if not self._registered:
+                LOG.debug("Client not registered yet, skip heartbeat")
+                return
+            if self._heartbeat_udp():
+                return
+            data = await self.request(self._heartbeat_data())
+            if self._resync(data):
+                data = await self.request(self._heartbeat_data())
+            self._on_heartbeat(data)
+        except Exception as e:
+            LOG.exception(e)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+from datetime import timedelta
+
+import tornado.web
+from tornado import gen
+from tornado.concurrent import Future
+
+from .common import Event
+
+LOG = logging.getLogger(__name__)
+
+MAX_WAIT = 300 # seconds
+
+
+class RegistryCache(object):
+    '''
+    JSON documents of the registry for the http api, encoded once per revision
+    of what they show: the whole registry, a service or a node. a service keeps
+    its revision while other services change, so its readers are not woken and
+    its document isn't encoded again.
+    long-poll readers wait on a future per document, woken together by the change.
+    '''
+    def __init__(self, registry):
+        self.registry = registry
+        self._start_revision = registry.revision
+        self._services_revision = registry.revision # last service added or removed
+        self._service_revisions = {} # service: revision of its last change
+        self._documents = {} # key: (revision, bytes)
+        self._waiters = {} # key: [Future]
+        registry.subscribe(self._on_registry_event)
+
+    def stop(self):
+        self.registry.unsubscribe(self._on_registry_event)
+        self._wake_all()
+
+    def revision(self, key):
+        '''
+        the revision of the last change of document key, None if it doesn't exist,
+        a service without nodes doesn't
+        '''
+        kind = key[0]
+        if kind == "nodes":
+            return self.registry.revision
+        if kind == "services":
+            return self._services_revision
+        if kind == "service":
+            if not self.registry.has_service(key[1]):
+                return None
+            return self._service_revisions.get(key[1], self._start_revision)
+        entry = self.registry.get(key[1])
+        return entry.revision if entry is not None else None
+
+    def document(self, key):
+        '''
+        return (revision, json bytes) of key, None if it doesn't exist
+        '''
+        revision = self.revision(key)
+        if revision is None:
+            return None
+        cached = self._documents.get(key)
+        if cached is not None and cached[0] == revision:
+            return cached
+        cached = (revision, self._encode(key, revision))
+        self._documents[key] = cached
+        return cached
+
+    def wait(self, key):
+        '''
+        a Future resolved on the next change of key
+        '''
+        future = Future()
+        self._waiters.setdefault(key, []).append(future)
+        return future
+
+    def cancel(self, key, future):
+        waiters = self._waiters.get(key)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self._waiters[key]
+
+    def _encode(self, key, revision):
+        data = {"epoch": self.registry.epoch, "revision": revision}
+        kind = key[0]
+        if kind == "nodes":
+            data["nodes"] = [dict(entry.view) for entry in self.registry]
+        elif kind == "services":
+            data["services"] = sorted(service for service in self.registry.services() if service is not None)
+        elif kind == "service":
+            data["service"] = key[1]
+            data["nodes"] = [dict(entry.view) for entry in self.registry.find_by_service(key[1])]
+        else:
+            data["node"] = dict(self.registry.get(key[1]).view)
+        return json.dumps(data).encode("utf-8")
+
+    def _on_registry_event(self, event):
+        keys = [("nodes", ), ("node", event.node_id)]
+        for service in (event.service, event.previous_service):
+            if service is not None:
+                keys.append(("service", service))
+                if self.registry.has_service(service):
+                    self._service_revisions[service] = event.revision
+                else:
+                    # its last node is gone
+                    self._service_revisions.pop(service, None)
+                    self._documents.pop(("service", service), None)
+        if event.previous_service is not None or event.type != Event.updated:
+            self._services_revision = event.revision
+            keys.append(("services", ))
+        if event.type == Event.removed:
+            self._documents.pop(("node", event.node_id), None)
+        for key in keys:
+            waiters = self._waiters.pop(key, None)
+            if waiters:
+                for future in waiters:
+                    if not future.done():
+                        future.set_result(event.revision)
+
+    def _wake_all(self):
+        waiters, self._waiters = self._waiters, {}
+        for futures in waiters.values():
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
+
+
+class RegistryHandler(tornado.web.RequestHandler):
+    '''
+    GET a registry document as JSON, the ETag is "epoch-revision", so
+    If-None-Match is answered with 304 without encoding anything.
+    ?wait=N long-polls: the reply is held until the document's revision is
+    greater than N or ?timeout= seconds (30 by default) passed
+    '''
+    def initialize(self, cache):
+        self.cache = cache
+        self._key = None
+        self._waiter = None
+        self._revision = None
+        self._closed = False
+
+    def key(self, *args):
+        raise NotImplementedError
+
+    async def get(self, *args):
+        self._key = self.key(*args)
+        wait = self.get_argument("wait", None)
+        if wait is not None:
+            try:
+                wait = int(wait)
+                timeout = min(float(self.get_argument("timeout", 30)), MAX_WAIT)
+            except ValueError:
+                raise tornado.web.HTTPError(400)
+            # only an up to date reader waits, one behind or from another epoch gets the document now
+            if self.cache.revision(self._key) == wait:
+                self._waiter = self.cache.wait(self._key)
+                try:
+                    await gen.with_timeout(timedelta(seconds = timeout), self._waiter)
+                except gen.TimeoutError:
+                    pass
+                finally:
+                    self.cache.cancel(self._key, self._waiter)
+                    self._waiter = None
+                if self._closed:
+                    return
+        document = self.cache.document(self._key)
+        if document is None:
+            raise tornado.web.HTTPError(404)
+        self._revision, body = document
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("X-Discovery-Revision", str(self._revision))
+        self.write(body)
+
+    def compute_etag(self):
+        if self._revision is None:
+            return None
+        return '"%s-%s"' % (self.cache.registry.epoch, self._revision)
+
+    def on_connection_close(self):
+        self._closed = True
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+
+class NodesHandler(RegistryHandler):
+    def key(self):
+        return ("nodes", )
+
+
+class ServicesHandler(RegistryHandler):
+    def key(self):
+        return ("services", )
+
+
+class ServiceHandler(RegistryHandler):
+    def key(self, service):
+        return ("service", service)
+
+
+class NodeHandler(RegistryHandler):
+    def key(self, node_id):
+        return ("node", node_id)
+
+
+def api_handlers(cache, prefix = ""):
+    '''
+    the url specs of the http api on cache, to mount them in an application:
+    GET prefix/nodes, prefix/nodes/<node_id>, prefix/services, prefix/services/<service>
+    '''
+    kwargs = {"cache": cache}
+    return [
+        (prefix + r"/nodes", NodesHandler, kwargs),
+        (prefix + r"/nodes/([^/]+)", NodeHandler, kwargs),
+        (prefix + r"/services", ServicesHandler, kwargs),
+        (prefix + r"/services/([^/]+)", ServiceHandler, kwargs),
+    ]
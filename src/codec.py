@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+import json
+import zlib
+import struct
+
+from .common import Command, Status, Event
+
+
+FLAG_COMPRESSED = 0x01
+CODEC_SHIFT = 1
+CODEC_MASK = 0x07
+
+
+class CodecError(Exception):
+    pass
+
+
+class Codec(object):
+    name = None
+    codec_id = None
+
+    def encode(self, data):
+        raise NotImplementedError
+
+    def decode(self, payload):
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    name = "JSON"
+    codec_id = 0
+
+    def encode(self, data):
+        return json.dumps(data).encode("utf-8")
+
+    def decode(self, payload):
+        return json.loads(payload.decode("utf-8"))
+
+
+# append only, the index is what goes on the wire
+INTERNED = (
+    "command", "data", "status", "message", "node_id",
+    "http_host", "http_port", "heartbeat_interval", "heartbeat_timeout",
+    "version", "base", "update", "delete", "delta", "framing", "codecs", "codec",
+    Command.register, Command.unregister, Command.heartbeat,
+    Command.error, Command.warning, Command.message,
+    Status.success, Status.failure, Status.green, Status.yellow, Status.red,
+    Status.connected, Status.registered, Status.resync,
+    "revision", "epoch", "events", "snapshot", "service", "tags", "type", "info",
+    Command.watch, Event.added, Event.updated, Event.removed,
+    "id", Command.sync, "reset",
+    Command.replicate, "origin", "digest", "count", "checksum",
+    "batch",
+)
+
+T_NONE = 0x00
+T_TRUE = 0x01
+T_FALSE = 0x02
+T_INT8 = 0x03
+T_INT32 = 0x04
+T_INT64 = 0x05
+T_FLOAT = 0x06
+T_STR8 = 0x07
+T_STR = 0x08
+T_LIST = 0x09
+T_DICT = 0x0A
+T_BIGINT = 0x0B
+T_BIGINT32 = 0x0C # 256 digits or more, uint32 length
+T_INTERNED = 0x80
+
+INT8 = struct.Struct(">b")
+INT32 = struct.Struct(">i")
+INT64 = struct.Struct(">q")
+FLOAT = struct.Struct(">d")
+UINT32 = struct.Struct(">I")
+
+NONE_VALUE = bytes((T_NONE,))
+TRUE_VALUE = bytes((T_TRUE,))
+FALSE_VALUE = bytes((T_FALSE,))
+INT8_VALUES = [bytes((T_INT8,)) + INT8.pack(i) for i in range(-128, 128)]
+INT32_PREFIX = bytes((T_INT32,))
+INT64_PREFIX = bytes((T_INT64,))
+FLOAT_PREFIX = bytes((T_FLOAT,))
+STR8_PREFIX = [bytes((T_STR8, i)) for i in range(256)]
+STR_PREFIX = bytes((T_STR,))
+LIST_PREFIX = bytes((T_LIST,))
+DICT_PREFIX = bytes((T_DICT,))
+
+
+class CompactCodec(Codec):
+    '''
+    tagged binary encoding of json compatible values, well-known keys and
+    the Command/Status values are packed as one byte
+    '''
+    name = "COMPACT"
+    codec_id = 1
+
+    def __init__(self, interned = INTERNED):
+        self.interned = interned
+        self.interned_index = dict((s, bytes((T_INTERNED | i,))) for i, s in enumerate(interned))
+
+    def encode(self, data):
+        out = []
+        self._encode(data, out)
+        return b"".join(out)
+
+    def decode(self, payload):
+        value, offset = self._decode(payload, 0)
+        if offset != len(payload):
+            raise CodecError("trailing bytes: %s" % (len(payload) - offset))
+        return value
+
+    def _encode(self, value, out):
+        if isinstance(value, str):
+            tag = self.interned_index.get(value)
+            if tag is not None:
+                out.append(tag)
+            else:
+                s = value.encode("utf-8")
+                if len(s) < 256:
+                    out.append(STR8_PREFIX[len(s)])
+                else:
+                    out.append(STR_PREFIX + UINT32.pack(len(s)))
+                out.append(s)
+        elif isinstance(value, dict):
+            out.append(DICT_PREFIX + UINT32.pack(len(value)))
+            for k, v in value.items():
+                self._encode(k if isinstance(k, str) else json.dumps(k), out)
+                self._encode(v, out)
+        elif value is None:
+            out.append(NONE_VALUE)
+        elif value is True:
+            out.append(TRUE_VALUE)
+        elif value is False:
+            out.append(FALSE_VALUE)
+        elif isinstance(value, int):
+            if -128 <= value < 128:
+                out.append(INT8_VALUES[value + 128])
+            elif -2147483648 <= value < 2147483648:
+                out.append(INT32_PREFIX + INT32.pack(value))
+            elif -9223372036854775808 <= value < 9223372036854775808:
+                out.append(INT64_PREFIX + INT64.pack(value))
+            else:
+                s = str(value).encode("utf-8")
+                if len(s) < 256:
+                    out.append(bytes((T_BIGINT, len(s))) + s)
+                else:
+                    out.append(bytes((T_BIGINT32,)) + UINT32.pack(len(s)) + s)
+        elif isinstance(value, float):
+            out.append(FLOAT_PREFIX + FLOAT.pack(value))
+        elif isinstance(value, (list, tuple)):
+            out.append(LIST_PREFIX + UINT32.pack(len(value)))
+            for v in value:
+                self._encode(v, out)
+        else:
+            raise CodecError("can't encode type: %s" % type(value))
+
+    def _decode(self, payload, offset):
+        tag = payload[offset]
+        offset += 1
+        if tag & T_INTERNED:
+            return self.interned[tag & 0x7f], offset
+        if tag == T_STR8:
+            end = offset + 1 + payload[offset]
+            return payload[offset + 1:end].decode("utf-8"), end
+        if tag == T_DICT:
+            count = UINT32.unpack_from(payload, offset)[0]
+            offset += 4
+            value = {}
+            for _ in range(count):
+                k, offset = self._decode(payload, offset)
+                value[k], offset = self._decode(payload, offset)
+            return value, offset
+        if tag == T_INT8:
+            return INT8.unpack_from(payload, offset)[0], offset + 1
+        if tag == T_INT32:
+            return INT32.unpack_from(payload, offset)[0], offset + 4
+        if tag == T_NONE:
+            return None, offset
+        if tag == T_TRUE:
+            return True, offset
+        if tag == T_FALSE:
+            return False, offset
+        if tag == T_LIST:
+            count = UINT32.unpack_from(payload, offset)[0]
+            offset += 4
+            value = []
+            for _ in range(count):
+                v, offset = self._decode(payload, offset)
+                value.append(v)
+            return value, offset
+        if tag == T_STR:
+            end = offset + 4 + UINT32.unpack_from(payload, offset)[0]
+            return payload[offset + 4:end].decode("utf-8"), end
+        if tag == T_INT64:
+            return INT64.unpack_from(payload, offset)[0], offset + 8
+        if tag == T_FLOAT:
+            return FLOAT.unpack_from(payload, offset)[0], offset + 8
+        if tag == T_BIGINT:
+            end = offset + 1 + payload[offset]
+            return int(payload[offset + 1:end]), end
+        if tag == T_BIGINT32:
+            end = offset + 4 + UINT32.unpack_from(payload, offset)[0]
+            return int(payload[offset + 4:end]), end
+        raise CodecError("unknown tag: %s" % tag)
+
+
+CODECS = {}
+CODEC_IDS = {}
+
+
+def register_codec(codec):
+    if codec.codec_id is None or not 0 <= codec.codec_id <= CODEC_MASK:
+        raise CodecError("invalid codec_id: %s" % codec.codec_id)
+    CODECS[codec.name] = codec
+    CODEC_IDS[codec.codec_id] = codec
+
+
+register_codec(JsonCodec())
+register_codec(CompactCodec())
+
+DEFAULT_CODEC = CODECS[JsonCodec.name]
+
+
+def choose_codec(offered):
+    '''
+    offered is a list of codec names in preference order
+    '''
+    for name in offered or []:
+        if name in CODECS:
+            return CODECS[name]
+    return DEFAULT_CODEC
+
+
+def encode_payload(data, codec = DEFAULT_CODEC, compress_threshold = None):
+    '''
+    return (payload, flags), payloads not shorter than compress_threshold are zlib compressed
+    '''
+    payload = codec.encode(data)
+    flags = codec.codec_id << CODEC_SHIFT
+    if compress_threshold is not None and len(payload) >= compress_threshold:
+        payload = zlib.compress(payload)
+        flags |= FLAG_COMPRESSED
+    return payload, flags
+
+
+def decode_payload(payload, flags = 0):
+    codec = CODEC_IDS.get((flags >> CODEC_SHIFT) & CODEC_MASK)
+    if codec is None:
+        raise CodecError("unknown codec flags: %s" % flags)
+    if flags & FLAG_COMPRESSED:
+        payload = zlib.decompress(payload)
+    return codec.decode(payload)
@@ -24,6 +24,10 @@ class Command(object):
     error = "ERROR"
     warning = "WARNING"
     message = "MESSAGE"
+    watch = "WATCH"
+    sync = "SYNC"
+    replicate = "REPLICATE"
+    fallback = "FALLBACK"
 
 
 class Status(object):
@@ -34,6 +38,33 @@ class Status(object):
     red = "RED"
     connected = "CONNECTED"
     registered = "REGISTERED"
+    resync = "RESYNC"
+    retry = "RETRY"
+
+
+class Event(object):
+    added = "ADDED"
+    updated = "UPDATED"
+    removed = "REMOVED"
+
+
+class Backpressure(object):
+    drop = "DROP"
+    coalesce = "COALESCE"
+    disconnect = "DISCONNECT"
+
+
+class ProbeMode(object):
+    tcp = "TCP"
+    http = "HTTP"
+
+
+class Delivery(object):
+    delivered = "delivered"
+    dropped = "dropped"
+    coalesced = "coalesced"
+    disconnected = "disconnected"
+    failed = "failed"
 
 
 class Message(object):
@@ -1,26 +1,65 @@
 # -*- coding: utf-8 -*-
 
 class BaseConfig(object):
+    '''
+    every modification bumps version, and the version each key was last
+    changed or removed at is recorded, so a registrant can send only the
+    keys modified since the version the listener already holds.
+    modify the config through these methods, changes made directly on
+    the dict returned by to_dict are not tracked.
+    '''
     def __init__(self):
         self.config = {}
+        self.version = 0
+        self._changes = {} # key: (version, removed)
 
     def has_key(self, key):
         return key in self.config
 
     def update(self, key, value):
         self.config.update({key: value})
+        self._touch(key)
 
     def get(self, key):
         return self.config[key]
 
     def set(self, key, value):
         self.config[key] = value
+        self._touch(key)
 
     def delete(self, key):
         del(self.config[key])
+        self._touch(key, removed = True)
 
     def to_dict(self):
         return self.config
 
     def from_dict(self, data):
+        changed = [key for key in data if key not in self.config or self.config[key] != data[key]]
+        removed = [key for key in self.config if key not in data]
         self.config = data
+        if changed or removed:
+            self.version += 1
+            for key in changed:
+                self._changes[key] = (self.version, False)
+            for key in removed:
+                self._changes[key] = (self.version, True)
+
+    def diff(self, since):
+        '''
+        return (update, delete), the keys changed and removed after version since
+        '''
+        update = {}
+        delete = []
+        if since != self.version:
+            for key, (version, removed) in self._changes.items():
+                if version > since:
+                    if removed:
+                        delete.append(key)
+                    else:
+                        update[key] = self.config[key]
+        return update, delete
+
+    def _touch(self, key, removed = False):
+        self.version += 1
+        self._changes[key] = (self.version, removed)
@@ -1,31 +1,137 @@
 # -*- coding: utf-8 -*-
 
-import json
+import time
 import logging
 import uuid
 from uuid import uuid4
+from functools import partial
 
 import tornado.iostream
 from tornado import gen
 from tornado.ioloop import IOLoop
 
-from .common import crc32sum, Command, Status, Message
+from .common import Command, Status, Message, Backpressure, Delivery
+from .protocol import Framing, new_header_buffer, pack_frame, read_frame
+from .codec import DEFAULT_CODEC, choose_codec, encode_payload, decode_payload
+from .timing_wheel import TimingWheel
+from .registry import Registry
+from .info import NodeInfo
+from .lease import lease_to_dict
+from .metrics import METRICS, LAG_BUCKETS
 
 LOG = logging.getLogger(__name__)
 
 
+class ConnectionMetrics(object):
+    '''
+    the listener's metric objects, created once per Metrics
+    '''
+    commands = (Command.register, Command.unregister, Command.heartbeat, Command.watch, Command.replicate)
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.connections = metrics.gauge("discovery_listener_connections", "open connections")
+        self.nodes = metrics.gauge("discovery_listener_registry_nodes", "nodes in the registry")
+        self.accepted = metrics.counter("discovery_listener_accepted_total", "accepted connections")
+        self.tls_handshakes = dict(
+            (result, metrics.counter("discovery_listener_tls_handshakes_total", "TLS handshakes of accepted connections", {"result": result}))
+            for result in ("full", "resumed", "failed")
+        )
+        self.requests = dict(
+            (command, metrics.counter("discovery_listener_requests_total", "requests by command", {"command": command}))
+            for command in self.commands
+        )
+        self.errors = metrics.counter("discovery_listener_errors_total", "error and failure replies")
+        self.timeouts = metrics.counter("discovery_listener_heartbeat_timeouts_total", "connections removed by heartbeat_timeout")
+        self.bytes_in = metrics.counter("discovery_listener_received_bytes_total", "received payload bytes")
+        self.bytes_out = metrics.counter("discovery_listener_sent_bytes_total", "sent frame bytes")
+        self.heartbeat_lag = metrics.histogram(
+            "discovery_listener_heartbeat_lag_seconds",
+            "heartbeat arrival interval minus heartbeat_interval",
+            buckets = LAG_BUCKETS
+        )
+        sample_every = metrics.sample_every
+        self.decode_time = metrics.histogram(
+            "discovery_listener_decode_seconds", "payload decode time, sampled", sample_every = sample_every
+        )
+        self.encode_time = metrics.histogram(
+            "discovery_listener_encode_seconds", "frame encode time, sampled", sample_every = sample_every
+        )
+        self.handle_time = metrics.histogram(
+            "discovery_listener_handle_seconds", "request handling time, sampled", sample_every = sample_every
+        )
+        self.write_time = metrics.histogram(
+            "discovery_listener_write_seconds", "time until a frame is flushed, sampled", sample_every = sample_every
+        )
+
+
+class NodeSession(object):
+    '''
+    a node registered by a batched REGISTER, several of them share one connection,
+    it is the registry entry's connection and the node's timing wheel key
+    '''
+    __slots__ = ("connection", "info", "version", "lease")
+
+    def __init__(self, connection, info, version, lease = None):
+        self.connection = connection
+        self.info = info
+        self.version = version
+        self.lease = lease # (ttl, heartbeat_interval) granted by the listener
+
+    def expire(self):
+        self.connection._expire_session(self)
+
+
 class BaseConnection(object):
     clients = set()
+    registry = Registry()
+    replicator = None # set by BaseListener.enable_replication
+    health = None # set by BaseListener.enable_health
+    admission = None # set by BaseListener.enable_admission_control
+    lease_policy = None # set by BaseListener.enable_leases
+    prober = None # set by BaseListener.enable_probing
+    udp = None # set by BaseListener.listen_udp
     status = Status.red
+    timing_wheel_tick = 1.0 # seconds, heartbeat_timeout accuracy
+    compress_threshold = None # bytes, zlib compress larger payloads in binary framing
+    max_write_buffer = 1024 * 1024 # bytes, outstanding writes allowed per client for broadcasts
+    broadcast_policy = Backpressure.drop
+    metrics = METRICS
+    _instruments = None
+    # subclasses without __slots__ get a __dict__ as usual
+    __slots__ = (
+        "_stream", "_address", "_status", "info", "_version", "_watching", "_watch_service",
+        "_peer_origin", "_framing", "_codec", "_compress_threshold", "_header_buffer",
+        "_pending_bytes", "_coalesced_frame", "_last_heartbeat", "_metrics", "_sessions",
+        "_handshake", "_handshake_timeout", "_lease",
+    )
 
     def __init__(self, stream, address):
         BaseConnection.clients.add(self)
+        self._metrics = self.get_instruments()
+        self._metrics.accepted.inc()
         self._stream = stream
         self._address = address
         self._stream.set_close_callback(self._on_close)
         self._status = Status.connected
-        self.info = {}
-        self._heartbeat_timeout = None
+        self.info = NodeInfo()
+        self._version = None
+        self._watching = False
+        self._watch_service = None
+        self._peer_origin = None
+        self._framing = Framing.delimiter
+        self._codec = DEFAULT_CODEC
+        self._compress_threshold = None
+        self._header_buffer = new_header_buffer()
+        self._pending_bytes = 0
+        self._coalesced_frame = None
+        self._last_heartbeat = None
+        self._sessions = None # node_id: NodeSession, for batched registrations
+        self._handshake = self.admission is not None # counted by admission until the first reply
+        self._handshake_timeout = None
+        if self._handshake and self.admission.handshake_timeout is not None:
+            self._handshake_timeout = IOLoop.current().call_later(self.admission.handshake_timeout, self._on_handshake_timeout)
+        self._lease = None # (ttl, heartbeat_interval) granted by lease_policy
         self._on_connect()
         LOG.info("Client (%s) Register", self._address)
 
@@ -33,7 +139,9 @@ class BaseConnection(object):
     def get_cluster_status(cls):
         result = False
         try:
-            if len(BaseConnection.clients) == 0:
+            if cls.health is not None:
+                BaseConnection.status = cls.health.status
+            elif len(BaseConnection.clients) == 0:
                 BaseConnection.status = Status.red
             else:
                 BaseConnection.status = Status.green
@@ -42,32 +150,141 @@ class BaseConnection(object):
             LOG.exception(e)
         return result
 
+    @classmethod
+    def get_service_status(cls, service):
+        '''
+        GREEN/YELLOW/RED of service, needs BaseListener.enable_health
+        '''
+        if cls.health is not None:
+            return cls.health.service_status(service)
+        return Status.green if cls.registry.find_by_service(service) else Status.red
+
+    @classmethod
+    def get_instruments(cls):
+        if cls._instruments is None or cls._instruments.metrics is not cls.metrics:
+            cls._instruments = ConnectionMetrics(cls.metrics)
+            cls.metrics.add_collector(cls.collect_metrics)
+        return cls._instruments
+
+    @classmethod
+    def collect_metrics(cls, metrics):
+        '''
+        refresh the gauges before metrics are rendered, override it to add custom ones
+        '''
+        instruments = cls.get_instruments()
+        instruments.connections.set(len(BaseConnection.clients))
+        instruments.nodes.set(len(cls.registry))
+
+    @classmethod
+    def get_timing_wheel(cls):
+        return TimingWheel.instance(tick = cls.timing_wheel_tick)
+
     @gen.coroutine
     def read_message(self):
+        payload, flags = yield read_frame(self._stream, self._header_buffer)
+        raise gen.Return(self._decode(payload, flags))
+
+    def _decode(self, payload, flags):
         data = {"command": Command.error, "data": Message.received_wrong_msg}
-        msg = yield self._stream.read_until(Message.msg_end)
-        data_string, data_crc32 = msg.strip().split(Message.msg_sp)
-        if crc32sum(data_string) == data_crc32:
-            data = json.loads(data_string.decode("utf-8"))
+        if payload is not None:
+            self._metrics.bytes_in.inc(len(payload))
+            if self._metrics.decode_time.sample():
+                t = time.perf_counter()
+                data = decode_payload(payload, flags)
+                self._metrics.decode_time.observe(time.perf_counter() - t)
+            else:
+                data = decode_payload(payload, flags)
             LOG.debug("Received: %s", data)
-        raise gen.Return(data)
+        return data
 
     @gen.coroutine
     def send_message(self, data, refuse_connect_flag = False):
         try:
-            data_string = json.dumps(data).encode("utf-8")
-            data_crc32 = crc32sum(data_string)
             LOG.debug("Send: %s", data)
-            msg = b"%s%s%s%s" % (data_string, Message.msg_sp, data_crc32, Message.msg_end)
-            yield self._stream.write(msg)
+            yield self._write(self.encode_frame(data))
             if refuse_connect_flag:
                 self._refuse_connect()
         except Exception as e:
             LOG.exception(e)
 
-    def broadcast_message(self, data):
-        for client in BaseConnection.clients:
-            client.send_message(data)
+    def broadcast_message(self, data, policy = None):
+        '''
+        encode data once per framing/codec and queue it to every client, a client
+        with more than max_write_buffer bytes outstanding is handled by policy
+        (default broadcast_policy), return the number of clients per Delivery result
+        '''
+        summary = {
+            Delivery.delivered: 0,
+            Delivery.dropped: 0,
+            Delivery.coalesced: 0,
+            Delivery.disconnected: 0,
+            Delivery.failed: 0,
+        }
+        frames = {}
+        for client in list(BaseConnection.clients):
+            try:
+                result = client.write_frame(client.encode_frame(data, frames), policy)
+            except Exception as e:
+                LOG.exception(e)
+                result = Delivery.failed
+            summary[result] += 1
+        return summary
+
+    def encode_frame(self, data, frames = None):
+        '''
+        frames is an optional cache shared between connections encoding the same data
+        '''
+        key = (self._framing, self._codec.codec_id, self._compress_threshold)
+        if frames is not None and key in frames:
+            return frames[key]
+        if self._metrics.encode_time.sample():
+            t = time.perf_counter()
+            payload, flags = encode_payload(data, self._codec, self._compress_threshold)
+            frame = pack_frame(payload, self._framing, flags)
+            self._metrics.encode_time.observe(time.perf_counter() - t)
+        else:
+            payload, flags = encode_payload(data, self._codec, self._compress_threshold)
+            frame = pack_frame(payload, self._framing, flags)
+        if frames is not None:
+            frames[key] = frame
+        return frame
+
+    def write_frame(self, frame, policy = None):
+        '''
+        queue an encoded frame subject to max_write_buffer, return a Delivery result
+        '''
+        if self._stream.closed():
+            return Delivery.failed
+        if self._pending_bytes > 0 and self._pending_bytes + len(frame) > self.max_write_buffer:
+            policy = policy or self.broadcast_policy
+            if policy == Backpressure.coalesce:
+                self._coalesced_frame = frame
+                return Delivery.coalesced
+            if policy == Backpressure.disconnect:
+                LOG.warning("Client(%s) write buffer full: %s bytes, disconnect", self._address, self._pending_bytes)
+                self._stream.close()
+                return Delivery.disconnected
+            return Delivery.dropped
+        self._write(frame)
+        return Delivery.delivered
+
+    def _write(self, frame):
+        self._pending_bytes += len(frame)
+        self._metrics.bytes_out.inc(len(frame))
+        start = time.perf_counter() if self._metrics.write_time.sample() else None
+        future = self._stream.write(frame)
+        future.add_done_callback(partial(self._on_write_done, len(frame), start))
+        return future
+
+    def _on_write_done(self, size, start, future):
+        if start is not None:
+            self._metrics.write_time.observe(time.perf_counter() - start)
+        self._pending_bytes -= size
+        if future.exception() is None and self._coalesced_frame is not None:
+            if self._pending_bytes + len(self._coalesced_frame) <= self.max_write_buffer:
+                frame = self._coalesced_frame
+                self._coalesced_frame = None
+                self._write(frame)
 
     def status(self):
         LOG.debug("Writing(%s): %s", self._address, self._stream.writing())
@@ -77,98 +294,500 @@ class BaseConnection(object):
     def _on_connect(self):
         try:
             while True:
-                refuse_connect_flag = False
                 data = yield self.read_message()
-                send_data = {}
-                # register
-                if "command" in data and data["command"] == Command.register:
-                    self.info = data["data"]
-                    if self.info["http_host"] == "0.0.0.0":
-                        self.info["http_host"] = self._address[0]
-                    # no node_id
-                    if "node_id" not in self.info or self.info["node_id"] == None:
-                        node_id = str(uuid4())
-                        send_data = {
-                            "command": Command.register,
-                            "data": {
-                                "status": Status.success,
-                                "message": Status.success,
-                                "node_id": node_id,
-                            }
-                        }
-                        self.info["node_id"] = node_id
-                        self._status = Status.registered
-                    # register with node_id
-                    else:
-                        send_data = {
-                            "command": Command.register,
-                            "data": {
-                                "status": Status.success,
-                                "message": Status.success,
-                                "node_id": self.info["node_id"],
-                            }
-                        }
-                        self._status = Status.registered
-                elif "command" in data and data["command"] == Command.heartbeat:
-                    self.info = data["data"]
-                    if self.info["http_host"] == "0.0.0.0":
-                        self.info["http_host"] = self._address[0]
-                    if self._status == Status.registered:
-                        send_data = {
-                            "command": Command.heartbeat,
-                            "data": {
-                                "status": Status.success,
-                                "message": Status.success,
-                            }
-                        }
-                        if self._heartbeat_timeout:
-                            IOLoop.instance().remove_timeout(self._heartbeat_timeout)
-                        self._heartbeat_timeout = IOLoop.instance().add_timeout(
-                            IOLoop.time(IOLoop.instance()) + self.info["heartbeat_timeout"],
-                            self._remove_connection
-                        )
-                    else:
-                        send_data = {
-                            "command": Command.heartbeat,
-                            "data": {
-                                "status": Status.failure,
-                                "message": "invalid node_id: %s" % self.info["node_id"],
-                            }
-                        }
-                        refuse_connect_flag = True
-                else:
-                    LOG.error("Client(%s) invaild message error: %s", self._address, data)
-                    send_data = {
-                        "command": Command.error,
-                        "data": {
-                            "status": Status.failure,
-                            "message": "Unknown Command!",
-                        }
-                    }
+                start = time.perf_counter() if self._metrics.handle_time.sample() else None
+                send_data, refuse_connect_flag = self._handle(data)
                 self.send_message(send_data, refuse_connect_flag = refuse_connect_flag)
+                self._end_handshake()
+                if start is not None:
+                    self._metrics.handle_time.observe(time.perf_counter() - start)
         except tornado.iostream.StreamClosedError:
             LOG.info("Closed: %s", self._address)
         except Exception as e:
             LOG.exception(e)
 
-    def _remove_connection(self):
+    def _handle(self, data):
+        '''
+        handle one request, return (reply, refuse_connect_flag)
+        '''
+        refuse_connect_flag = False
+        send_data = {}
+        if data.get("command") in self._metrics.requests:
+            self._metrics.requests[data["command"]].inc()
+        retry_after = self._admit(data)
+        if retry_after is not None:
+            send_data = {
+                "command": Command.register,
+                "data": {
+                    "status": Status.retry,
+                    "message": "retry after %.3f seconds" % retry_after,
+                    "retry_after": retry_after,
+                }
+            }
+            refuse_connect_flag = True
+        elif "batch" in data and data.get("command") in (Command.register, Command.heartbeat):
+            send_data = self._batch(data)
+        # register
+        elif "command" in data and data["command"] == Command.register:
+            previous_node_id = self.info.get("node_id")
+            self.info = NodeInfo.from_dict(data["data"])
+            self._version = data.get("version")
+            if self.info["http_host"] == "0.0.0.0":
+                self.info["http_host"] = self._address[0]
+            self._negotiate(data)
+            # no node_id
+            if "node_id" not in self.info or self.info["node_id"] == None:
+                node_id = str(uuid4())
+                send_data = {
+                    "command": Command.register,
+                    "data": {
+                        "status": Status.success,
+                        "message": Status.success,
+                        "node_id": node_id,
+                    },
+                    "version": self._version,
+                    "framing": self._framing,
+                    "codec": self._codec.name,
+                }
+                self.info["node_id"] = node_id
+                self._status = Status.registered
+            # register with node_id
+            else:
+                send_data = {
+                    "command": Command.register,
+                    "data": {
+                        "status": Status.success,
+                        "message": Status.success,
+                        "node_id": self.info["node_id"],
+                    },
+                    "version": self._version,
+                    "framing": self._framing,
+                    "codec": self._codec.name,
+                }
+                self._status = Status.registered
+            if previous_node_id is not None and previous_node_id != self.info["node_id"]:
+                # one node per connection, the new registration replaces the previous one
+                self.registry.remove(previous_node_id, self)
+            self.registry.register(self.info["node_id"], self.info, self)
+            self._lease = self._grant(self.info)
+            if self._lease is not None:
+                send_data["lease"] = lease_to_dict(self._lease)
+            if self.udp is not None and data.get("udp"):
+                send_data["udp"] = self._grant_udp()
+            self._renew()
+        elif "command" in data and data["command"] == Command.heartbeat:
+            self._observe_heartbeat()
+            if data.get("delta"):
+                synced, changed = self._apply_delta(data["data"])
+            else:
+                if data["data"].get("http_host") == "0.0.0.0":
+                    data["data"]["http_host"] = self._address[0]
+                if "node_id" in self.info and data["data"].get("node_id") is None:
+                    data["data"]["node_id"] = self.info["node_id"]
+                if self.prober is not None:
+                    self.prober.annotate(data["data"].get("node_id"), data["data"])
+                changed = self.info != data["data"]
+                if changed:
+                    self.info = NodeInfo.from_dict(data["data"])
+                self._version = data.get("version")
+                synced = True
+            if self._status == Status.registered and not synced:
+                send_data = {
+                    "command": Command.heartbeat,
+                    "data": {
+                        "status": Status.resync,
+                        "message": "version mismatch: %s" % self._version,
+                        "version": self._version,
+                    }
+                }
+            elif self._status == Status.registered:
+                send_data = {
+                    "command": Command.heartbeat,
+                    "data": {
+                        "status": Status.success,
+                        "message": Status.success,
+                    }
+                }
+                if changed:
+                    self.registry.update(self.info["node_id"], self.info)
+                if self.udp is not None and data.get("udp"):
+                    # back to UDP after a fallback
+                    send_data["udp"] = self._grant_udp()
+                self._renew()
+            else:
+                send_data = {
+                    "command": Command.heartbeat,
+                    "data": {
+                        "status": Status.failure,
+                        "message": "invalid node_id: %s" % self.info.get("node_id"),
+                    }
+                }
+                refuse_connect_flag = True
+        elif "command" in data and data["command"] == Command.unregister:
+            send_data = self._unregister(data)
+        elif "command" in data and data["command"] == Command.watch:
+            self._negotiate(data)
+            send_data = self._watch(data.get("data") or {})
+        elif "command" in data and data["command"] == Command.replicate and self.replicator:
+            self._negotiate(data)
+            self._peer_origin = data["data"]["origin"]
+            send_data = {
+                "command": Command.replicate,
+                "data": {
+                    "status": self.replicator.apply(self._peer_origin, data["data"]),
+                    "message": Status.success,
+                },
+                "framing": self._framing,
+                "codec": self._codec.name,
+            }
+        else:
+            LOG.error("Client(%s) invaild message error: %s", self._address, data)
+            send_data = {
+                "command": Command.error,
+                "data": {
+                    "status": Status.failure,
+                    "message": "Unknown Command!",
+                }
+            }
+        if "id" in data:
+            send_data["id"] = data["id"]
+        if send_data["command"] == Command.error or send_data["data"]["status"] == Status.failure:
+            self._metrics.errors.inc()
+        return send_data, refuse_connect_flag
+
+    def _grant(self, info):
+        '''
+        the lease of a registering node, None without lease_policy
+        '''
+        if self.lease_policy is None:
+            return None
+        return self.lease_policy.grant(info)
+
+    def _renew(self):
+        '''
+        start or renew the lease of the connection's node, without a granted
+        lease it lasts the heartbeat_timeout of the node's info
+        '''
+        ttl, heartbeat_interval = self._lease or (self.info["heartbeat_timeout"], self.info["heartbeat_interval"])
+        self.get_timing_wheel().schedule(self, IOLoop.current().time() + ttl, self._remove_connection)
+        if self.health is not None:
+            self.health.heartbeat(self.info["node_id"], heartbeat_interval)
+
+    def _udp_heartbeat(self):
+        '''
+        a valid UDP heartbeat of the connection's node arrived, see HeartbeatReceiver
+        '''
+        if self._status == Status.registered:
+            self._observe_heartbeat()
+            self._renew()
+
+    def _grant_udp(self):
+        heartbeat_interval = (self._lease or (None, self.info["heartbeat_interval"]))[1]
+        return self.udp.grant(self.info["node_id"], self, heartbeat_interval)
+
+    def _udp_fallback(self, loss):
+        '''
+        tell the node to heartbeat over TCP again
+        '''
+        try:
+            self._write(self.encode_frame({
+                "command": Command.fallback,
+                "data": {"node_id": self.info.get("node_id"), "loss": loss},
+            }))
+        except Exception as e:
+            LOG.exception(e)
+
+    def _unregister(self, data):
+        '''
+        remove the connection's node, or the batched nodes in data["batch"], from
+        the registry right away, watchers see it removed as on a timeout.
+        the connection stays open, it can register again
+        '''
+        if "batch" in data:
+            return {
+                "command": Command.unregister,
+                "data": {"status": Status.success, "message": Status.success},
+                "batch": [self._unregister_session(item.get("node_id")) for item in data["batch"]],
+            }
+        node_id = self.info.get("node_id")
+        if self._status != Status.registered or node_id is None:
+            return {
+                "command": Command.unregister,
+                "data": {
+                    "status": Status.failure,
+                    "message": "not registered",
+                }
+            }
+        self.get_timing_wheel().cancel(self)
+        self._status = Status.connected
+        self._lease = None
+        self.registry.remove(node_id, self)
+        LOG.info("Client(%s) node_id: %s unregistered", self._address, node_id)
+        return {
+            "command": Command.unregister,
+            "data": {
+                "status": Status.success,
+                "message": Status.success,
+                "node_id": node_id,
+            }
+        }
+
+    def _unregister_session(self, node_id):
+        session = self._sessions.pop(node_id, None) if self._sessions else None
+        if session is None:
+            return {"status": Status.failure, "node_id": node_id, "message": "invalid node_id: %s" % node_id}
+        self.get_timing_wheel().cancel(session)
+        self.registry.remove(node_id, session)
+        LOG.info("Client(%s) node_id: %s unregistered", self._address, node_id)
+        return {"status": Status.success, "node_id": node_id}
+
+    def _admit(self, data):
+        '''
+        return None if the registration is admitted, otherwise the seconds the registrant has to wait
+        '''
+        if self.admission is None or data.get("command") != Command.register:
+            return None
+        return self.admission.admit(len(data.get("batch") or ()) or 1)
+
+    def _end_handshake(self):
+        if self._handshake:
+            self._handshake = False
+            self.admission.end_handshake()
+            if self._handshake_timeout is not None:
+                IOLoop.current().remove_timeout(self._handshake_timeout)
+                self._handshake_timeout = None
+
+    def _on_handshake_timeout(self):
+        self._handshake_timeout = None
+        if self._handshake:
+            LOG.warning("Client(%s) no request in %ss, disconnect", self._address, self.admission.handshake_timeout)
+            self.admission.rejected_timeout.inc()
+            self._stream.close()
+
+    def _observe_heartbeat(self):
+        now = IOLoop.current().time()
+        if self._last_heartbeat is not None and (self._lease is not None or "heartbeat_interval" in self.info):
+            # a leased node heartbeats at the granted interval
+            heartbeat_interval = (self._lease or (None, self.info["heartbeat_interval"]))[1]
+            self._metrics.heartbeat_lag.observe(now - self._last_heartbeat - heartbeat_interval)
+        self._last_heartbeat = now
+
+    def _negotiate(self, data):
+        if Framing.binary in data.get("framing", []):
+            self._framing = Framing.binary
+            self._codec = choose_codec(data.get("codecs"))
+            self._compress_threshold = self.compress_threshold
+
+    def _watch(self, params):
+        '''
+        subscribe this connection to registry changes, reply with the events
+        after params["revision"] or with a full snapshot when they are unknown
+        '''
+        self._watch_service = params.get("service")
+        if not self._watching:
+            self.registry.subscribe(self._on_registry_event)
+            self._watching = True
+        send_data = {
+            "command": Command.watch,
+            "data": {
+                "status": Status.success,
+                "message": Status.success,
+                "revision": self.registry.revision,
+                "epoch": self.registry.epoch,
+            },
+            "framing": self._framing,
+            "codec": self._codec.name,
+        }
+        events = None
+        if params.get("revision") is not None and params.get("epoch") == self.registry.epoch:
+            events = self.registry.events_since(params["revision"])
+        if events is None:
+            snapshot = self.registry.snapshot()
+            if self._watch_service is None:
+                nodes = snapshot.nodes.values()
+            else:
+                nodes = snapshot.find_by_service(self._watch_service)
+            send_data["data"]["snapshot"] = [dict(info) for info in nodes]
+        else:
+            send_data["data"]["events"] = []
+            for event in events:
+                event_type = event.match(self._watch_service)
+                if event_type:
+                    send_data["data"]["events"].append(event.to_dict(event_type))
+        LOG.info("Client(%s) watch service: %s, revision: %s", self._address, self._watch_service, params.get("revision"))
+        return send_data
+
+    def _on_registry_event(self, event):
+        event_type = event.match(self._watch_service)
+        if event_type:
+            if event_type not in event.messages:
+                event.messages[event_type] = {
+                    "command": Command.watch,
+                    "data": {
+                        "revision": event.revision,
+                        "events": [event.to_dict(event_type)],
+                    }
+                }
+            frames = event.frames.setdefault(event_type, {})
+            # a lagging watcher is disconnected, it resumes from its last revision
+            self.write_frame(self.encode_frame(event.messages[event_type], frames), Backpressure.disconnect)
+
+    def _unwatch(self):
+        if self._watching:
+            self.registry.unsubscribe(self._on_registry_event)
+            self._watching = False
+
+    def _apply_delta(self, delta, target = None):
+        '''
+        patch self.info (or target.info of a NodeSession) with a delta heartbeat,
+        return (synced, changed), synced is False when the base version doesn't
+        match the stored one and a full resync is needed
+        '''
+        info = self.info if target is None else target.info
+        version = self._version if target is None else target.version
+        base = delta.get("base", delta["version"])
+        if version is None or base != version:
+            return False, False
+        changed = False
+        for key in delta.get("delete", []):
+            if key in info:
+                del info[key]
+                changed = True
+        for key, value in delta.get("update", {}).items():
+            if key == "http_host" and value == "0.0.0.0":
+                value = self._address[0]
+            if key not in info or info[key] != value:
+                info[key] = value
+                changed = True
+        if target is None:
+            self._version = delta["version"]
+        else:
+            target.version = delta["version"]
+        return True, changed
+
+    def _batch(self, data):
+        '''
+        batched REGISTER or HEARTBEAT of several nodes, data["batch"] holds one item
+        per node, the reply holds one result per item in the same order
+        '''
+        if self._sessions is None:
+            self._sessions = {}
+        if data["command"] == Command.register:
+            self._negotiate(data)
+            results = [self._batch_register(item) for item in data["batch"]]
+            self._status = Status.registered
+            return {
+                "command": Command.register,
+                "data": {"status": Status.success, "message": Status.success},
+                "batch": results,
+                "framing": self._framing,
+                "codec": self._codec.name,
+            }
+        results = [self._batch_heartbeat(item) for item in data["batch"]]
+        return {
+            "command": Command.heartbeat,
+            "data": {"status": Status.success, "message": Status.success},
+            "batch": results,
+        }
+
+    def _batch_register(self, item):
+        info = NodeInfo.from_dict(item["data"])
+        if info.get("http_host") == "0.0.0.0":
+            info["http_host"] = self._address[0]
+        if info.get("node_id") is None:
+            info["node_id"] = str(uuid4())
+        node_id = info["node_id"]
+        session = self._sessions.get(node_id)
+        if session is None:
+            session = self._sessions[node_id] = NodeSession(self, info, item.get("version"))
+        else:
+            session.info = info
+            session.version = item.get("version")
+        session.lease = self._grant(info)
+        self.registry.register(node_id, info, session)
+        self._schedule_session(session)
+        result = {"status": Status.success, "node_id": node_id, "version": session.version}
+        if session.lease is not None:
+            result["lease"] = lease_to_dict(session.lease)
+        return result
+
+    def _batch_heartbeat(self, item):
+        node_id = item.get("node_id")
+        session = self._sessions.get(node_id)
+        if session is None:
+            return {"status": Status.failure, "node_id": node_id, "message": "invalid node_id: %s" % node_id}
+        if item.get("delta"):
+            synced, changed = self._apply_delta(item["data"], session)
+        else:
+            info = item["data"]
+            if info.get("http_host") == "0.0.0.0":
+                info["http_host"] = self._address[0]
+            info["node_id"] = node_id
+            if self.prober is not None:
+                self.prober.annotate(node_id, info)
+            changed = session.info != info
+            if changed:
+                session.info = NodeInfo.from_dict(info)
+            session.version = item.get("version")
+            synced = True
+        if not synced:
+            return {"status": Status.resync, "node_id": node_id, "version": session.version}
+        if changed:
+            self.registry.update(node_id, session.info)
+        self._schedule_session(session)
+        return {"status": Status.success, "node_id": node_id}
+
+    def _schedule_session(self, session):
+        ttl, heartbeat_interval = session.lease or (session.info["heartbeat_timeout"], session.info["heartbeat_interval"])
+        self.get_timing_wheel().schedule(session, IOLoop.current().time() + ttl, session.expire)
+        if self.health is not None:
+            self.health.heartbeat(session.info["node_id"], heartbeat_interval)
+
+    def _expire_session(self, session):
+        node_id = session.info["node_id"]
+        self._metrics.timeouts.inc()
+        if self._sessions is not None and self._sessions.get(node_id) is session:
+            del self._sessions[node_id]
+        self.registry.remove(node_id, session)
+        LOG.warning("Client(%s) node_id: %s heartbeat_timeout", self._address, node_id)
+        if not self._sessions and "node_id" not in self.info:
+            # every node of the connection timed out
+            self._stream.close()
+
+    def _drop_sessions(self):
+        if self._sessions:
+            timing_wheel = self.get_timing_wheel()
+            for node_id, session in self._sessions.items():
+                timing_wheel.cancel(session)
+                self.registry.remove(node_id, session)
+            self._sessions = None
+
+    def _teardown(self):
+        '''
+        forget the connection everywhere and close it, shared by every way a connection ends
+        '''
+        self.get_timing_wheel().cancel(self)
         if self in BaseConnection.clients:
             BaseConnection.clients.remove(self)
+        self._drop_sessions()
+        if "node_id" in self.info:
+            self.registry.remove(self.info["node_id"], self)
+        self._unwatch()
+        if self._peer_origin and self.replicator:
+            self.replicator.peer_lost(self._peer_origin)
+            self._peer_origin = None
         self._stream.close()
-        LOG.warning("Client(%s) node_id: %s heartbeat_timeout", self._address, self.info["node_id"])
+
+    def _remove_connection(self):
+        self._metrics.timeouts.inc()
+        self._teardown()
+        LOG.warning("Client(%s) node_id: %s heartbeat_timeout", self._address, self.info.get("node_id"))
 
     def _refuse_connect(self):
-        if self._heartbeat_timeout:
-            IOLoop.instance().remove_timeout(self._heartbeat_timeout)
-        if self in BaseConnection.clients:
-            BaseConnection.clients.remove(self)
-        self._stream.close()
-        LOG.warning("Refuse(%s) node_id: %s connect", self._address, self.info["node_id"])
+        self._teardown()
+        LOG.warning("Refuse(%s) node_id: %s connect", self._address, self.info.get("node_id"))
 
     def _on_close(self):
-        if self._heartbeat_timeout:
-            IOLoop.instance().remove_timeout(self._heartbeat_timeout)
-        if self in BaseConnection.clients:
-            BaseConnection.clients.remove(self)
-        self._stream.close()
+        self._end_handshake()
+        self._teardown()
         LOG.info("Client(%s) closed", self._address)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from tornado.ioloop import IOLoop
+
+from .common import Status, Event
+from .timing_wheel import TimingWheel
+
+LOG = logging.getLogger(__name__)
+
+
+class HealthEvent(object):
+    '''
+    a status transition of service, service is None for the whole cluster
+    '''
+    __slots__ = ("service", "previous", "status", "live", "late", "expected")
+
+    def __init__(self, service, previous, status, live, late, expected):
+        self.service = service
+        self.previous = previous
+        self.status = status
+        self.live = live
+        self.late = late
+        self.expected = expected
+
+    def to_dict(self):
+        return {
+            "service": self.service,
+            "previous": self.previous,
+            "status": self.status,
+            "live": self.live,
+            "late": self.late,
+            "expected": self.expected,
+        }
+
+
+class ServiceHealth(object):
+    __slots__ = ("service", "live", "late", "expected", "quorum", "status")
+
+    def __init__(self, service, expected = None, quorum = None):
+        self.service = service
+        self.live = 0
+        self.late = set() # late node_ids
+        self.expected = expected
+        self.quorum = quorum if quorum is not None else (expected or 1)
+        self.status = Status.red
+
+    def compute(self):
+        if self.live == 0:
+            return Status.red
+        if self.late or self.live < self.quorum:
+            return Status.yellow
+        return Status.green
+
+
+class ClusterHealth(object):
+    '''
+    per-service health maintained incrementally from registry events and
+    heartbeats, reading a status is O(1):
+    RED the service has no live node,
+    YELLOW some nodes are late (no heartbeat for late_factor * heartbeat_interval)
+    or fewer than quorum nodes are live, quorum defaults to expected,
+    GREEN otherwise.
+    expected and quorum are dicts of service: count, services not in expected
+    are tracked while they have nodes. the cluster is RED without nodes or when
+    an expected service is RED, YELLOW when a service is YELLOW.
+    transitions are passed as HealthEvent to the subscribers.
+    '''
+    def __init__(self, registry, expected = None, quorum = None, late_factor = 2, tick = 1.0):
+        self.registry = registry
+        self.late_factor = late_factor
+        self.services = {}
+        self.status = Status.red
+        self._quorum = dict(quorum or {})
+        self._counts = {Status.green: 0, Status.yellow: 0, Status.red: 0}
+        self._subscribers = []
+        self._nodes = {} # node_id: service, of the nodes with a service
+        self._late_callbacks = {} # node_id: callback, created once per node
+        self._timing_wheel = TimingWheel(tick = tick)
+        for service, count in (expected or {}).items():
+            health = ServiceHealth(service, count, self._quorum.get(service))
+            self.services[service] = health
+            self._counts[health.status] += 1
+        for entry in registry:
+            self._add(entry.node_id, entry.service)
+        self._refresh_cluster()
+        registry.subscribe(self._on_registry_event)
+
+    def stop(self):
+        self.registry.unsubscribe(self._on_registry_event)
+        self._timing_wheel.stop()
+
+    def subscribe(self, callback):
+        '''
+        callback(event) is called with every HealthEvent
+        '''
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def service_status(self, service):
+        health = self.services.get(service)
+        return health.status if health is not None else Status.red
+
+    def heartbeat(self, node_id, heartbeat_interval):
+        '''
+        a heartbeat of node_id arrived, it is late if the next one doesn't arrive in time
+        '''
+        callback = self._late_callbacks.get(node_id)
+        if callback is None:
+            callback = self._late_callbacks[node_id] = lambda: self._mark_late(node_id)
+        self._timing_wheel.schedule(
+            node_id, IOLoop.current().time() + heartbeat_interval * self.late_factor, callback
+        )
+        health = self.services.get(self._nodes.get(node_id))
+        if health is not None and node_id in health.late:
+            health.late.discard(node_id)
+            self._refresh(health)
+            self._refresh_cluster()
+
+    def _mark_late(self, node_id):
+        health = self.services.get(self._nodes.get(node_id))
+        if health is not None and node_id not in health.late:
+            health.late.add(node_id)
+            LOG.warning("Node(%s) of service %s is late", node_id, health.service)
+            self._refresh(health)
+            self._refresh_cluster()
+
+    def _on_registry_event(self, event):
+        service = self._nodes.get(event.node_id)
+        if event.type == Event.removed:
+            self._remove(event.node_id, service)
+            self._timing_wheel.cancel(event.node_id)
+            self._late_callbacks.pop(event.node_id, None)
+        elif event.service != service:
+            late = self._remove(event.node_id, service)
+            self._add(event.node_id, event.service, late)
+        self._refresh_cluster()
+
+    def _add(self, node_id, service, late = False):
+        if service is None:
+            return
+        self._nodes[node_id] = service
+        health = self.services.get(service)
+        if health is None:
+            health = ServiceHealth(service, quorum = self._quorum.get(service))
+            self.services[service] = health
+            self._counts[health.status] += 1
+        health.live += 1
+        if late:
+            health.late.add(node_id)
+        self._refresh(health)
+
+    def _remove(self, node_id, service):
+        '''
+        return True if the node was late
+        '''
+        health = self.services.get(service)
+        if health is None:
+            return False
+        del self._nodes[node_id]
+        late = node_id in health.late
+        health.late.discard(node_id)
+        health.live -= 1
+        self._refresh(health)
+        if health.live == 0 and health.expected is None:
+            # an unexpected service is forgotten when its last node leaves
+            self._counts[health.status] -= 1
+            del self.services[service]
+        return late
+
+    def _refresh(self, health):
+        status = health.compute()
+        if status != health.status:
+            previous = health.status
+            self._counts[previous] -= 1
+            self._counts[status] += 1
+            health.status = status
+            self._emit(HealthEvent(health.service, previous, status, health.live, len(health.late), health.expected))
+
+    def _refresh_cluster(self):
+        if len(self.registry) == 0 or self._counts[Status.red] > 0:
+            status = Status.red
+        elif self._counts[Status.yellow] > 0:
+            status = Status.yellow
+        else:
+            status = Status.green
+        if status != self.status:
+            previous = self.status
+            self.status = status
+            self._emit(HealthEvent(None, previous, status, len(self.registry), None, None))
+
+    def _emit(self, event):
+        LOG.info("Health %s: %s -> %s", event.service or "cluster", event.previous, event.status)
+        for callback in list(self._subscribers):
+            try:
+                callback(event)
+            except Exception as e:
+                LOG.exception(e)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import sys
+from collections.abc import MutableMapping
+
+# the well-known registrant fields, stored in slots instead of dict entries
+FIELDS = ("node_id", "http_host", "http_port", "heartbeat_interval", "heartbeat_timeout")
+MISSING = object()
+
+
+class NodeInfo(MutableMapping):
+    '''
+    compact node info: a dict-like mapping storing the FIELDS in slots and the
+    custom keys in an overflow dict created only when needed. custom keys and
+    http_host values are interned, so thousands of nodes share the strings.
+    use dict(info) to get a plain dict, e.g. to encode it.
+    '''
+    __slots__ = FIELDS + ("extra", )
+
+    def __init__(self, data = None):
+        self.node_id = MISSING
+        self.http_host = MISSING
+        self.http_port = MISSING
+        self.heartbeat_interval = MISSING
+        self.heartbeat_timeout = MISSING
+        self.extra = None
+        if data:
+            for key, value in data.items():
+                self[key] = value
+
+    @classmethod
+    def from_dict(cls, data):
+        if isinstance(data, cls):
+            return data
+        return cls(data)
+
+    def __getitem__(self, key):
+        if key in FIELDS:
+            value = getattr(self, key)
+            if value is not MISSING:
+                return value
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in FIELDS:
+            if key == "http_host" and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[sys.intern(key) if isinstance(key, str) else key] = value
+
+    def __delitem__(self, key):
+        if key in FIELDS:
+            if getattr(self, key) is MISSING:
+                raise KeyError(key)
+            setattr(self, key, MISSING)
+        elif self.extra is not None and key in self.extra:
+            del self.extra[key]
+            if not self.extra:
+                self.extra = None
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in FIELDS:
+            return getattr(self, key) is not MISSING
+        return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        for key in FIELDS:
+            if getattr(self, key) is not MISSING:
+                yield key
+        if self.extra is not None:
+            for key in self.extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in FIELDS if getattr(self, key) is not MISSING) + (len(self.extra) if self.extra else 0)
+
+    def __eq__(self, other):
+        if isinstance(other, NodeInfo):
+            return all(getattr(self, key) == getattr(other, key) for key in FIELDS) and (self.extra or {}) == (other.extra or {})
+        if isinstance(other, dict):
+            return len(self) == len(other) and all(key in other and other[key] == value for key, value in self.items())
+        return MutableMapping.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "NodeInfo(%r)" % dict(self)
+
+    def copy(self):
+        info = NodeInfo()
+        for key in FIELDS:
+            setattr(info, key, getattr(self, key))
+        if self.extra is not None:
+            info.extra = dict(self.extra)
+        return info
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+class LeasePolicy(object):
+    '''
+    leases granted by the listener: a node is removed ttl seconds after its last
+    REGISTER or HEARTBEAT, whatever heartbeat_timeout it sent, and it is told to
+    heartbeat at least renewals times per ttl.
+    with ttl None the requested heartbeat_timeout is granted, clamped to [min_ttl, max_ttl],
+    one of them is needed for nodes registering without heartbeat_timeout
+    '''
+    def __init__(self, ttl = None, min_ttl = None, max_ttl = None, renewals = 3):
+        if ttl is None and min_ttl is None and max_ttl is None:
+            raise ValueError("a lease needs ttl, min_ttl or max_ttl")
+        self.ttl = ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.renewals = renewals
+
+    def grant(self, info):
+        '''
+        return (ttl, heartbeat_interval) of the node with info
+        '''
+        ttl = self.ttl
+        if ttl is None:
+            ttl = info.get("heartbeat_timeout") or self.max_ttl or self.min_ttl
+            if self.min_ttl is not None:
+                ttl = max(ttl, self.min_ttl)
+            if self.max_ttl is not None:
+                ttl = min(ttl, self.max_ttl)
+        heartbeat_interval = ttl / float(self.renewals)
+        if info.get("heartbeat_interval"):
+            heartbeat_interval = min(heartbeat_interval, info["heartbeat_interval"])
+        return ttl, heartbeat_interval
+
+
+def lease_to_dict(lease):
+    ttl, heartbeat_interval = lease
+    return {"ttl": ttl, "heartbeat_interval": heartbeat_interval}
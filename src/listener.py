@@ -1,9 +1,29 @@
 # -*- coding: utf-8 -*-
 
+import os
 import logging
+import tempfile
 
+import tornado.web
+import tornado.netutil
+import tornado.process
+import tornado.iostream
 import tornado.tcpserver
 
+from .common import ProbeMode
+
+from .admission import AdmissionControl
+from .api import RegistryCache, api_handlers
+from .health import ClusterHealth
+from .lease import LeasePolicy
+from .metrics import MetricsHandler
+from .multiprocess import Coordinator, WorkerLink
+from .persistence import RegistryStore
+from .probe import Prober
+from .udp import HeartbeatReceiver
+from .replication import Replicator
+from .tls import server_context
+
 LOG = logging.getLogger(__name__)
 
 
@@ -11,8 +31,160 @@ class BaseListener(tornado.tcpserver.TCPServer):
     def __init__(self, connection_cls, ssl_options = None, **kwargs):
         LOG.info("DiscoveryListener start")
         self.connection_cls = connection_cls
-        tornado.tcpserver.TCPServer.__init__(self, ssl_options = ssl_options, **kwargs)
+        self.coordinator = None
+        self.worker_link = None
+        self.replicator = None
+        self.store = None
+        self.health = None
+        self.admission = None
+        self.lease_policy = None
+        self.cache = None
+        self.prober = None
+        self.udp = None
+        tornado.tcpserver.TCPServer.__init__(self, ssl_options = server_context(ssl_options), **kwargs)
 
     def handle_stream(self, stream, address):
         LOG.debug("Incoming connection from %r", address)
+        if self.admission is not None and not self.admission.start_handshake():
+            LOG.debug("Refuse connection from %r: %s handshakes in progress", address, self.admission.handshakes)
+            stream.close()
+            return
+        if isinstance(stream, tornado.iostream.SSLIOStream):
+            stream.wait_for_handshake().add_done_callback(lambda future: self._on_tls_handshake(stream, future))
         self.connection_cls(stream, address)
+
+    def _on_tls_handshake(self, stream, future):
+        tls_handshakes = self.connection_cls.get_instruments().tls_handshakes
+        if future.exception() is not None:
+            tls_handshakes["failed"].inc()
+        elif stream.socket is not None and stream.socket.session_reused:
+            tls_handshakes["resumed"].inc()
+        else:
+            tls_handshakes["full"].inc()
+
+    def enable_admission_control(self, rate = None, burst = None, max_handshakes = None, retry_after = 1.0,
+                                 handshake_timeout = 10.0):
+        '''
+        limit new registrations to rate per second and the connections waiting for
+        their first reply to max_handshakes for at most handshake_timeout seconds,
+        see AdmissionControl
+        '''
+        self.admission = AdmissionControl(
+            rate = rate, burst = burst, max_handshakes = max_handshakes, retry_after = retry_after,
+            handshake_timeout = handshake_timeout, metrics = self.connection_cls.metrics
+        )
+        self.connection_cls.admission = self.admission
+        return self.admission
+
+    def enable_replication(self, peers, **kwargs):
+        '''
+        replicate connection_cls.registry with the peer listeners [(host, port), ...],
+        kwargs are passed to Replicator, call it after the IOLoop is created
+        '''
+        self.replicator = Replicator(self.connection_cls.registry, peers, **kwargs)
+        self.connection_cls.replicator = self.replicator
+        self.replicator.start()
+        return self.replicator
+
+    def enable_leases(self, ttl = None, min_ttl = None, max_ttl = None, renewals = 3):
+        '''
+        grant leases to registering nodes instead of trusting their heartbeat_timeout,
+        see LeasePolicy, registrants heartbeat at the granted heartbeat_interval.
+        ttl, min_ttl or max_ttl is required
+        '''
+        self.lease_policy = LeasePolicy(ttl = ttl, min_ttl = min_ttl, max_ttl = max_ttl, renewals = renewals)
+        self.connection_cls.lease_policy = self.lease_policy
+        return self.lease_policy
+
+    def enable_health(self, expected = None, quorum = None, **kwargs):
+        '''
+        maintain per-service health of connection_cls.registry, expected and quorum
+        are dicts of service: count, kwargs are passed to ClusterHealth
+        '''
+        self.health = ClusterHealth(self.connection_cls.registry, expected = expected, quorum = quorum, **kwargs)
+        self.connection_cls.health = self.health
+        return self.health
+
+    def enable_probing(self, mode = ProbeMode.tcp, path = "/", interval = 10, timeout = 2, concurrency = 100, **kwargs):
+        '''
+        probe the http_host:http_port of the nodes connected to this listener with
+        a TCP connect or an HTTP GET of path, their probed GREEN/YELLOW/RED is in
+        their info as "status", kwargs are passed to Prober, call it after the IOLoop is created
+        '''
+        kwargs.setdefault("metrics", self.connection_cls.metrics)
+        self.prober = Prober(
+            self.connection_cls.registry, mode = mode, path = path, interval = interval,
+            timeout = timeout, concurrency = concurrency, **kwargs
+        )
+        self.connection_cls.prober = self.prober
+        self.prober.start()
+        return self.prober
+
+    def enable_persistence(self, path, **kwargs):
+        '''
+        restore connection_cls.registry from directory path and keep it persisted there,
+        kwargs are passed to RegistryStore, call it after the IOLoop is created
+        '''
+        kwargs.setdefault("timing_wheel", self.connection_cls.get_timing_wheel())
+        self.store = RegistryStore(self.connection_cls.registry, path, **kwargs)
+        self.store.restore()
+        self.store.start()
+        return self.store
+
+    def listen_metrics(self, port, address = "", path = r"/metrics"):
+        '''
+        serve connection_cls.metrics in the Prometheus text format over http on port
+        '''
+        application = tornado.web.Application([(path, MetricsHandler, {"metrics": self.connection_cls.metrics})])
+        return application.listen(port, address = address)
+
+    def listen_http(self, port, address = "", prefix = ""):
+        '''
+        serve connection_cls.registry as JSON over http on port, see api_handlers,
+        one RegistryCache is shared by every reader
+        '''
+        if self.cache is None:
+            self.cache = RegistryCache(self.connection_cls.registry)
+        application = tornado.web.Application(api_handlers(self.cache, prefix = prefix))
+        return application.listen(port, address = address)
+
+    def listen_udp(self, port, address = "", secret = None, **kwargs):
+        '''
+        receive the liveness heartbeats of registrants created with udp_heartbeat
+        on UDP port, their registration and info changes stay on TCP, kwargs are
+        passed to HeartbeatReceiver, call it after the IOLoop is created
+        '''
+        kwargs.setdefault("metrics", self.connection_cls.metrics)
+        self.udp = HeartbeatReceiver(self.connection_cls.registry, port, address = address, secret = secret, **kwargs)
+        self.connection_cls.udp = self.udp
+        self.udp.start()
+        return self.udp
+
+    def listen_multiprocess(self, port, address = None, num_processes = None,
+                            max_restarts = None, reuse_port = False, unix_socket_path = None):
+        '''
+        fork num_processes workers (cpu count if None) sharing the listening socket,
+        plus a coordinator process (task id 0) merging the workers' registries,
+        so every worker's connection_cls.registry holds the whole fleet.
+        call it before any IOLoop is created and start the IOLoop after it,
+        return the task id of the current process.
+        '''
+        sockets = tornado.netutil.bind_sockets(port, address = address, reuse_port = reuse_port)
+        if unix_socket_path is None:
+            unix_socket_path = os.path.join(tempfile.mkdtemp(prefix = "tornado_discovery_"), "coordinator.sock")
+        unix_socket = tornado.netutil.bind_unix_socket(unix_socket_path)
+        if not num_processes or num_processes <= 0:
+            num_processes = tornado.process.cpu_count()
+        task_id = tornado.process.fork_processes(num_processes + 1, max_restarts)
+        if task_id == 0:
+            for sock in sockets:
+                sock.close()
+            self.coordinator = Coordinator(unix_socket)
+            self.coordinator.start()
+        else:
+            unix_socket.close()
+            self.add_sockets(sockets)
+            self.worker_link = WorkerLink(unix_socket_path, self.connection_cls.registry)
+            self.worker_link.start()
+            LOG.info("DiscoveryListener worker %s start", task_id)
+        return task_id
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import logging
+
+import tornado.web
+
+LOG = logging.getLogger(__name__)
+
+# seconds
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+LAG_BUCKETS = (-0.5, -0.1, 0.0, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    __slots__ = ("name", "labels", "value")
+    kind = "counter"
+
+    def __init__(self, name, labels = ()):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Gauge(Counter):
+    __slots__ = ()
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount = 1):
+        self.value -= amount
+
+
+class Histogram(object):
+    '''
+    fixed buckets, the bucket counts are preallocated, observe is a bisect and two adds.
+    sample() returns True for one in sample_every calls, to time only those
+    '''
+    __slots__ = ("name", "labels", "buckets", "counts", "sum", "count", "sample_every", "_skipped")
+    kind = "histogram"
+
+    def __init__(self, name, labels = (), buckets = LATENCY_BUCKETS, sample_every = 1):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.sample_every = sample_every
+        self._skipped = 0
+
+    def sample(self):
+        self._skipped += 1
+        if self._skipped >= self.sample_every:
+            self._skipped = 0
+            return True
+        return False
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"), ), self.counts):
+            cumulative += count
+            yield self.name + "_bucket", self.labels + (("le", format_value(bound)), ), cumulative
+        yield self.name + "_sum", self.labels, self.sum
+        yield self.name + "_count", self.labels, self.count
+
+
+class Metrics(object):
+    '''
+    named metrics, rendered in the Prometheus text format. metric objects are
+    created once and kept by the instrumented code, updating them costs an
+    attribute add. sample_every is the default sampling of timing histograms,
+    collectors are called before rendering to refresh gauges.
+    '''
+    def __init__(self, sample_every = 16):
+        self.sample_every = sample_every
+        self._metrics = {} # (name, labels): metric
+        self._help = {} # name: (kind, help)
+        self._collectors = []
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        labels = tuple(sorted(labels.items())) if labels else ()
+        key = (name, labels)
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = cls(name, labels, **kwargs)
+            self._metrics[key] = metric
+            self._help.setdefault(name, (cls.kind, help))
+        return metric
+
+    def counter(self, name, help = "", labels = None):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help = "", labels = None):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help = "", labels = None, buckets = LATENCY_BUCKETS, sample_every = 1):
+        return self._get(Histogram, name, help, labels, buckets = buckets, sample_every = sample_every)
+
+    def add_collector(self, callback):
+        '''
+        callback(metrics) is called before every render
+        '''
+        if callback not in self._collectors:
+            self._collectors.append(callback)
+
+    def remove_collector(self, callback):
+        if callback in self._collectors:
+            self._collectors.remove(callback)
+
+    def render(self):
+        for callback in list(self._collectors):
+            try:
+                callback(self)
+            except Exception as e:
+                LOG.exception(e)
+        lines = []
+        names = {}
+        for (name, _), metric in self._metrics.items():
+            names.setdefault(name, []).append(metric)
+        for name in sorted(names):
+            kind, help = self._help[name]
+            if help:
+                lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for metric in names[name]:
+                for sample_name, labels, value in metric.samples():
+                    lines.append("%s%s %s" % (sample_name, format_labels(labels), format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    '''
+    serve metrics in the Prometheus text format:
+    tornado.web.Application([(r"/metrics", MetricsHandler, {"metrics": METRICS})])
+    '''
+    def initialize(self, metrics = METRICS):
+        self.metrics = metrics
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(self.metrics.render())
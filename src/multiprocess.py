@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import logging
+
+import tornado.iostream
+import tornado.netutil
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+
+from .common import Command, Event
+from .protocol import Framing, FrameError, new_header_buffer, pack_frame, read_frame
+from .codec import CODECS, CompactCodec, encode_payload, decode_payload
+from .registry import Registry
+
+LOG = logging.getLogger(__name__)
+
+
+class SyncStream(object):
+    '''
+    binary framed, COMPACT encoded SYNC messages between a worker and the coordinator
+    '''
+    codec = CODECS[CompactCodec.name]
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._header_buffer = new_header_buffer()
+
+    @classmethod
+    def encode(cls, data):
+        payload, flags = encode_payload(data, cls.codec)
+        return pack_frame(payload, Framing.binary, flags)
+
+    def write(self, frame):
+        try:
+            self.stream.write(frame)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+    def send(self, data):
+        self.write(self.encode(data))
+
+    @gen.coroutine
+    def read(self):
+        payload, flags = yield read_frame(self.stream, self._header_buffer)
+        if payload is None:
+            raise FrameError("checksum mismatch")
+        raise gen.Return(decode_payload(payload, flags))
+
+
+def entry_event(entry, event_type = Event.added):
+    return {"type": event_type, "node_id": entry.node_id, "info": dict(entry.info)}
+
+
+class Coordinator(object):
+    '''
+    merge the registries of all workers into one view, every change reported
+    by a worker is applied to the coordinator's registry and fanned out to all
+    workers. a node is owned by the worker that reported it last, only that
+    worker can remove it.
+    '''
+    def __init__(self, unix_socket):
+        self.registry = Registry()
+        self._socket = unix_socket
+        self._workers = set()
+        self._outgoing = []
+        self.registry.subscribe(self._on_registry_event)
+
+    def start(self):
+        tornado.netutil.add_accept_handler(self._socket, self._on_accept)
+        LOG.info("Coordinator start")
+
+    def _on_accept(self, connection, address):
+        IOLoop.current().add_callback(self._serve, SyncStream(IOStream(connection)))
+
+    @gen.coroutine
+    def _serve(self, worker):
+        self._workers.add(worker)
+        LOG.info("Coordinator worker connected, workers: %s", len(self._workers))
+        worker.send({
+            "command": Command.sync,
+            "data": {"reset": True, "events": [entry_event(entry) for entry in self.registry]},
+        })
+        try:
+            while True:
+                data = yield worker.read()
+                if data.get("command") == Command.sync:
+                    self._apply(worker, data["data"])
+                else:
+                    LOG.warning("Coordinator received wrong message: %s", data)
+        except tornado.iostream.StreamClosedError:
+            pass
+        except Exception as e:
+            LOG.exception(e)
+        self._workers.discard(worker)
+        worker.stream.close()
+        for entry in self.registry:
+            if entry.connection is worker:
+                self.registry.remove(entry.node_id, worker)
+        LOG.info("Coordinator worker closed, workers: %s", len(self._workers))
+
+    def _apply(self, worker, data):
+        if data.get("reset"):
+            node_ids = set(event["node_id"] for event in data["events"])
+            for entry in self.registry:
+                if entry.connection is worker and entry.node_id not in node_ids:
+                    self.registry.remove(entry.node_id, worker)
+        for event in data["events"]:
+            if event["type"] == Event.removed:
+                if self.registry.remove(event["node_id"], worker) is None:
+                    entry = self.registry.get(event["node_id"])
+                    if entry is not None:
+                        # the node moved to another worker, restore it on the sender
+                        worker.send({"command": Command.sync, "data": {"events": [entry_event(entry)]}})
+            else:
+                self.registry.register(event["node_id"], event["info"], worker)
+
+    def _on_registry_event(self, event):
+        if not self._outgoing:
+            IOLoop.current().add_callback(self._flush)
+        self._outgoing.append(event.to_dict())
+
+    def _flush(self):
+        events, self._outgoing = self._outgoing, []
+        if events:
+            frame = SyncStream.encode({"command": Command.sync, "data": {"events": events}})
+            for worker in list(self._workers):
+                worker.write(frame)
+
+
+class WorkerLink(object):
+    '''
+    forward the changes of the nodes connected to this worker to the coordinator
+    and apply the changes of the other workers' nodes to the local registry,
+    remote nodes are registered without connection
+    '''
+    def __init__(self, path, registry, retry_interval = 1):
+        self.path = path
+        self.registry = registry
+        self.retry_interval = retry_interval
+        self._sync = None
+        self._outgoing = []
+
+    def start(self):
+        self.registry.subscribe(self._on_registry_event)
+        IOLoop.current().add_callback(self.connect)
+
+    @gen.coroutine
+    def connect(self):
+        try:
+            stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            yield stream.connect(self.path)
+        except Exception as e:
+            LOG.warning("Connect to Coordinator failed: %s, Retry %s seconds later ...", e, self.retry_interval)
+            IOLoop.current().call_later(self.retry_interval, self.connect)
+            return
+        sync = SyncStream(stream)
+        self._outgoing = []
+        sync.send({
+            "command": Command.sync,
+            "data": {
+                "reset": True,
+                "events": [entry_event(entry) for entry in self.registry if entry.connection is not None],
+            },
+        })
+        self._sync = sync
+        try:
+            while True:
+                data = yield sync.read()
+                if data.get("command") == Command.sync:
+                    self._apply(data["data"])
+                else:
+                    LOG.warning("Worker received wrong message: %s", data)
+        except tornado.iostream.StreamClosedError:
+            pass
+        except Exception as e:
+            LOG.exception(e)
+        self._sync = None
+        stream.close()
+        LOG.warning("Coordinator closed, Reconnect %s seconds later ...", self.retry_interval)
+        IOLoop.current().call_later(self.retry_interval, self.connect)
+
+    def _apply(self, data):
+        if data.get("reset"):
+            node_ids = set(event["node_id"] for event in data["events"])
+            for entry in self.registry:
+                if entry.connection is None and entry.node_id not in node_ids:
+                    self.registry.remove(entry.node_id)
+        for event in data["events"]:
+            entry = self.registry.get(event["node_id"])
+            if entry is not None and entry.connection is not None:
+                continue # connected here, this worker is the source of truth
+            if event["type"] == Event.removed:
+                if entry is not None:
+                    self.registry.remove(event["node_id"])
+            else:
+                self.registry.register(event["node_id"], event["info"])
+
+    def _on_registry_event(self, event):
+        if event.local and self._sync is not None:
+            if not self._outgoing:
+                IOLoop.current().add_callback(self._flush)
+            self._outgoing.append({"type": event.type, "node_id": event.node_id, "info": dict(event.info)})
+
+    def _flush(self):
+        events, self._outgoing = self._outgoing, []
+        if events and self._sync is not None:
+            self._sync.send({"command": Command.sync, "data": {"events": events}})
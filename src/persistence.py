@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import logging
+import binascii
+
+import tornado.ioloop
+from tornado.ioloop import IOLoop
+
+from .common import Event
+from .protocol import Framing, HEADER, MAGIC, VERSION, pack_frame
+from .codec import CODECS, JsonCodec, encode_payload, decode_payload
+from .timing_wheel import TimingWheel
+
+LOG = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = "registry.snapshot"
+LOG_FILE = "registry.wal"
+
+
+def encode_record(data, codec = JsonCodec.name):
+    payload, flags = encode_payload(data, CODECS[codec])
+    return pack_frame(payload, Framing.binary, flags)
+
+
+def iter_records(buffer):
+    '''
+    decode the binary frames in buffer (bytes or mmap), stop at the first
+    truncated or corrupted frame, a torn write at the end of the log
+    '''
+    offset = 0
+    size = len(buffer)
+    while offset + HEADER.size <= size:
+        magic, version, flags, length, crc = HEADER.unpack_from(buffer, offset)
+        end = offset + HEADER.size + length
+        if magic != MAGIC or version != VERSION or end > size:
+            LOG.warning("Truncated record at offset %s", offset)
+            return
+        payload = buffer[offset + HEADER.size:end]
+        if binascii.crc32(payload) & 0xffffffff != crc:
+            LOG.warning("Corrupted record at offset %s", offset)
+            return
+        yield decode_payload(payload, flags)
+        offset = end
+
+
+def read_records(path):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return []
+    with open(path, "rb") as fp:
+        buffer = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            return list(iter_records(buffer))
+        finally:
+            buffer.close()
+
+
+class RegistryStore(object):
+    '''
+    persist the nodes connected to this process in directory path: every change
+    is appended to a write-ahead log, compacted into a snapshot every
+    snapshot_interval seconds or when the log grows over max_log_size bytes.
+    restore() loads them back at startup, restored nodes are registered without
+    connection and kept for grace seconds, until they reconnect.
+    records are binary frames of codec, JSON decodes faster, COMPACT is smaller.
+    the directory must not be shared between processes.
+    '''
+    def __init__(self, registry, path, snapshot_interval = 60, max_log_size = 64 * 1024 * 1024,
+                 grace = 30, fsync = False, timing_wheel = None, codec = JsonCodec.name):
+        self.registry = registry
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.max_log_size = max_log_size
+        self.grace = grace
+        self.fsync = fsync
+        self.codec = codec
+        self.timing_wheel = timing_wheel or TimingWheel.instance()
+        self.snapshot_path = os.path.join(path, SNAPSHOT_FILE)
+        self.log_path = os.path.join(path, LOG_FILE)
+        self.periodic_snapshot = None
+        self._log = None
+        self._log_size = 0
+        self._outgoing = []
+        self._leases = set() # restored node_ids waiting for their node to reconnect
+
+    def restore(self):
+        '''
+        register the persisted nodes, call it before start, return the number of nodes
+        '''
+        nodes = {}
+        for record in read_records(self.snapshot_path):
+            nodes[record["node_id"]] = record["info"]
+        for record in read_records(self.log_path):
+            if record["type"] == Event.removed:
+                nodes.pop(record["node_id"], None)
+            else:
+                nodes[record["node_id"]] = record["info"]
+        for node_id, info in nodes.items():
+            if node_id not in self.registry:
+                self.registry.register(node_id, info)
+                self._leases.add(node_id)
+        if self._leases:
+            # all the leases end together, one timer for them
+            self.timing_wheel.schedule(self, IOLoop.current().time() + self.grace, self._expire_leases)
+        LOG.info("Restored %s nodes from %s", len(self._leases), self.path)
+        return len(self._leases)
+
+    def start(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.snapshot()
+        self.registry.subscribe(self._on_registry_event)
+        self.periodic_snapshot = tornado.ioloop.PeriodicCallback(self.snapshot, self.snapshot_interval * 1000)
+        self.periodic_snapshot.start()
+
+    def stop(self):
+        self.registry.unsubscribe(self._on_registry_event)
+        if self.periodic_snapshot:
+            self.periodic_snapshot.stop()
+        self._flush()
+        if self._log:
+            self._log.close()
+            self._log = None
+
+    def persisted_entries(self):
+        return [entry for entry in self.registry if entry.connection is not None or entry.node_id in self._leases]
+
+    def snapshot(self):
+        '''
+        write the persisted nodes to a new snapshot and start an empty log
+        '''
+        self._flush()
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as fp:
+            for entry in self.persisted_entries():
+                fp.write(encode_record({"node_id": entry.node_id, "info": dict(entry.info)}, self.codec))
+            fp.flush()
+            if self.fsync:
+                os.fsync(fp.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        if self._log:
+            self._log.close()
+        self._log = open(self.log_path, "wb")
+        self._log_size = 0
+        LOG.debug("Registry snapshot written: %s", self.snapshot_path)
+
+    def _on_registry_event(self, event):
+        leased = event.node_id in self._leases
+        if not event.local and not leased:
+            return # a node connected to another process
+        if leased and (event.local or event.type == Event.removed):
+            self._leases.discard(event.node_id) # reconnected or gone
+        if not self._outgoing:
+            IOLoop.current().add_callback(self._flush)
+        record = {"type": event.type, "node_id": event.node_id}
+        if event.type != Event.removed:
+            record["info"] = dict(event.info)
+        self._outgoing.append(encode_record(record, self.codec))
+
+    def _flush(self):
+        records, self._outgoing = self._outgoing, []
+        if records and self._log:
+            data = b"".join(records)
+            self._log.write(data)
+            self._log.flush()
+            if self.fsync:
+                os.fsync(self._log.fileno())
+            self._log_size += len(data)
+            if self._log_size > self.max_log_size:
+                self.snapshot()
+
+    def _expire_leases(self):
+        expired = 0
+        for node_id in list(self._leases):
+            entry = self.registry.get(node_id)
+            if entry is not None and entry.connection is None:
+                self.registry.remove(node_id)
+                expired += 1
+        self._leases.clear()
+        LOG.info("Restored nodes lease expired, removed %s nodes", expired)
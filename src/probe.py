@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+import random
+import logging
+from collections import deque
+
+import tornado.iostream
+import tornado.tcpclient
+from tornado import gen
+from tornado.httputil import HTTPHeaders, parse_response_start_line
+from tornado.ioloop import IOLoop
+
+from .common import Status, Event, ProbeMode
+from .metrics import METRICS
+from .timing_wheel import TimingWheel
+
+LOG = logging.getLogger(__name__)
+
+MAX_HEADER = 64 * 1024 # bytes
+MAX_BODY = 64 * 1024 # bytes, a larger body isn't read and its connection isn't reused
+
+
+class ConnectionPool(object):
+    '''
+    keep-alive streams shared by the probes, at most max_idle idle streams per
+    (host, port), an idle stream older than max_idle_time seconds is closed
+    instead of reused
+    '''
+    def __init__(self, max_idle = 1, max_idle_time = 30, tcpclient = None):
+        self.max_idle = max_idle
+        self.max_idle_time = max_idle_time
+        self.tcpclient = tcpclient or tornado.tcpclient.TCPClient()
+        self._idle = {} # (host, port): deque([(stream, released_at), ...])
+
+    def __len__(self):
+        return sum(len(streams) for streams in self._idle.values())
+
+    @gen.coroutine
+    def acquire(self, host, port, timeout = None):
+        '''
+        return (stream, reused), an idle stream of (host, port) or a new one
+        '''
+        streams = self._idle.get((host, port))
+        now = IOLoop.current().time()
+        while streams:
+            stream, released_at = streams.pop()
+            if not streams:
+                del self._idle[(host, port)]
+            if not stream.closed() and now - released_at < self.max_idle_time:
+                raise gen.Return((stream, True))
+            stream.close()
+        stream = yield self.tcpclient.connect(host, port, timeout = timeout)
+        raise gen.Return((stream, False))
+
+    def release(self, host, port, stream):
+        if stream.closed():
+            return
+        streams = self._idle.setdefault((host, port), deque())
+        if len(streams) >= self.max_idle:
+            stream.close()
+            return
+        streams.append((stream, IOLoop.current().time()))
+
+    def discard(self, host, port):
+        '''
+        close the idle streams of (host, port)
+        '''
+        for stream, _ in self._idle.pop((host, port), ()):
+            stream.close()
+
+    def close(self):
+        for key in list(self._idle.keys()):
+            self.discard(*key)
+
+
+class ProbeState(object):
+    __slots__ = ("node_id", "address", "failures", "status", "deadline", "queued", "callback")
+
+    def __init__(self, node_id, address):
+        self.node_id = node_id
+        self.address = address
+        self.failures = 0 # consecutive failed probes
+        self.status = None # unknown until the first probe
+        self.deadline = None
+        self.queued = False # waiting for a probe slot or being probed
+        self.callback = None
+
+
+class Prober(object):
+    '''
+    active health probes of the local nodes' http_host:http_port, a TCP connect
+    or an HTTP GET of path answered with a 2xx or 3xx status.
+    every node is probed every interval seconds from a random phase, so the probes
+    are spread over the interval, and at most concurrency probes are in flight,
+    the due nodes wait in a queue. HTTP probes reuse keep-alive connections from
+    the shared ConnectionPool.
+    a node is GREEN while its probes succeed, YELLOW after a failed probe and RED
+    after failures consecutive ones, the status is set in its info as "status".
+    nodes replicated from peers are probed by their own listener.
+    '''
+    def __init__(self, registry, mode = ProbeMode.tcp, path = "/", interval = 10, timeout = 2,
+                 concurrency = 100, failures = 3, pool = None, tick = 0.1, metrics = METRICS):
+        self.registry = registry
+        self.mode = mode
+        self.path = path
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.failures = failures
+        self.pool = pool or ConnectionPool()
+        self._nodes = {} # node_id: ProbeState
+        self._queue = deque()
+        self._active = 0
+        self._started = False
+        self._timing_wheel = TimingWheel(tick = tick)
+        self._results = dict(
+            (result, metrics.counter("discovery_listener_probes_total", "active health probes", {"result": result}))
+            for result in ("success", "failure", "timeout")
+        )
+        self._reused = metrics.counter("discovery_listener_probe_connections_reused_total", "probes on a pooled connection")
+        self._time = metrics.histogram("discovery_listener_probe_seconds", "probe duration", buckets = (
+            0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+        ))
+        self._in_flight = metrics.gauge("discovery_listener_probes_in_flight", "probes in progress")
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        for entry in self.registry:
+            if entry.connection is not None:
+                self._add(entry.node_id, entry.address)
+        self.registry.subscribe(self._on_registry_event)
+
+    def stop(self):
+        self._started = False
+        self.registry.unsubscribe(self._on_registry_event)
+        self._timing_wheel.stop()
+        self._nodes.clear()
+        self._queue.clear()
+        self.pool.close()
+
+    def status(self, node_id):
+        '''
+        GREEN/YELLOW/RED of node_id, None before its first probe
+        '''
+        state = self._nodes.get(node_id)
+        return state.status if state is not None else None
+
+    def annotate(self, node_id, info):
+        '''
+        keep the probed status in info replacing the node's info, e.g. on a full heartbeat
+        '''
+        state = self._nodes.get(node_id)
+        if state is not None and state.status is not None:
+            info["status"] = state.status
+
+    def _add(self, node_id, address):
+        state = ProbeState(node_id, address)
+        state.callback = lambda: self._due(state)
+        self._nodes[node_id] = state
+        state.deadline = IOLoop.current().time() + random.uniform(0, self.interval)
+        self._timing_wheel.schedule(node_id, state.deadline, state.callback)
+
+    def _on_registry_event(self, event):
+        if event.type == Event.removed:
+            state = self._nodes.pop(event.node_id, None)
+            if state is not None:
+                self._timing_wheel.cancel(event.node_id)
+            return
+        entry = self.registry.get(event.node_id)
+        if entry is None or entry.connection is None:
+            return
+        state = self._nodes.get(event.node_id)
+        if state is None:
+            self._add(entry.node_id, entry.address)
+        elif state.address != entry.address:
+            state.address = entry.address
+            state.failures = 0
+
+    def _due(self, state):
+        if self._nodes.get(state.node_id) is not state:
+            return
+        # keep the phase, unless the loop fell behind by a whole interval
+        now = IOLoop.current().time()
+        state.deadline = max(state.deadline + self.interval, now)
+        self._timing_wheel.schedule(state.node_id, state.deadline, state.callback)
+        if not state.queued:
+            state.queued = True
+            self._queue.append(state)
+            self._pump()
+
+    def _pump(self):
+        while self._queue and self._active < self.concurrency:
+            state = self._queue.popleft()
+            if self._nodes.get(state.node_id) is not state:
+                continue
+            self._active += 1
+            self._in_flight.set(self._active)
+            IOLoop.current().add_future(self._probe(state), lambda future: self._probed())
+
+    def _probed(self):
+        self._active -= 1
+        self._in_flight.set(self._active)
+        self._pump()
+
+    @gen.coroutine
+    def _probe(self, state):
+        host, port = state.address
+        start = IOLoop.current().time()
+        result = "failure"
+        try:
+            if host is None or port is None:
+                LOG.debug("Probe Node(%s): no http address", state.node_id)
+            elif self.mode == ProbeMode.http:
+                ok = yield self._probe_http(host, port, start + self.timeout)
+                result = "success" if ok else "failure"
+            else:
+                stream = yield self.pool.tcpclient.connect(host, port, timeout = self.timeout)
+                stream.close()
+                result = "success"
+        except gen.TimeoutError:
+            result = "timeout"
+        except Exception as e:
+            LOG.debug("Probe Node(%s) %s:%s failed: %s", state.node_id, host, port, e)
+        self._time.observe(IOLoop.current().time() - start)
+        self._results[result].inc()
+        state.queued = False
+        if self._nodes.get(state.node_id) is state:
+            self._update(state, result == "success")
+
+    @gen.coroutine
+    def _probe_http(self, host, port, deadline):
+        stream, reused = yield self.pool.acquire(host, port, timeout = max(deadline - IOLoop.current().time(), 0))
+        try:
+            code, keep_alive = yield self._get(stream, host, port, deadline)
+        except tornado.iostream.StreamClosedError:
+            if not reused:
+                raise
+            # the endpoint closed the idle connection meanwhile, retry on a new one
+            stream, reused = yield self.pool.acquire(host, port, timeout = max(deadline - IOLoop.current().time(), 0))
+            code, keep_alive = yield self._get(stream, host, port, deadline)
+        if reused:
+            self._reused.inc()
+        if keep_alive:
+            self.pool.release(host, port, stream)
+        else:
+            stream.close()
+        raise gen.Return(200 <= code < 400)
+
+    @gen.coroutine
+    def _get(self, stream, host, port, deadline):
+        '''
+        GET path on stream before deadline, return (status code, keep_alive),
+        the stream is closed on failure
+        '''
+        try:
+            result = yield gen.with_timeout(
+                deadline, self._request(stream, host, port), quiet_exceptions = tornado.iostream.StreamClosedError
+            )
+        except Exception:
+            stream.close()
+            raise
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def _request(self, stream, host, port):
+        stream.write((
+            "GET %s HTTP/1.1\r\nHost: %s:%s\r\nUser-Agent: tornado_discovery\r\n\r\n" % (self.path, host, port)
+        ).encode("latin1"))
+        header = yield stream.read_until(b"\r\n\r\n", max_bytes = MAX_HEADER)
+        lines = header.decode("latin1").split("\r\n", 1)
+        start_line = parse_response_start_line(lines[0])
+        headers = HTTPHeaders.parse(lines[1] if len(lines) > 1 else "")
+        keep_alive = start_line.version == "HTTP/1.1" and headers.get("Connection", "").lower() != "close"
+        length = headers.get("Content-Length")
+        if length is None or "Transfer-Encoding" in headers or int(length) > MAX_BODY:
+            # the end of the body isn't known without reading it all, don't reuse the connection
+            keep_alive = False
+        elif int(length) > 0:
+            yield stream.read_bytes(int(length))
+        raise gen.Return((start_line.code, keep_alive))
+
+    def _update(self, state, success):
+        if success:
+            state.failures = 0
+            status = Status.green
+        else:
+            state.failures += 1
+            status = Status.red if state.failures >= self.failures else Status.yellow
+        if status == state.status:
+            return
+        LOG.info("Probe Node(%s): %s -> %s", state.node_id, state.status, status)
+        state.status = status
+        entry = self.registry.get(state.node_id)
+        if entry is not None:
+            entry.info["status"] = status
+            self.registry.update(state.node_id)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import struct
+import binascii
+
+from tornado import gen
+
+from .common import crc32sum, Message
+
+
+class Framing(object):
+    delimiter = "DELIMITER"
+    binary = "BINARY"
+
+
+# magic, version, flags, payload length, crc32
+HEADER = struct.Struct(">2sBBII")
+MAGIC = b"TD"
+VERSION = 1
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+
+
+class FrameError(Exception):
+    pass
+
+
+def new_header_buffer():
+    return bytearray(HEADER.size)
+
+
+def pack_frame(payload, framing = Framing.delimiter, flags = 0):
+    '''
+    payload is bytes
+    '''
+    if framing == Framing.binary:
+        return HEADER.pack(MAGIC, VERSION, flags, len(payload), binascii.crc32(payload) & 0xffffffff) + payload
+    return b"%s%s%s%s" % (payload, Message.msg_sp, crc32sum(payload), Message.msg_end)
+
+
+def unpack_header(header_buffer):
+    '''
+    return (length, flags, crc) of a binary frame header, None for a delimiter frame
+    '''
+    if header_buffer[:2] != MAGIC:
+        return None
+    magic, version, flags, length, crc = HEADER.unpack(header_buffer)
+    if version != VERSION:
+        raise FrameError("unsupported frame version: %s" % version)
+    if length > MAX_PAYLOAD_SIZE:
+        raise FrameError("frame too large: %s" % length)
+    return length, flags, crc
+
+
+def check_payload(payload, crc):
+    if binascii.crc32(payload) & 0xffffffff != crc:
+        return None
+    return payload
+
+
+def split_delimited(msg):
+    '''
+    return the data of a delimiter frame, None when the checksum doesn't match
+    '''
+    data_string, data_crc32 = msg.strip().split(Message.msg_sp)
+    if crc32sum(data_string) != data_crc32:
+        return None
+    return data_string
+
+
+@gen.coroutine
+def read_frame(stream, header_buffer):
+    '''
+    read one frame in either framing mode, the mode is detected from the
+    first HEADER.size bytes, a delimiter frame is always longer than that.
+    return (payload, flags), payload is None when the checksum doesn't match
+    '''
+    yield stream.read_into(header_buffer)
+    header = unpack_header(header_buffer)
+    if header is not None:
+        length, flags, crc = header
+        payload = (yield stream.read_bytes(length)) if length else b""
+        raise gen.Return((check_payload(payload, crc), flags))
+    msg = bytes(header_buffer) + (yield stream.read_until(Message.msg_end))
+    raise gen.Return((split_delimited(msg), 0))
+
+
+async def read_frame_async(stream, header_buffer):
+    '''
+    native coroutine version of read_frame
+    '''
+    await stream.read_into(header_buffer)
+    header = unpack_header(header_buffer)
+    if header is not None:
+        length, flags, crc = header
+        payload = (await stream.read_bytes(length)) if length else b""
+        return check_payload(payload, crc), flags
+    msg = bytes(header_buffer) + (await stream.read_until(Message.msg_end))
+    return split_delimited(msg), 0
@@ -1,122 +1,549 @@
 # -*- coding: utf-8 -*-
 
+import time
+import random
 import logging
-import json
+from datetime import timedelta
 
 import tornado
+import tornado.iostream
 import tornado.tcpclient
 from tornado import gen
+from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
 
-from .common import crc32sum, Command, Status, Message
+from .common import Command, Status
+from .protocol import Framing, new_header_buffer, pack_frame, read_frame
+from .codec import DEFAULT_CODEC, CODECS, CompactCodec, JsonCodec, encode_payload, decode_payload
+from .metrics import METRICS
+from .udp import HeartbeatSender
+from .tls import client_context, start_tls
 
 LOG = logging.getLogger(__name__)
 
 
 class BaseRegistrant(object):
-    def __init__(self, host, port, config, retry_interval = 10, reconnect = True):
-        self.host = host
-        self.port = port
+    metrics = METRICS
+
+    def __init__(self, host, port, config, retry_interval = 10, reconnect = True,
+                 codecs = (JsonCodec.name, CompactCodec.name), compress_threshold = None,
+                 request_timeout = None, endpoints = None, name = None,
+                 max_retry_interval = 300, jitter = True, udp_heartbeat = False, udp_retry_interval = 30,
+                 ssl_options = None, server_hostname = None, session_resumption = True):
+        '''
+        endpoints is an optional list of (host, port) of replicated listeners,
+        when the connection is lost the next one is tried immediately, a retry delay
+        is only waited after every endpoint failed in a row. node_id is kept in
+        config, so the node re-registers with the same node_id on the next listener.
+        the retry delay doubles from retry_interval up to max_retry_interval until the
+        node registers again, with jitter it is drawn uniformly below that bound.
+        round-trip times are recorded in metrics labeled with name, http_host:http_port by default.
+        with udp_heartbeat the heartbeats without info changes are sent as UDP datagrams
+        when the listener grants it, until it asks for TCP heartbeats again (FALLBACK).
+        udp_retry_interval seconds after a fallback the node asks for UDP again with a
+        TCP heartbeat, the wait doubles, up to 32 times, while UDP keeps failing sooner.
+        ssl_options (an SSLContext, a dict as for Tornado or True for the default context)
+        connects with TLS, server_hostname is checked against the listener's certificate,
+        host by default. with session_resumption the TLS session of the last connection
+        to an endpoint is resumed on reconnect, skipping the certificate exchange.
+        '''
+        self.endpoints = list(endpoints) if endpoints else [(host, port)]
+        self.host, self.port = self.endpoints[0]
         self.config = config
         self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.jitter = jitter
+        self.udp_heartbeat = udp_heartbeat
+        self.udp_retry_interval = udp_retry_interval
+        self.ssl_context = client_context(ssl_options)
+        self.server_hostname = server_hostname
+        self.session_resumption = session_resumption
         self.heartbeat_interval = self.config.get("heartbeat_interval")
         self.heartbeat_timeout = self.config.get("heartbeat_timeout")
         self.reconnect = reconnect
+        self.codecs = list(codecs)
+        self.compress_threshold = compress_threshold
+        self.request_timeout = request_timeout or self.heartbeat_timeout
         self.tcpclient = tornado.tcpclient.TCPClient()
+        self.random = random # draws the jitter, a seeded random.Random makes it reproducible
         self.periodic_heartbeat = None
+        self._heartbeat_start = None
         self._stream = None
+        self._delta_heartbeat = False
+        self._synced_version = None
+        self._framing = Framing.delimiter
+        self._codec = DEFAULT_CODEC
+        self._compress_threshold = None
+        self._header_buffer = new_header_buffer()
+        self._request_id = 0
+        self._pending = {} # request id: Future, in send order
+        self._ordered_replies = None # listener without request ids, None until its register reply
+        self._sent_version = None
+        self._registered = False
+        self._endpoint_index = 0
+        self._endpoint_failures = 0
+        self._retry_attempts = 0
+        self._retry_after = None # seconds, set by a RETRY reply of the listener
+        self._connect_timeout = None # the scheduled reconnect
+        self._io_loop = None
+        self.lease = None # {"ttl", "heartbeat_interval"} granted by the listener
+        self._udp = None # HeartbeatSender, when the listener granted UDP heartbeats
+        self._udp_granted_at = None
+        self._udp_cooldown = None # seconds waited after the last fallback
+        self._udp_retry_at = None # time to ask for UDP heartbeats again after a fallback
+        self._tls_sessions = {} # (host, port): ssl.SSLSession of the last connection
+        if name is None:
+            name = "%s:%s" % (config.config.get("http_host"), config.config.get("http_port"))
+        labels = {"registrant": name}
+        self.rtt = self.metrics.histogram("discovery_registrant_rtt_seconds", "request round-trip time", labels)
+        self.request_failures = self.metrics.counter(
+            "discovery_registrant_request_failures_total", "requests timed out or closed", labels
+        )
+        self.reconnects = self.metrics.counter("discovery_registrant_reconnects_total", "connection attempts after a failure", labels)
+        self.udp_heartbeats = self.metrics.counter("discovery_registrant_udp_heartbeats_total", "heartbeats sent over UDP", labels)
+        self.tls_handshakes = dict(
+            (resumed, self.metrics.counter(
+                "discovery_registrant_tls_handshakes_total", "TLS handshakes",
+                dict(labels, result = "resumed" if resumed else "full")
+            ))
+            for resumed in (True, False)
+        )
+
+    @property
+    def io_loop(self):
+        '''
+        the IOLoop the registrant runs on, the current one unless set explicitly
+        '''
+        return self._io_loop or IOLoop.current()
 
     @gen.coroutine
     def connect(self, delay = False):
         try:
             if delay == False:
                 stream = yield self.tcpclient.connect(self.host, self.port)
+                if self.ssl_context is not None:
+                    stream = yield self._start_tls(stream)
                 self._on_connect(stream)
             else:
-                LOG.info("Connect to Server failed: Retry %s seconds later ...", self.retry_interval)
-                IOLoop.instance().add_timeout(IOLoop.time(IOLoop.instance()) + self.retry_interval ,self.connect)
+                self._schedule_connect()
         except Exception as e:
             LOG.exception(e)
             if self.reconnect == True:
-                LOG.info("Connect to Server failed: Retry %s seconds later ...", self.retry_interval)
-                IOLoop.instance().add_timeout(IOLoop.time(IOLoop.instance()) + self.retry_interval ,self.connect)
+                self._failover()
+
+    @gen.coroutine
+    def _start_tls(self, stream):
+        session = self._tls_sessions.get((self.host, self.port)) if self.session_resumption else None
+        try:
+            stream = start_tls(stream, self.ssl_context, server_hostname = self.server_hostname or self.host, session = session)
+            yield stream.wait_for_handshake()
+        except Exception:
+            stream.close()
+            raise
+        resumed = stream.socket.session_reused
+        self.tls_handshakes[resumed].inc()
+        LOG.debug("TLS handshake with %s:%s, resumed: %s", self.host, self.port, resumed)
+        raise gen.Return(stream)
+
+    def _save_tls_session(self):
+        '''
+        keep the session to resume on reconnect, with TLS 1.3 its ticket arrives
+        after the handshake, it is there once a reply was read
+        '''
+        if self.ssl_context is not None and self.session_resumption and self._stream.socket is not None:
+            session = self._stream.socket.session
+            if session is not None:
+                self._tls_sessions[(self.host, self.port)] = session
+
+    def _schedule_connect(self):
+        delay = self._retry_delay()
+        LOG.info("Connect to Server failed: Retry %.3f seconds later ...", delay)
+        self._connect_timeout = self.io_loop.add_timeout(self.io_loop.time() + delay, self._retry_connect)
+
+    def _retry_delay(self):
+        '''
+        exponential backoff with full jitter, so a fleet that lost its listener
+        at once doesn't reconnect in lockstep waves. a retry_after sent by the
+        listener is waited at least, plus up to as much again with jitter.
+        '''
+        delay = min(self.max_retry_interval, self.retry_interval * 2 ** min(self._retry_attempts, 32))
+        self._retry_attempts += 1
+        if self.jitter:
+            delay = self.random.uniform(0, delay)
+        if self._retry_after is not None:
+            delay = self._retry_after + (self.random.uniform(0, self._retry_after) if self.jitter else 0)
+            self._retry_after = None
+        return delay
+
+    def _failover(self):
+        '''
+        switch to the next endpoint and connect, immediately unless all endpoints failed in a row
+        '''
+        self._endpoint_failures += 1
+        self.reconnects.inc()
+        self._endpoint_index = (self._endpoint_index + 1) % len(self.endpoints)
+        self.host, self.port = self.endpoints[self._endpoint_index]
+        if self._retry_after is None and self._endpoint_failures < len(self.endpoints):
+            LOG.info("Failover to Server %s:%s ...", self.host, self.port)
+            self.io_loop.add_callback(self._retry_connect)
+        else:
+            self._endpoint_failures = 0
+            self._schedule_connect()
+
+    def _retry_connect(self):
+        self._connect_timeout = None
+        # closed while waiting to reconnect
+        if self.reconnect:
+            self.connect()
 
     def _on_connect(self, stream):
         LOG.info("Client on connect")
         self._stream = stream
         self._stream.set_close_callback(self._on_close)
+        if self._stream.closed():
+            # closed before the callback was set, e.g. refused by the listener's admission control
+            self._stream.set_close_callback(None)
+            self.io_loop.add_callback(self._on_close)
+            return
+        self._delta_heartbeat = False
+        self._synced_version = None
+        self._framing = Framing.delimiter
+        self._codec = DEFAULT_CODEC
+        self._compress_threshold = None
+        self._header_buffer = new_header_buffer()
+        self._ordered_replies = None
+        self._sent_version = None
+        self._registered = False
+        self.lease = None
+        self._close_udp()
         LOG.debug("self.stream: %s: %s", type(self._stream), self._stream.fileno())
-        IOLoop.instance().add_callback(self.register_service)
+        self.io_loop.add_callback(self._read_loop, self._stream)
+        self.io_loop.add_callback(self.register_service)
+        self._start_heartbeat(self.heartbeat_interval)
+
+    def _start_heartbeat(self, heartbeat_interval):
+        self._stop_heartbeat()
         self.periodic_heartbeat = tornado.ioloop.PeriodicCallback(
             self.heartbeat_service, 
-            self.heartbeat_interval * 1000
+            heartbeat_interval * 1000
         )
-        self.periodic_heartbeat.start()
+        # a random phase, registrants reconnecting together don't heartbeat together
+        self._heartbeat_start = self.io_loop.add_timeout(
+            self.io_loop.time() + self.random.uniform(0, heartbeat_interval),
+            self.periodic_heartbeat.start
+        )
+
+    def _stop_heartbeat(self):
+        if self._heartbeat_start is not None:
+            self.io_loop.remove_timeout(self._heartbeat_start)
+            self._heartbeat_start = None
+        if self.periodic_heartbeat:
+            self.periodic_heartbeat.stop()
 
     @gen.coroutine
     def read_message(self):
-        data = {"command": Command.error, "data": "Client received wrong message!"}
-        msg = yield self._stream.read_until(Message.msg_end)
-        data_string, data_crc32 = msg.strip().split(Message.msg_sp)
-        if crc32sum(data_string) == data_crc32:
-            data = json.loads(data_string.decode("utf-8"))
-        raise gen.Return(data)
+        payload, flags = yield read_frame(self._stream, self._header_buffer)
+        raise gen.Return(self._decode(payload, flags))
+
+    def _decode(self, payload, flags):
+        if payload is None:
+            return {"command": Command.error, "data": "Client received wrong message!"}
+        return decode_payload(payload, flags)
 
     @gen.coroutine
     def send_message(self, data):
         try:
-            data_string = json.dumps(data).encode("utf-8")
-            data_crc32 = crc32sum(data_string)
+            payload, flags = encode_payload(data, self._codec, self._compress_threshold)
             LOG.debug("Send: %s", data)
-            msg = b"%s%s%s%s" % (data_string, Message.msg_sp, data_crc32, Message.msg_end)
-            yield self._stream.write(msg)
+            yield self._stream.write(pack_frame(payload, self._framing, flags))
         except Exception as e:
             LOG.exception(e)
 
     @gen.coroutine
-    def register_service(self):
+    def request(self, data, timeout = None):
+        '''
+        send data with a new request id and wait for the matching reply,
+        several requests can be in flight on the connection at the same time
+        '''
+        request_id, future = self._new_request(data)
+        start = time.perf_counter()
         try:
-            data = {"command": Command.register, "data": self.config.to_dict()}
             self.send_message(data)
-            data = yield self.read_message()
-            if not self.config.has_key("node_id"):
-                self.config.set("node_id", data["data"]["node_id"])
-                LOG.info("Received new node_id: %s", data["data"]["node_id"])
-            LOG.info("Client Register Received Message: %s", data)
+            result = yield gen.with_timeout(timedelta(seconds = timeout or self.request_timeout), future)
+            self.rtt.observe(time.perf_counter() - start)
+        except Exception:
+            self.request_failures.inc()
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+        raise gen.Return(result)
+
+    def _new_request(self, data):
+        self._request_id += 1
+        data["id"] = self._request_id
+        future = Future()
+        self._pending[self._request_id] = future
+        return self._request_id, future
+
+    def on_message(self, data):
+        '''
+        called with messages pushed by the listener, e.g. broadcasts
+        '''
+        LOG.info("Client Received Message: %s", data)
+
+    @gen.coroutine
+    def _read_loop(self, stream):
+        try:
+            while stream is self._stream:
+                data = yield self.read_message()
+                self._dispatch(data)
+        except tornado.iostream.StreamClosedError:
+            pass
         except Exception as e:
             LOG.exception(e)
+        self._fail_pending(stream)
+
+    def _dispatch(self, data):
+        '''
+        resolve the request data replies to, or pass a pushed message to on_message
+        '''
+        if data.get("command") == Command.fallback:
+            self._on_fallback(data)
+            return
+        if data.get("command") == Command.register and self._refused(data):
+            LOG.warning("Client Register Refused: retry after %s seconds", data["data"]["retry_after"])
+            self._retry_after = data["data"]["retry_after"]
+            if self._connect_timeout is not None:
+                # the close that follows a RETRY was handled first, wait retry_after instead
+                self.io_loop.remove_timeout(self._connect_timeout)
+                self._schedule_connect()
+        request_id = data.get("id")
+        if request_id is not None:
+            self._ordered_replies = False
+        elif self._pending and self._replies_in_order(data):
+            request_id = next(iter(self._pending))
+        future = self._pending.pop(request_id, None)
+        if future is not None:
+            if not future.done():
+                future.set_result(data)
+        elif request_id is None:
+            self.on_message(data)
+        else:
+            LOG.warning("Client Received Late Reply: %s", data)
+
+    def _replies_in_order(self, data):
+        '''
+        a listener without request ids replies in order, it is known from its
+        register reply, the first one on the connection. until then and with a
+        listener echoing ids, frames without id are pushed messages
+        '''
+        if self._ordered_replies is None and data.get("command") == Command.register:
+            self._ordered_replies = True
+        return bool(self._ordered_replies) and data.get("command") not in (Command.message, Command.watch)
+
+    def _fail_pending(self, stream):
+        if stream is self._stream:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(tornado.iostream.StreamClosedError())
+            self._pending.clear()
+
+    @gen.coroutine
+    def register_service(self):
+        try:
+            data = yield self.request(self._register_data())
+            self._on_register(data)
+        except Exception as e:
+            LOG.exception(e)
+
+    def _register_data(self):
+        self._sent_version = self.config.version
+        data = {
+            "command": Command.register,
+            "data": self.config.to_dict(),
+            "version": self.config.version,
+            "framing": [Framing.binary],
+            "codecs": self.codecs,
+        }
+        if self.udp_heartbeat:
+            data["udp"] = True
+        return data
+
+    def _on_register(self, data):
+        if self._refused(data):
+            return
+        self._retry_after = None
+        if data.get("framing") == Framing.binary:
+            self._framing = Framing.binary
+            self._codec = CODECS.get(data.get("codec"), DEFAULT_CODEC)
+            self._compress_threshold = self.compress_threshold
+        # listener supports delta heartbeats, it has applied everything sent so far
+        # when it handles the next heartbeat
+        if "version" in data:
+            self._delta_heartbeat = True
+            self._synced_version = self._sent_version
+        if not self.config.has_key("node_id"):
+            self.config.set("node_id", data["data"]["node_id"])
+            LOG.info("Received new node_id: %s", data["data"]["node_id"])
+        self._registered = True
+        self._retry_attempts = 0
+        # a listener accepting and closing again isn't a working endpoint
+        self._endpoint_failures = 0
+        self._save_tls_session()
+        self._apply_lease(data.get("lease"))
+        self._open_udp(data.get("udp"))
+        LOG.info("Client Register Received Message: %s", data)
+
+    def _apply_lease(self, lease):
+        '''
+        heartbeat at the interval granted by the listener, heartbeat_interval is kept
+        for the next connection
+        '''
+        if lease is None:
+            return
+        self.lease = lease
+        if self.periodic_heartbeat is not None and self.periodic_heartbeat.callback_time != lease["heartbeat_interval"] * 1000:
+            self._start_heartbeat(lease["heartbeat_interval"])
+        LOG.info("Client Lease: ttl %ss, heartbeat every %ss", lease["ttl"], lease["heartbeat_interval"])
+
+    def _open_udp(self, grant):
+        self._close_udp()
+        if grant and self.udp_heartbeat:
+            # the listener's address as resolved for the TCP connection
+            self._udp = HeartbeatSender(self._stream.socket.getpeername(), grant)
+            self._udp_granted_at = self.io_loop.time()
+            self._udp_retry_at = None
+            LOG.info("Client UDP Heartbeats to port %s", grant["port"])
+
+    def _close_udp(self):
+        if self._udp is not None:
+            self._udp.close()
+            self._udp = None
+
+    def _on_fallback(self, data):
+        LOG.warning("Client UDP Heartbeats Fallback to TCP: loss %s", data["data"].get("loss"))
+        self._close_udp()
+        now = self.io_loop.time()
+        if self._udp_cooldown is None or self._udp_granted_at is None or now - self._udp_granted_at > self._udp_cooldown:
+            self._udp_cooldown = self.udp_retry_interval
+        else:
+            # UDP failed again within the cool-down, wait longer before the next try
+            self._udp_cooldown = min(self._udp_cooldown * 2, self.udp_retry_interval * 32)
+        self._udp_retry_at = now + self._udp_cooldown
+        self.io_loop.add_callback(self.heartbeat_service)
+
+    def _heartbeat_udp(self):
+        '''
+        send the heartbeat as a UDP datagram if granted and the listener has every
+        info change, return False if it has to go over TCP
+        '''
+        if self._udp is None or self._synced_version is None or self._synced_version != self.config.version:
+            return False
+        if self._udp.send(self.config.get("node_id")):
+            self.udp_heartbeats.inc()
+            return True
+        return False
+
+    def _refused(self, data):
+        '''
+        True if the listener answered RETRY, it closes the connection and the
+        next connect waits retry_after seconds, set by _dispatch
+        '''
+        return isinstance(data.get("data"), dict) and data["data"].get("status") == Status.retry
 
     @gen.coroutine
     def unregister_service(self):
+        '''
+        remove the node from the listener right away, e.g. before a deploy stops the
+        process, heartbeats stop and the registrant doesn't reconnect, close() it afterwards
+        '''
         try:
-            data = {"command": Command.unregister, "data": "Client Unregister Service!"}
-            self.send_message(data)
-            data = yield self.read_message()
-            LOG.info("Client Received Message: %s", data)
+            data = yield self.request(self._unregister_data())
+            self._on_unregister(data)
         except Exception as e:
             LOG.exception(e)
 
+    def _unregister_data(self):
+        return {"command": Command.unregister, "data": {"node_id": self.config.get("node_id")}}
+
+    def _on_unregister(self, data):
+        if data["data"]["status"] != Status.success:
+            LOG.error("Client Unregister Received Message: %s", data["data"])
+            return
+        self._registered = False
+        self.reconnect = False
+        self._stop_heartbeat()
+        self._close_udp()
+        LOG.info("Client Unregister Received Message: %s", data["data"])
+
     @gen.coroutine
     def heartbeat_service(self):
         try:
-            data = {"command": Command.heartbeat, "data": self.config.to_dict()}
-            self.send_message(data)
-            data = yield self.read_message()
-            if data["data"]["status"] == Status.success:
-                LOG.debug("Client Received Heartbeat Message: %s", data["data"])
-            else:
-                LOG.error("Client Received Heartbeat Message: %s", data["data"])
+            if not self._registered:
+                LOG.debug("Client not registered yet, skip heartbeat")
+                return
+            if self._heartbeat_udp():
+                return
+            data = yield self.request(self._heartbeat_data())
+            if self._resync(data):
+                data = yield self.request(self._heartbeat_data())
+            self._on_heartbeat(data)
         except Exception as e:
             LOG.exception(e)
 
+    def _resync(self, data):
+        '''
+        True if the listener asked for a full heartbeat
+        '''
+        if data["data"]["status"] == Status.resync:
+            LOG.info("Client Resync Heartbeat: %s", data["data"])
+            self._synced_version = None
+            return True
+        return False
+
+    def _on_heartbeat(self, data):
+        if data["data"]["status"] == Status.success:
+            LOG.debug("Client Received Heartbeat Message: %s", data["data"])
+            if data.get("udp"):
+                self._open_udp(data["udp"])
+        else:
+            LOG.error("Client Received Heartbeat Message: %s", data["data"])
+
+    def _heartbeat_data(self):
+        '''
+        heartbeats are applied in order by the listener, so the next delta is
+        based on the version sent last, a RESYNC reply falls back to a full heartbeat
+        '''
+        version = self.config.version
+        synced_version = self._synced_version
+        self._sent_version = version
+        if self._delta_heartbeat:
+            self._synced_version = version
+        if synced_version is None:
+            message = {"command": Command.heartbeat, "data": self.config.to_dict(), "version": version}
+        else:
+            data = {"version": version}
+            if version != synced_version:
+                update, delete = self.config.diff(synced_version)
+                data["base"] = synced_version
+                if update:
+                    data["update"] = update
+                if delete:
+                    data["delete"] = delete
+            message = {"command": Command.heartbeat, "delta": True, "data": data}
+        if self._udp is None and self._udp_retry_at is not None and self.io_loop.time() >= self._udp_retry_at:
+            # the fallback cool-down passed, ask for UDP heartbeats again
+            message["udp"] = True
+        return message
+
     def close(self):
         try:
             if self._stream:
                 self._stream.set_close_callback(None)
             self.reconnect = False
-            if self.periodic_heartbeat:
-                self.periodic_heartbeat.stop()
-            IOLoop.instance().add_timeout(IOLoop.time(IOLoop.instance()) + 5 ,
+            self._stop_heartbeat()
+            self._close_udp()
+            self.io_loop.add_timeout(self.io_loop.time() + 5 ,
                                           lambda :(self._stream.close() if self._stream else None, 
                                                    self.tcpclient.close(), 
                                                    LOG.info("Close Client!")))
@@ -127,13 +554,196 @@ class BaseRegistrant(object):
         try:
             LOG.info("Client closed by Server refused!")
             self._stream.close()
-            if self.periodic_heartbeat:
-                self.periodic_heartbeat.stop()
+            self._stop_heartbeat()
+            self._close_udp()
             if self.reconnect:
                 LOG.info("Reconnect to Server ...")
-                self.connect(delay = True)
+                self._failover()
             else:
                 LOG.info("Close Client!")
                 self.tcpclient.close()
         except Exception as e:
             LOG.exception(e)
+
+
+class NodeState(object):
+    '''
+    delta heartbeat state of one config of a MultiplexRegistrant
+    '''
+    __slots__ = ("synced_version", "sent_version", "registered", "removed")
+
+    def __init__(self):
+        self.synced_version = None
+        self.sent_version = None
+        self.registered = False
+        self.removed = False # unregistered, not registered again on reconnect
+
+
+class MultiplexRegistrant(BaseRegistrant):
+    '''
+    register several configs (services of one process) over one connection,
+    one batched HEARTBEAT frame per heartbeat_interval covers all of them,
+    heartbeat_interval is the smallest of the configs by default.
+    needs a listener that understands batched REGISTER/HEARTBEAT.
+    '''
+    def __init__(self, host, port, configs, heartbeat_interval = None, **kwargs):
+        self.configs = list(configs)
+        self.nodes = [NodeState() for _ in self.configs]
+        first = self.configs[0].config
+        kwargs.setdefault("name", "multiplex-%s:%s" % (first.get("http_host"), first.get("http_port")))
+        BaseRegistrant.__init__(self, host, port, self.configs[0], **kwargs)
+        self.heartbeat_interval = heartbeat_interval or min(config.get("heartbeat_interval") for config in self.configs)
+        self.heartbeat_timeout = min(config.get("heartbeat_timeout") for config in self.configs)
+        self.request_timeout = kwargs.get("request_timeout") or self.heartbeat_timeout
+
+    def add_config(self, config):
+        '''
+        add a config, registered right away when the connection is up
+        '''
+        self.configs.append(config)
+        self.nodes.append(NodeState())
+        if self._registered:
+            self.io_loop.add_callback(self.register_service, [len(self.configs) - 1])
+
+    def _on_connect(self, stream):
+        for node in self.nodes:
+            node.synced_version = None
+            node.sent_version = None
+            node.registered = False
+        BaseRegistrant._on_connect(self, stream)
+
+    @gen.coroutine
+    def register_service(self, indexes = None):
+        '''
+        register the configs at indexes, all of them by default, in one frame
+        '''
+        try:
+            if indexes is None:
+                indexes = [i for i, node in enumerate(self.nodes) if not node.removed]
+            batch = []
+            for i in indexes:
+                self.nodes[i].sent_version = self.configs[i].version
+                batch.append({"data": self.configs[i].to_dict(), "version": self.configs[i].version})
+            data = {
+                "command": Command.register,
+                "batch": batch,
+                "framing": [Framing.binary],
+                "codecs": self.codecs,
+            }
+            data = yield self.request(data)
+            if self._refused(data):
+                return
+            self._retry_after = None
+            if data.get("framing") == Framing.binary:
+                self._framing = Framing.binary
+                self._codec = CODECS.get(data.get("codec"), DEFAULT_CODEC)
+                self._compress_threshold = self.compress_threshold
+            leases = []
+            for i, result in zip(indexes, data["batch"]):
+                if result["status"] != Status.success:
+                    LOG.error("Client Register Received Message: %s", result)
+                    continue
+                if "lease" in result:
+                    leases.append(result["lease"])
+                config = self.configs[i]
+                self.nodes[i].synced_version = self.nodes[i].sent_version
+                self.nodes[i].registered = True
+                if not config.has_key("node_id"):
+                    config.set("node_id", result["node_id"])
+                    LOG.info("Received new node_id: %s", result["node_id"])
+            self._registered = True
+            self._retry_attempts = 0
+            self._endpoint_failures = 0
+            self._save_tls_session()
+            if leases:
+                # one batched heartbeat has to renew the shortest lease
+                self._apply_lease(min(leases, key = lambda lease: lease["heartbeat_interval"]))
+            LOG.info("Client Register Received Message: %s", data["data"])
+        except Exception as e:
+            LOG.exception(e)
+
+    @gen.coroutine
+    def unregister_service(self, indexes = None):
+        '''
+        remove the configs at indexes from the listener right away, all of them by
+        default, they are not registered again. once none is left heartbeats stop
+        and the registrant doesn't reconnect
+        '''
+        try:
+            if indexes is None:
+                indexes = [i for i, node in enumerate(self.nodes) if not node.removed]
+            data = yield self.request({
+                "command": Command.unregister,
+                "batch": [{"node_id": self.configs[i].get("node_id")} for i in indexes],
+                "data": {},
+            })
+            for i, result in zip(indexes, data.get("batch", ())):
+                if result["status"] != Status.success:
+                    LOG.error("Client Unregister Received Message: %s", result)
+                self.nodes[i].registered = False
+                self.nodes[i].removed = True
+            if all(node.removed for node in self.nodes):
+                self._registered = False
+                self.reconnect = False
+                self._stop_heartbeat()
+            LOG.info("Client Unregister Received Message: %s", data["data"])
+        except Exception as e:
+            LOG.exception(e)
+
+    @gen.coroutine
+    def heartbeat_service(self):
+        try:
+            if not self._registered:
+                LOG.debug("Client not registered yet, skip heartbeat")
+                return
+            indexes = [i for i, node in enumerate(self.nodes) if node.registered]
+            if not indexes:
+                return
+            data = yield self._heartbeat_batch(indexes)
+            results = dict(zip(indexes, data["batch"]))
+            resync = [i for i in indexes if results[i]["status"] == Status.resync]
+            if resync:
+                LOG.info("Client Resync Heartbeat: %s nodes", len(resync))
+                for i in resync:
+                    self.nodes[i].synced_version = None
+                data = yield self._heartbeat_batch(resync)
+                results.update(zip(resync, data["batch"]))
+            failed = [i for i in indexes if results[i]["status"] == Status.failure]
+            if failed:
+                LOG.error("Client Received Heartbeat Message: %s", [results[i] for i in failed])
+                for i in failed:
+                    self.nodes[i].registered = False
+                self.io_loop.add_callback(self.register_service, failed)
+        except Exception as e:
+            LOG.exception(e)
+
+    def _heartbeat_batch(self, indexes):
+        return self.request({
+            "command": Command.heartbeat,
+            "batch": [self._node_heartbeat(self.configs[i], self.nodes[i]) for i in indexes],
+        })
+
+    def _node_heartbeat(self, config, node):
+        '''
+        same as _heartbeat_data for one config, a batched listener always takes deltas
+        '''
+        version = config.version
+        synced_version = node.synced_version
+        node.sent_version = version
+        node.synced_version = version
+        item = {"node_id": config.get("node_id")}
+        if synced_version is None:
+            item["data"] = config.to_dict()
+            item["version"] = version
+            return item
+        data = {"version": version}
+        if version != synced_version:
+            update, delete = config.diff(synced_version)
+            data["base"] = synced_version
+            if update:
+                data["update"] = update
+            if delete:
+                data["delete"] = delete
+        item["delta"] = True
+        item["data"] = data
+        return item
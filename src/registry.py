@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import itertools
+from collections import deque
+from uuid import uuid4
+from types import MappingProxyType
+
+from .common import Event
+from .info import NodeInfo
+
+LOG = logging.getLogger(__name__)
+
+
+class RegistryEntry(object):
+    __slots__ = (
+        "node_id", "info", "connection", "service", "tags", "address", "view",
+        "revision", "origin", "origin_revision",
+    )
+
+    def __init__(self, node_id, info, connection = None):
+        self.node_id = node_id
+        self.info = info
+        self.connection = connection
+        self.service = None
+        self.tags = ()
+        self.address = None
+        self.view = None
+        self.revision = 0 # registry revision of the last change
+        self.origin = None # id of the peer listener a replicated node is connected to
+        self.origin_revision = 0
+
+    def __repr__(self):
+        return "RegistryEntry(%s, %s, %s)" % (self.node_id, self.service, self.address)
+
+
+class RegistryEvent(object):
+    __slots__ = ("revision", "type", "node_id", "service", "info", "previous_service", "local", "messages", "frames")
+
+    def __init__(self, revision, event_type, node_id, service, info = None, previous_service = None, local = True):
+        self.revision = revision
+        self.type = event_type
+        self.node_id = node_id
+        self.service = service
+        self.info = info
+        self.previous_service = previous_service
+        self.local = local # the node is connected to this process
+        self.messages = {} # watch messages and their encoded frames shared by the watchers,
+        self.frames = {}   # both keyed by event type
+
+    def match(self, service):
+        '''
+        return the event type as seen by a watcher of service, None if not relevant
+        '''
+        if service is None or self.service == service:
+            return self.type
+        if self.previous_service == service:
+            return Event.removed
+        return None
+
+    def to_dict(self, event_type = None):
+        data = {"revision": self.revision, "type": event_type or self.type, "node_id": self.node_id}
+        if self.info is not None and (event_type or self.type) != Event.removed:
+            data["info"] = dict(self.info)
+        return data
+
+
+class RegistrySnapshot(object):
+    '''
+    immutable view of the registry at revision, info values are read-only shallow copies.
+    it is made of one tuple of (node_id, info) per service, shared with the next
+    snapshots while the service doesn't change, the node and tag maps are built
+    from them on first use
+    '''
+    def __init__(self, revision, groups):
+        self.revision = revision
+        self._groups = groups # service, None for the nodes without: ((node_id, info), ...)
+        self._nodes = None
+        self._tags = None
+
+    @property
+    def nodes(self):
+        if self._nodes is None:
+            self._nodes = MappingProxyType(dict(itertools.chain.from_iterable(self._groups.values())))
+        return self._nodes
+
+    def __len__(self):
+        return sum(len(group) for group in self._groups.values())
+
+    def __contains__(self, node_id):
+        return node_id in self.nodes
+
+    def get(self, node_id, default = None):
+        return self.nodes.get(node_id, default)
+
+    def services(self):
+        return [service for service in self._groups if service is not None]
+
+    def has_service(self, service):
+        return service is not None and service in self._groups
+
+    def find_by_service(self, service):
+        if service is None:
+            return []
+        return [info for _, info in self._groups.get(service, ())]
+
+    def find_by_tag(self, tag):
+        if self._tags is None:
+            self._tags = {}
+            for info in self.nodes.values():
+                for t in info.get("tags") or ():
+                    self._tags.setdefault(t, []).append(info)
+        return list(self._tags.get(tag, ()))
+
+
+class Registry(object):
+    '''
+    live nodes indexed by node_id, service name ("service" in info),
+    tag ("tags" in info) and http address, revision is bumped on every change.
+    the last history changes are kept as RegistryEvent for watchers to resume from.
+    info is stored as NodeInfo, dicts are converted
+    '''
+    def __init__(self, history = 10000):
+        self.epoch = str(uuid4())
+        self.revision = 0
+        self._events = deque(maxlen = history)
+        self._subscribers = []
+        self._entries = {}
+        self._services = {}
+        self._tags = {}
+        self._addresses = {}
+        self._hosts = {}
+        self._unserviced = set() # node_ids without service
+        self._groups = {} # service: ((node_id, view), ...) of the last snapshot
+        self._dirty = set() # services changed since the last snapshot
+        self._snapshot = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, node_id):
+        return node_id in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries.values()))
+
+    def get(self, node_id):
+        return self._entries.get(node_id)
+
+    def services(self):
+        return list(self._services.keys())
+
+    def has_service(self, service):
+        return service in self._services
+
+    def find_by_service(self, service):
+        return [self._entries[node_id] for node_id in self._services.get(service, ())]
+
+    def find_by_tag(self, tag):
+        return [self._entries[node_id] for node_id in self._tags.get(tag, ())]
+
+    def find_by_address(self, host, port = None):
+        if port is not None:
+            return [self._entries[node_id] for node_id in self._addresses.get((host, port), ())]
+        return [self._entries[node_id] for node_id in self._hosts.get(host, ())]
+
+    def register(self, node_id, info, connection = None, origin = None):
+        '''
+        add or replace the node, return the entry
+        '''
+        info = NodeInfo.from_dict(info)
+        entry = self._entries.get(node_id)
+        if entry is None:
+            entry = RegistryEntry(node_id, info, connection)
+            entry.origin = origin
+            self._entries[node_id] = entry
+            self._index(entry)
+            self._changed(Event.added, entry)
+        else:
+            previous_service = entry.service
+            entry.info = info
+            if connection is not None:
+                entry.connection = connection
+                entry.origin = None
+            elif origin is not None:
+                entry.origin = origin
+            self._index(entry)
+            self._changed(Event.updated, entry, previous_service)
+        return entry
+
+    def update(self, node_id, info = None):
+        '''
+        re-index the node after its info changed, return the entry or None
+        '''
+        entry = self._entries.get(node_id)
+        if entry is not None:
+            previous_service = entry.service
+            if info is not None:
+                entry.info = NodeInfo.from_dict(info)
+            self._index(entry)
+            self._changed(Event.updated, entry, previous_service)
+        return entry
+
+    def remove(self, node_id, connection = None, origin = None):
+        '''
+        remove the node, when connection or origin is given only if it still owns the entry
+        '''
+        entry = self._entries.get(node_id)
+        if entry is None or (connection is not None and entry.connection is not connection):
+            return None
+        if origin is not None and (entry.origin != origin or entry.connection is not None):
+            return None
+        del self._entries[node_id]
+        service = entry.service
+        self._unindex(entry)
+        entry.service = service
+        self._changed(Event.removed, entry)
+        return entry
+
+    def subscribe(self, callback):
+        '''
+        callback(event) is called with every RegistryEvent
+        '''
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def events_since(self, revision):
+        '''
+        return the events after revision, None when they are not in the history anymore
+        '''
+        if revision >= self.revision:
+            return []
+        if not self._events or self._events[0].revision > revision + 1:
+            return None
+        return list(itertools.islice(self._events, revision + 1 - self._events[0].revision, None))
+
+    def snapshot(self):
+        '''
+        RegistrySnapshot of the current revision, only the services changed since
+        the last one are copied
+        '''
+        if self._snapshot is None or self._snapshot.revision != self.revision:
+            if self._dirty:
+                self._groups = dict(self._groups)
+                for service in self._dirty:
+                    node_ids = self._unserviced if service is None else self._services.get(service)
+                    if node_ids:
+                        self._groups[service] = tuple((node_id, self._entries[node_id].view) for node_id in node_ids)
+                    else:
+                        self._groups.pop(service, None)
+                self._dirty.clear()
+            self._snapshot = RegistrySnapshot(self.revision, self._groups)
+        return self._snapshot
+
+    def clear(self):
+        for node_id in list(self._entries.keys()):
+            self.remove(node_id)
+
+    def _changed(self, event_type, entry, previous_service = None):
+        self.revision += 1
+        entry.revision = self.revision
+        event = RegistryEvent(
+            self.revision,
+            event_type,
+            entry.node_id,
+            entry.service,
+            entry.view,
+            previous_service if previous_service != entry.service else None,
+            entry.connection is not None
+        )
+        self._events.append(event)
+        for callback in list(self._subscribers):
+            try:
+                callback(event)
+            except Exception as e:
+                LOG.exception(e)
+
+    def _index(self, entry):
+        info = entry.info
+        service = info.get("service")
+        tags = tuple(info.get("tags") or ())
+        address = (info.get("http_host"), info.get("http_port"))
+        if service != entry.service or tags != entry.tags or address != entry.address:
+            self._unindex(entry)
+            entry.service = service
+            entry.tags = tags
+            entry.address = address
+            if service is not None:
+                self._services.setdefault(service, set()).add(entry.node_id)
+            else:
+                self._unserviced.add(entry.node_id)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(entry.node_id)
+            self._addresses.setdefault(address, set()).add(entry.node_id)
+            self._hosts.setdefault(address[0], set()).add(entry.node_id)
+        entry.view = MappingProxyType(info.copy())
+        self._dirty.add(entry.service)
+
+    def _unindex(self, entry):
+        self._discard(self._services, entry.service, entry.node_id)
+        self._unserviced.discard(entry.node_id)
+        if entry.address is not None:
+            # indexed before
+            self._dirty.add(entry.service)
+        for tag in entry.tags:
+            self._discard(self._tags, tag, entry.node_id)
+        self._discard(self._addresses, entry.address, entry.node_id)
+        if entry.address is not None:
+            self._discard(self._hosts, entry.address[0], entry.node_id)
+        entry.service = None
+        entry.tags = ()
+        entry.address = None
+
+    def _discard(self, index, key, node_id):
+        node_ids = index.get(key)
+        if node_ids is not None:
+            node_ids.discard(node_id)
+            if not node_ids:
+                del index[key]
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+import binascii
+import logging
+
+import tornado.ioloop
+import tornado.iostream
+import tornado.tcpclient
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from .common import Command, Status, Event
+from .protocol import Framing, new_header_buffer, pack_frame, read_frame
+from .codec import DEFAULT_CODEC, CODECS, CompactCodec, JsonCodec, encode_payload, decode_payload
+
+LOG = logging.getLogger(__name__)
+
+
+def entry_event(entry, event_type = Event.added):
+    return {"revision": entry.revision, "type": event_type, "node_id": entry.node_id, "info": dict(entry.info)}
+
+
+class PeerLink(object):
+    '''
+    outbound REPLICATE stream to one peer listener, pushes the nodes connected
+    to this listener: a full reset on connect and on request, then batches of
+    events and periodic digests
+    '''
+    def __init__(self, replicator, host, port, retry_interval = 1,
+                 codecs = (JsonCodec.name, CompactCodec.name)):
+        self.replicator = replicator
+        self.host = host
+        self.port = port
+        self.retry_interval = retry_interval
+        self.codecs = list(codecs)
+        self.tcpclient = tornado.tcpclient.TCPClient()
+        self.connected = False
+        self._closed = False
+        self._stream = None
+        self._framing = Framing.delimiter
+        self._codec = DEFAULT_CODEC
+        self._header_buffer = new_header_buffer()
+
+    @gen.coroutine
+    def connect(self):
+        if self._closed:
+            return
+        try:
+            stream = yield self.tcpclient.connect(self.host, self.port)
+        except Exception as e:
+            LOG.debug("Connect to Peer(%s:%s) failed: %s", self.host, self.port, e)
+            IOLoop.current().call_later(self.retry_interval, self.connect)
+            return
+        self._stream = stream
+        self._framing = Framing.delimiter
+        self._codec = DEFAULT_CODEC
+        self.send_reset()
+        self.connected = True
+        LOG.info("Peer(%s:%s) connected", self.host, self.port)
+        try:
+            while True:
+                data = yield self.read_message()
+                if data.get("framing") == Framing.binary:
+                    self._framing = Framing.binary
+                    self._codec = CODECS.get(data.get("codec"), DEFAULT_CODEC)
+                if data["command"] != Command.replicate:
+                    LOG.error("Peer(%s:%s) Received Message: %s", self.host, self.port, data)
+                    break
+                if data["data"]["status"] == Status.resync:
+                    LOG.info("Peer(%s:%s) asks for resync", self.host, self.port)
+                    self.send_reset()
+        except tornado.iostream.StreamClosedError:
+            pass
+        except Exception as e:
+            LOG.exception(e)
+        self.connected = False
+        stream.close()
+        LOG.info("Peer(%s:%s) closed", self.host, self.port)
+        IOLoop.current().call_later(self.retry_interval, self.connect)
+
+    @gen.coroutine
+    def read_message(self):
+        data = {"command": Command.error, "data": "Peer received wrong message!"}
+        payload, flags = yield read_frame(self._stream, self._header_buffer)
+        if payload is not None:
+            data = decode_payload(payload, flags)
+        raise gen.Return(data)
+
+    def send_message(self, data):
+        try:
+            payload, flags = encode_payload(data, self._codec)
+            self._stream.write(pack_frame(payload, self._framing, flags))
+        except tornado.iostream.StreamClosedError:
+            pass
+        except Exception as e:
+            LOG.exception(e)
+
+    def send_reset(self):
+        self.send_message({
+            "command": Command.replicate,
+            "data": {
+                "origin": self.replicator.origin,
+                "reset": True,
+                "events": [entry_event(entry) for entry in self.replicator.local_entries()],
+            },
+            "framing": [Framing.binary],
+            "codecs": self.codecs,
+        })
+
+    def send_events(self, events):
+        self.send_message({
+            "command": Command.replicate,
+            "data": {"origin": self.replicator.origin, "events": events},
+        })
+
+    def send_digest(self, digest):
+        self.send_message({
+            "command": Command.replicate,
+            "data": {"origin": self.replicator.origin, "digest": digest},
+        })
+
+    def close(self):
+        self._closed = True
+        if self._stream:
+            self._stream.close()
+        self.tcpclient.close()
+
+
+class Replicator(object):
+    '''
+    replicate the registry between listeners, every listener pushes the nodes
+    connected to it to all peers (full mesh) over the REPLICATE command.
+    replicated nodes are registered without connection with origin set to the
+    peer's id, a node connected here always wins over a replicated copy, the
+    copy is kept and restored when the node leaves this listener.
+    anti-entropy: every sync_interval a digest of the pushed nodes is sent,
+    a peer holding a different state asks for a full reset.
+    nodes of a lost peer are removed after peer_grace seconds unless it comes back.
+    '''
+    def __init__(self, registry, peers, sync_interval = 10, peer_grace = 30, retry_interval = 1):
+        self.registry = registry
+        self.origin = registry.epoch
+        self.sync_interval = sync_interval
+        self.peer_grace = peer_grace
+        self.links = [PeerLink(self, host, port, retry_interval = retry_interval) for host, port in peers]
+        self.periodic_digest = None
+        self._outgoing = []
+        self._shadows = {} # node_id: (origin, revision, info), peer copies of nodes connected here
+        self._expiry = {} # origin: timeout handle
+
+    def start(self):
+        self.registry.subscribe(self._on_registry_event)
+        for link in self.links:
+            IOLoop.current().add_callback(link.connect)
+        self.periodic_digest = tornado.ioloop.PeriodicCallback(self._send_digests, self.sync_interval * 1000)
+        self.periodic_digest.start()
+        LOG.info("Replicator(%s) start, peers: %s", self.origin, [(link.host, link.port) for link in self.links])
+
+    def stop(self):
+        self.registry.unsubscribe(self._on_registry_event)
+        if self.periodic_digest:
+            self.periodic_digest.stop()
+        for link in self.links:
+            link.close()
+
+    def local_entries(self):
+        return [entry for entry in self.registry if entry.connection is not None]
+
+    def digest(self, origin = None):
+        '''
+        digest of the nodes connected here, or of the nodes replicated from origin
+        '''
+        if origin is None:
+            items = [(entry.node_id, entry.revision) for entry in self.local_entries()]
+        else:
+            items = [(entry.node_id, entry.origin_revision) for entry in self.registry
+                     if entry.origin == origin and entry.connection is None]
+            items.extend((node_id, revision) for node_id, (o, revision, _) in self._shadows.items() if o == origin)
+        items.sort()
+        checksum = binascii.crc32("\n".join("%s:%s" % item for item in items).encode("utf-8")) & 0xffffffff
+        return {"count": len(items), "checksum": checksum}
+
+    def apply(self, origin, data):
+        '''
+        apply a REPLICATE message received from peer origin, return the reply status
+        '''
+        self._cancel_expiry(origin)
+        if "events" in data:
+            if data.get("reset"):
+                node_ids = set(event["node_id"] for event in data["events"])
+                for entry in self.registry:
+                    if entry.origin == origin and entry.node_id not in node_ids:
+                        self.registry.remove(entry.node_id, origin = origin)
+                for node_id in list(self._shadows.keys()):
+                    if self._shadows[node_id][0] == origin and node_id not in node_ids:
+                        del self._shadows[node_id]
+            for event in data["events"]:
+                self._apply_event(origin, event)
+        if "digest" in data and data["digest"] != self.digest(origin):
+            return Status.resync
+        return Status.success
+
+    def peer_lost(self, origin):
+        self._cancel_expiry(origin)
+        self._expiry[origin] = IOLoop.current().call_later(self.peer_grace, self._expire_origin, origin)
+
+    def _apply_event(self, origin, event):
+        node_id = event["node_id"]
+        entry = self.registry.get(node_id)
+        if entry is not None and entry.connection is not None:
+            if event["type"] == Event.removed:
+                if node_id in self._shadows and self._shadows[node_id][0] == origin:
+                    del self._shadows[node_id]
+            else:
+                self._shadows[node_id] = (origin, event["revision"], event["info"])
+            return
+        if event["type"] == Event.removed:
+            self.registry.remove(node_id, origin = origin)
+        else:
+            entry = self.registry.register(node_id, event["info"], origin = origin)
+            entry.origin_revision = event["revision"]
+
+    def _on_registry_event(self, event):
+        if not event.local:
+            return
+        if not self._outgoing:
+            IOLoop.current().add_callback(self._flush)
+        self._outgoing.append({"revision": event.revision, "type": event.type, "node_id": event.node_id, "info": dict(event.info)})
+        if event.type == Event.removed and event.node_id in self._shadows:
+            IOLoop.current().add_callback(self._restore, event.node_id)
+
+    def _restore(self, node_id):
+        if node_id in self._shadows and node_id not in self.registry:
+            origin, revision, info = self._shadows.pop(node_id)
+            entry = self.registry.register(node_id, info, origin = origin)
+            entry.origin_revision = revision
+
+    def _flush(self):
+        events, self._outgoing = self._outgoing, []
+        if events:
+            for link in self.links:
+                if link.connected:
+                    link.send_events(events)
+
+    def _send_digests(self):
+        digest = self.digest()
+        for link in self.links:
+            if link.connected:
+                link.send_digest(digest)
+
+    def _cancel_expiry(self, origin):
+        handle = self._expiry.pop(origin, None)
+        if handle is not None:
+            IOLoop.current().remove_timeout(handle)
+
+    def _expire_origin(self, origin):
+        self._expiry.pop(origin, None)
+        expired = 0
+        for entry in self.registry:
+            if entry.origin == origin and self.registry.remove(entry.node_id, origin = origin):
+                expired += 1
+        for node_id in list(self._shadows.keys()):
+            if self._shadows[node_id][0] == origin:
+                del self._shadows[node_id]
+        LOG.warning("Peer(%s) lost, removed %s nodes", origin, expired)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import random
+import logging
+
+from tornado.ioloop import IOLoop
+
+from .common import Event
+from .watcher import BaseWatcher
+
+LOG = logging.getLogger(__name__)
+
+
+class Strategy(object):
+    round_robin = "ROUND_ROBIN"
+    random = "RANDOM"
+    least_loaded = "LEAST_LOADED"
+    power_of_two = "POWER_OF_TWO"
+
+
+class Resolver(BaseWatcher):
+    '''
+    resolve a service to one of its live nodes from a local cache kept fresh
+    by the listener's WATCH stream, no network round trip per call.
+    least_loaded and power_of_two compare info[load_key] sent by the
+    registrants in their heartbeats, nodes without it count as load 0.
+    when the watch stream is lost the cache is served for ttl seconds
+    (forever if ttl is None), then resolve returns None until it resyncs.
+    '''
+    def __init__(self, host, port, service = None, strategy = Strategy.round_robin,
+                 load_key = "load", ttl = None, **kwargs):
+        BaseWatcher.__init__(self, host, port, service = service, **kwargs)
+        self.strategy = strategy
+        self.load_key = load_key
+        self.ttl = ttl
+        self._members = {} # service: set(node_id)
+        self._node_services = {} # node_id: service
+        self._candidates = {} # service: tuple(info), rebuilt when dirty
+        self._counters = {}
+
+    def on_event(self, event_type, node_id, info):
+        previous_service = self._node_services.pop(node_id, None)
+        if previous_service is not None or node_id in self._members.get(None, ()):
+            self._leave(previous_service, node_id)
+        if event_type != Event.removed:
+            service = info.get("service")
+            self._node_services[node_id] = service
+            self._members.setdefault(service, set()).add(node_id)
+            self._members.setdefault(None, set()).add(node_id)
+            self._candidates.pop(service, None)
+            self._candidates.pop(None, None)
+
+    def nodes_of(self, service = None):
+        if self.ttl is not None and self.lost_time is not None:
+            if IOLoop.current().time() - self.lost_time > self.ttl:
+                return ()
+        candidates = self._candidates.get(service)
+        if candidates is None:
+            candidates = tuple(self.nodes[node_id] for node_id in sorted(self._members.get(service, ())))
+            self._candidates[service] = candidates
+        return candidates
+
+    def resolve(self, service = None, strategy = None):
+        '''
+        return the info of the chosen node or None
+        '''
+        if service is None:
+            service = self.service
+        candidates = self.nodes_of(service)
+        if not candidates:
+            return None
+        strategy = strategy or self.strategy
+        if strategy == Strategy.round_robin:
+            n = self._counters.get(service, 0)
+            self._counters[service] = n + 1
+            return candidates[n % len(candidates)]
+        if strategy == Strategy.random:
+            return random.choice(candidates)
+        if strategy == Strategy.least_loaded:
+            return min(candidates, key = self._load)
+        if strategy == Strategy.power_of_two:
+            if len(candidates) == 1:
+                return candidates[0]
+            a, b = random.sample(candidates, 2)
+            return a if self._load(a) <= self._load(b) else b
+        raise ValueError("unknown strategy: %s" % strategy)
+
+    def resolve_address(self, service = None, strategy = None):
+        '''
+        return (http_host, http_port) of the chosen node or None
+        '''
+        info = self.resolve(service, strategy)
+        if info is None:
+            return None
+        return info.get("http_host"), info.get("http_port")
+
+    def _load(self, info):
+        return info.get(self.load_key) or 0
+
+    def _leave(self, service, node_id):
+        for key in (service, None):
+            members = self._members.get(key)
+            if members is not None:
+                members.discard(node_id)
+                if not members:
+                    del self._members[key]
+            self._candidates.pop(key, None)
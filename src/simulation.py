@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+import random
+import asyncio
+import logging
+import itertools
+import selectors
+from collections import deque
+
+import tornado.iostream
+from tornado import gen
+from tornado.concurrent import Future, future_set_result_unless_cancelled, future_set_exception_unless_cancelled
+from tornado.ioloop import IOLoop
+from tornado.platform.asyncio import BaseAsyncIOLoop
+
+from .listener import BaseListener
+
+LOG = logging.getLogger(__name__)
+
+FILENOS = itertools.count(1 << 20) # fake file descriptors, above any real one
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    '''
+    the selector of VirtualClockLoop: when nothing is ready it doesn't wait,
+    it moves the loop's clock to the next timer
+    '''
+    def __init__(self):
+        selectors.DefaultSelector.__init__(self)
+        self.loop = None
+
+    def select(self, timeout = None):
+        events = selectors.DefaultSelector.select(self, 0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # no timer at all, only real I/O can wake the loop
+            return selectors.DefaultSelector.select(self, timeout)
+        self.loop.advance(timeout)
+        return []
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    '''
+    asyncio loop on a virtual clock, time only moves when every ready callback
+    ran, straight to the next timer, so hours of timers run in the cpu time of
+    their callbacks. IOLoop.time() and everything scheduled with it follow the clock.
+    '''
+    def __init__(self, start = 0.0):
+        selector = VirtualSelector()
+        asyncio.SelectorEventLoop.__init__(self, selector)
+        selector.loop = self
+        self._now = start
+
+    def time(self):
+        return self._now
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self._now += seconds
+
+
+class VirtualIOLoop(BaseAsyncIOLoop):
+    '''
+    the IOLoop of a VirtualClockLoop, IOLoop.time() is time.time() otherwise
+    '''
+    def time(self):
+        return self.asyncio_loop.time()
+
+
+class MemoryStream(object):
+    '''
+    in-memory stand-in for an IOStream connected to its peer, the bytes written
+    are readable by the peer latency seconds later and in order, closing it
+    closes the peer once the bytes in flight are delivered.
+    it implements what the listener and the registrants use of an IOStream
+    '''
+    def __init__(self, io_loop, latency = 0.0):
+        self.io_loop = io_loop
+        self.latency = latency
+        self.peer = None
+        self.socket = None
+        self.error = None
+        self._buffer = bytearray()
+        self._in_flight = deque() # (deliver_at, bytes or None for the close), written not delivered
+        self._read = None # (kind, argument, future)
+        self._closed = False
+        self._close_callback = None
+        self._fileno = next(FILENOS)
+
+    def fileno(self):
+        return self._fileno
+
+    def closed(self):
+        return self._closed
+
+    def reading(self):
+        return self._read is not None
+
+    def writing(self):
+        return bool(self._in_flight)
+
+    def set_close_callback(self, callback):
+        self._close_callback = callback
+
+    def write(self, data):
+        if self._closed:
+            raise tornado.iostream.StreamClosedError()
+        self._send(bytes(data))
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def read_into(self, buf, partial = False):
+        return self._start_read("into", buf)
+
+    def read_bytes(self, num_bytes, partial = False):
+        return self._start_read("bytes", num_bytes)
+
+    def read_until(self, delimiter, max_bytes = None):
+        return self._start_read("until", delimiter)
+
+    def close(self, exc_info = False):
+        if self._closed:
+            return
+        self._closed = True
+        self._send(None)
+        if self._read is not None:
+            future = self._read[2]
+            self._read = None
+            future_set_exception_unless_cancelled(future, tornado.iostream.StreamClosedError())
+        if self._close_callback is not None:
+            callback, self._close_callback = self._close_callback, None
+            self.io_loop.add_callback(callback)
+
+    def _send(self, data):
+        deliver_at = self.io_loop.time() + self.latency
+        self._in_flight.append((deliver_at, data))
+        if self.latency:
+            self.io_loop.call_at(deliver_at, self._deliver)
+        else:
+            self.io_loop.add_callback(self._deliver)
+
+    def _deliver(self):
+        # timers due at the same time may run in any order, the bytes are delivered in order
+        now = self.io_loop.time()
+        while self._in_flight and self._in_flight[0][0] <= now:
+            _, data = self._in_flight.popleft()
+            if data is None:
+                self.peer.close()
+            elif not self.peer._closed:
+                self.peer._buffer.extend(data)
+                self.peer._try_read()
+
+    def _start_read(self, kind, argument):
+        if self._read is not None:
+            raise RuntimeError("Already reading")
+        future = Future()
+        self._read = (kind, argument, future)
+        if not self._try_read() and self._closed:
+            self._read = None
+            raise tornado.iostream.StreamClosedError()
+        return future
+
+    def _try_read(self):
+        if self._read is None:
+            return False
+        kind, argument, future = self._read
+        if kind == "until":
+            position = self._buffer.find(argument)
+            if position < 0:
+                return False
+            size = position + len(argument)
+        else:
+            size = len(argument) if kind == "into" else argument
+            if len(self._buffer) < size:
+                return False
+        self._read = None
+        if kind == "into":
+            argument[:] = self._buffer[:size]
+            result = size
+        else:
+            result = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        future_set_result_unless_cancelled(future, result)
+        return True
+
+
+def memory_stream_pair(io_loop, latency = 0.0):
+    client = MemoryStream(io_loop, latency)
+    server = MemoryStream(io_loop, latency)
+    client.peer = server
+    server.peer = client
+    return client, server
+
+
+class SimulatedClient(object):
+    '''
+    the tcpclient of a registrant in a SimulatedNetwork
+    '''
+    def __init__(self, network, host):
+        self.network = network
+        self.host = host
+
+    @gen.coroutine
+    def connect(self, host, port, **kwargs):
+        stream = yield self.network.connect(self.host, host, port)
+        raise gen.Return(stream)
+
+    def close(self):
+        pass
+
+
+class SimulatedNetwork(object):
+    '''
+    listeners bound to (host, port) and the registrants connecting to them
+    over MemoryStreams, a connect takes one round trip of latency, it is refused
+    when nothing is bound
+    '''
+    def __init__(self, latency = 0.0):
+        self.latency = latency
+        self._listeners = {} # (host, port): listener
+        self._streams = {} # (host, port): {accepted MemoryStream: None}, ordered as accepted
+        self._ports = itertools.count(1024)
+
+    def bind(self, listener, host, port):
+        self._listeners[(host, port)] = listener
+        self._streams[(host, port)] = {}
+
+    def unbind(self, host, port):
+        '''
+        stop accepting on (host, port) and drop its connections, as a listener process exiting
+        '''
+        self._listeners.pop((host, port), None)
+        # in the order they were accepted, a set of streams would close them in a different order every run
+        for stream in list(self._streams.pop((host, port), ())):
+            stream.close()
+
+    def client(self, host):
+        return SimulatedClient(self, host)
+
+    @gen.coroutine
+    def connect(self, client_host, host, port):
+        if self.latency:
+            yield gen.sleep(self.latency * 2)
+        listener = self._listeners.get((host, port))
+        if listener is None:
+            raise tornado.iostream.StreamClosedError()
+        client, server = memory_stream_pair(IOLoop.current(), self.latency)
+        streams = self._streams[(host, port)]
+        streams[server] = None
+        listener.handle_stream(server, (client_host, next(self._ports)))
+        # forget the server side once closed, the connection owns the close callback
+        callback = server._close_callback
+
+        def on_close():
+            streams.pop(server, None)
+            if callback is not None:
+                callback()
+        server._close_callback = on_close
+        raise gen.Return(client)
+
+
+class TracedConnection(object):
+    '''
+    mixed into the connection class of a simulated listener, it records how
+    late a heartbeat timeout removed a node: the removal time minus the last
+    renewal plus its ttl, at most one timing wheel tick in theory
+    '''
+    simulation = None
+
+    def _renew(self):
+        self._renewed_at = IOLoop.current().time()
+        super(TracedConnection, self)._renew()
+
+    def _remove_connection(self):
+        renewed_at = getattr(self, "_renewed_at", None)
+        if renewed_at is not None and "node_id" in self.info:
+            ttl = (self._lease or (self.info["heartbeat_timeout"], None))[0]
+            self.simulation.timeouts.append((self.info["node_id"], IOLoop.current().time() - renewed_at - ttl))
+        super(TracedConnection, self)._remove_connection()
+
+
+class Simulation(object):
+    '''
+    deterministic runs of listeners and registrants on a VirtualClockLoop and a
+    SimulatedNetwork, the registrants' jitter is drawn from self.random, seeded
+    with seed, the global random isn't touched. scenarios are coroutines run
+    with run(), they sleep in virtual time:
+
+        simulation = Simulation(seed = 1)
+        def scenario():
+            listener = simulation.listener(BaseConnection, "listener", 8000)
+            registrant = simulation.registrant(BaseRegistrant, "node-1", "listener", 8000, config)
+            registrant.connect()
+            yield gen.sleep(600)
+        simulation.run(gen.coroutine(scenario))
+    '''
+    def __init__(self, seed = 0, latency = 0.001, start = 0.0):
+        self.random = random.Random(seed)
+        self.loop = VirtualClockLoop(start = start)
+        self.io_loop = VirtualIOLoop(asyncio_loop = self.loop, make_current = False)
+        self.network = SimulatedNetwork(latency = latency)
+        self.timeouts = [] # (node_id, seconds late) of the heartbeat timeouts
+
+    @property
+    def now(self):
+        return self.loop.time()
+
+    def run(self, scenario, *args, **kwargs):
+        '''
+        run scenario(*args, **kwargs) until it returns, return its result
+        '''
+        asyncio.set_event_loop(self.loop)
+
+        async def main():
+            return await scenario(*args, **kwargs)
+        try:
+            return self.loop.run_until_complete(main())
+        finally:
+            asyncio.set_event_loop(None)
+
+    def close(self):
+        self.io_loop.close()
+
+    def listener(self, connection_cls, host, port, listener_cls = BaseListener, **kwargs):
+        '''
+        a listener_cls bound to (host, port) in the network, its connection class
+        is connection_cls with TracedConnection mixed in
+        '''
+        traced = type("Traced" + connection_cls.__name__, (TracedConnection, connection_cls), {"simulation": self})
+        listener = listener_cls(traced, **kwargs)
+        self.network.bind(listener, host, port)
+        return listener
+
+    def stop_listener(self, host, port):
+        self.network.unbind(host, port)
+
+    def registrant(self, registrant_cls, client_host, host, port, config, **kwargs):
+        '''
+        a registrant_cls of client_host connecting through the network, start it with connect()
+        '''
+        registrant = registrant_cls(host, port, config, **kwargs)
+        registrant.tcpclient = self.network.client(client_host)
+        registrant.random = self.random
+        return registrant
+
+    @gen.coroutine
+    def wait_until(self, predicate, timeout, step = 0.1):
+        '''
+        return the virtual seconds until predicate() is true, None if it's still false after timeout
+        '''
+        start = self.now
+        while not predicate():
+            if self.now - start >= timeout:
+                raise gen.Return(None)
+            yield gen.sleep(step)
+        raise gen.Return(self.now - start)
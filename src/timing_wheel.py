@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import tornado.ioloop
+from tornado.ioloop import IOLoop
+
+LOG = logging.getLogger(__name__)
+
+
+class TimingWheel(object):
+    '''
+    coarse-grained hashed timing wheel, keys expire at most one tick after
+    their deadline. refreshing a deadline only updates the entry, it is moved
+    to the right slot lazily when its old slot is swept.
+    '''
+    _instances = {} # (IOLoop, tick): the shared TimingWheel
+
+    def __init__(self, tick = 1.0, slots = 512):
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._entries = {} # key: [deadline, callback, slot_tick]
+        self._last_tick = None
+        self._periodic_sweep = None
+
+    @classmethod
+    def instance(cls, tick = 1.0, slots = 512):
+        '''
+        the wheel of tick shared on the current IOLoop, it sweeps on that loop only
+        '''
+        key = (IOLoop.current(), tick)
+        wheel = cls._instances.get(key)
+        if wheel is None:
+            # forget the wheels of closed loops, e.g. of an earlier asyncio.run()
+            for closed in [k for k in cls._instances if k[0].asyncio_loop.is_closed()]:
+                cls._instances.pop(closed).stop()
+            wheel = cls._instances[key] = cls(tick = tick, slots = slots)
+        return wheel
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def start(self):
+        if self._periodic_sweep is None:
+            self._last_tick = int(IOLoop.current().time() / self.tick)
+            self._periodic_sweep = tornado.ioloop.PeriodicCallback(self.sweep, self.tick * 1000)
+            self._periodic_sweep.start()
+
+    def stop(self):
+        if self._periodic_sweep:
+            self._periodic_sweep.stop()
+            self._periodic_sweep = None
+
+    def schedule(self, key, deadline, callback):
+        '''
+        add key or refresh its deadline, callback is called without arguments on expiry
+        '''
+        if self._periodic_sweep is None:
+            self.start()
+        entry = self._entries.get(key)
+        if entry is not None and deadline >= entry[0]:
+            entry[0] = deadline
+            entry[1] = callback
+        else:
+            if entry is not None:
+                self._slots[entry[2] % len(self._slots)].discard(key)
+            slot_tick = max(int(deadline / self.tick), self._last_tick + 1)
+            self._entries[key] = [deadline, callback, slot_tick]
+            self._slots[slot_tick % len(self._slots)].add(key)
+
+    def cancel(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._slots[entry[2] % len(self._slots)].discard(key)
+
+    def sweep(self, now = None):
+        if now is None:
+            now = IOLoop.current().time()
+        if self._last_tick is None:
+            self._last_tick = int(now / self.tick)
+        current_tick = int(now / self.tick)
+        first_tick = max(self._last_tick + 1, current_tick - len(self._slots) + 1)
+        expired = []
+        for t in range(first_tick, current_tick + 1):
+            slot = self._slots[t % len(self._slots)]
+            for key in list(slot):
+                entry = self._entries[key]
+                if entry[2] > t and entry[2] > current_tick:
+                    continue # due in a later round
+                slot.discard(key)
+                if entry[0] <= now:
+                    del self._entries[key]
+                    expired.append(entry[1])
+                else:
+                    entry[2] = max(int(entry[0] / self.tick), current_tick + 1)
+                    self._slots[entry[2] % len(self._slots)].add(key)
+        self._last_tick = current_tick
+        for callback in expired:
+            try:
+                callback()
+            except Exception as e:
+                LOG.exception(e)
+        return len(expired)
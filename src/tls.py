@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import ssl
+import logging
+
+import tornado.iostream
+import tornado.netutil
+
+LOG = logging.getLogger(__name__)
+
+
+def server_context(ssl_options):
+    '''
+    one SSLContext for every connection of a listener, Tornado builds a new
+    context per connection from a dict, which loses its session cache and
+    ticket keys, so no session could be resumed
+    '''
+    if ssl_options is None or isinstance(ssl_options, ssl.SSLContext):
+        return ssl_options
+    return tornado.netutil.ssl_options_to_context(ssl_options, server_side = True)
+
+
+def client_context(ssl_options):
+    '''
+    the SSLContext of a registrant, True for the default one verifying the listener's certificate
+    '''
+    if ssl_options is None or isinstance(ssl_options, ssl.SSLContext):
+        return ssl_options
+    if ssl_options is True:
+        return ssl.create_default_context()
+    return tornado.netutil.ssl_options_to_context(ssl_options, server_side = False)
+
+
+def start_tls(stream, context, server_hostname = None, session = None):
+    '''
+    IOStream.start_tls resuming session, an ssl.SSLSession of an earlier connection
+    to the same listener. the returned SSLIOStream is handshaking, wait for it
+    with wait_for_handshake(), then socket.session_reused tells if it was resumed.
+    a session the listener doesn't know anymore falls back to a full handshake.
+    '''
+    sock = stream.socket
+    stream.io_loop.remove_handler(sock)
+    stream.socket = None
+    ssl_socket = context.wrap_socket(
+        sock, server_hostname = server_hostname, do_handshake_on_connect = False, session = session
+    )
+    return tornado.iostream.SSLIOStream(
+        ssl_socket, max_buffer_size = stream.max_buffer_size, read_chunk_size = stream.read_chunk_size
+    )
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+import os
+import hmac
+import errno
+import socket
+import struct
+import hashlib
+import logging
+
+from tornado.ioloop import IOLoop
+
+from .common import Event
+from .metrics import METRICS
+from .timing_wheel import TimingWheel
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b"TD"
+VERSION = 1
+HEADER = struct.Struct("!2sBQB") # magic, version, seq, node_id length
+TAG_SIZE = 16
+MAX_DATAGRAM = HEADER.size + 255 + TAG_SIZE
+
+
+class DatagramError(Exception):
+    pass
+
+
+def node_key(secret, node_id):
+    '''
+    the key a node signs its heartbeats with, derived from the listener's secret
+    so the listener doesn't store one per node
+    '''
+    return hmac.new(secret, node_id.encode("utf-8"), hashlib.sha256).digest()
+
+
+def pack_heartbeat(node_id, seq, key):
+    node_id = node_id.encode("utf-8")
+    data = HEADER.pack(MAGIC, VERSION, seq, len(node_id)) + node_id
+    return data + hmac.new(key, data, hashlib.sha256).digest()[:TAG_SIZE]
+
+
+def unpack_heartbeat(datagram):
+    '''
+    return (node_id, seq, signed bytes, tag) of a heartbeat datagram
+    '''
+    if len(datagram) < HEADER.size + TAG_SIZE:
+        raise DatagramError("short datagram: %s bytes" % len(datagram))
+    magic, version, seq, length = HEADER.unpack_from(datagram)
+    if magic != MAGIC or version != VERSION:
+        raise DatagramError("unknown datagram: %r %s" % (bytes(magic), version))
+    end = HEADER.size + length
+    if len(datagram) != end + TAG_SIZE:
+        raise DatagramError("bad datagram length: %s" % len(datagram))
+    return bytes(datagram[HEADER.size:end]).decode("utf-8"), seq, datagram[:end], bytes(datagram[end:])
+
+
+class UdpTarget(object):
+    __slots__ = ("connection", "key", "heartbeat_interval", "last_seq", "received", "lost", "callback")
+
+    def __init__(self, connection, key, heartbeat_interval):
+        self.connection = connection
+        self.key = key
+        self.heartbeat_interval = heartbeat_interval
+        self.last_seq = 0
+        self.received = 0 # heartbeats received in the current loss window
+        self.lost = 0 # sequence numbers skipped in the current loss window
+        self.callback = None
+
+
+class HeartbeatReceiver(object):
+    '''
+    liveness heartbeats of registered nodes over UDP, registration and info
+    changes stay on their TCP connection.
+    a node registering with "udp" is granted the port and a key, it then sends
+    datagrams of its node_id, an increasing seq and a truncated HMAC-SHA256 tag,
+    each valid one renews the node like a TCP heartbeat. the socket is drained up
+    to batch datagrams per readable event.
+    the loss is measured on seq gaps over window heartbeats, above loss_threshold,
+    or without any datagram for silence heartbeat intervals, the node is told to
+    heartbeat over TCP again with a FALLBACK message on its connection.
+    '''
+    def __init__(self, registry, port, address = "", secret = None, loss_threshold = 0.2, window = 20,
+                 silence = 3, batch = 64, receive_buffer = 4 * 1024 * 1024, tick = 0.5, metrics = METRICS):
+        self.registry = registry
+        self.secret = secret or os.urandom(32)
+        self.loss_threshold = loss_threshold
+        self.window = window
+        self.silence = silence
+        self.batch = batch
+        self._targets = {} # node_id: UdpTarget
+        self._timing_wheel = TimingWheel(tick = tick)
+        self._io_loop = None
+        self._buffer = bytearray(MAX_DATAGRAM + 1)
+        family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        try:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        except socket.error as e:
+            LOG.warning("UDP receive buffer: %s", e)
+        self._socket.bind((address, port))
+        self.port = self._socket.getsockname()[1]
+        self._datagrams = dict(
+            (result, metrics.counter("discovery_listener_udp_datagrams_total", "heartbeat datagrams received", {"result": result}))
+            for result in ("accepted", "malformed", "unknown", "bad_tag", "replayed")
+        )
+        self._reads = metrics.counter("discovery_listener_udp_reads_total", "readable events of the heartbeat socket")
+        self._lost = metrics.counter("discovery_listener_udp_lost_total", "heartbeat datagrams missing from the sequence")
+        self._fallbacks = metrics.counter("discovery_listener_udp_fallbacks_total", "nodes sent back to TCP heartbeats")
+        self._grants = metrics.counter("discovery_listener_udp_grants_total", "UDP heartbeats granted, at registration or after a fallback")
+
+    def start(self):
+        if self._io_loop is None:
+            self._io_loop = IOLoop.current()
+            self._io_loop.add_handler(self._socket.fileno(), self._on_readable, IOLoop.READ)
+            self.registry.subscribe(self._on_registry_event)
+            LOG.info("UDP heartbeats on port %s", self.port)
+
+    def stop(self):
+        if self._io_loop is not None:
+            self._io_loop.remove_handler(self._socket.fileno())
+            self._io_loop = None
+        self.registry.unsubscribe(self._on_registry_event)
+        self._timing_wheel.stop()
+        self._targets.clear()
+        self._socket.close()
+
+    def grant(self, node_id, connection, heartbeat_interval):
+        '''
+        accept UDP heartbeats of node_id renewing connection, return what the node needs to send them
+        '''
+        self._grants.inc()
+        target = UdpTarget(connection, node_key(self.secret, node_id), heartbeat_interval)
+        target.callback = lambda: self._on_silence(node_id, target)
+        self._targets[node_id] = target
+        # the first heartbeat after the registration may still go over TCP
+        self._expect(node_id, target, self.silence + 1)
+        return {"port": self.port, "key": target.key.hex()}
+
+    def revoke(self, node_id):
+        if self._targets.pop(node_id, None) is not None:
+            self._timing_wheel.cancel(node_id)
+
+    def _expect(self, node_id, target, intervals):
+        self._timing_wheel.schedule(
+            node_id, IOLoop.current().time() + target.heartbeat_interval * intervals, target.callback
+        )
+
+    def _on_readable(self, fd, events):
+        self._reads.inc()
+        self._drain()
+
+    def _drain(self):
+        view = memoryview(self._buffer)
+        for _ in range(self.batch):
+            try:
+                size, address = self._socket.recvfrom_into(self._buffer)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    LOG.warning("UDP receive: %s", e)
+                return
+            try:
+                self._on_datagram(view[:size])
+            except Exception as e:
+                LOG.exception(e)
+
+    def _on_datagram(self, datagram):
+        try:
+            node_id, seq, signed, tag = unpack_heartbeat(datagram)
+        except (DatagramError, struct.error, UnicodeDecodeError) as e:
+            self._datagrams["malformed"].inc()
+            LOG.debug("UDP heartbeat dropped: %s", e)
+            return
+        target = self._targets.get(node_id)
+        if target is None:
+            self._datagrams["unknown"].inc()
+            return
+        if not hmac.compare_digest(hmac.new(target.key, signed, hashlib.sha256).digest()[:TAG_SIZE], tag):
+            self._datagrams["bad_tag"].inc()
+            return
+        if seq <= target.last_seq:
+            # replayed or reordered, it isn't counted as a renewal
+            self._datagrams["replayed"].inc()
+            return
+        self._datagrams["accepted"].inc()
+        lost = seq - target.last_seq - 1
+        target.last_seq = seq
+        target.received += 1
+        if lost:
+            target.lost += lost
+            self._lost.inc(lost)
+        target.connection._udp_heartbeat()
+        self._expect(node_id, target, self.silence)
+        total = target.received + target.lost
+        if total >= self.window:
+            loss = target.lost / float(total)
+            target.received = target.lost = 0
+            if loss > self.loss_threshold:
+                self._fallback(node_id, target, loss)
+
+    def _on_silence(self, node_id, target):
+        if self._targets.get(node_id) is not target:
+            return
+        # a busy loop may not have read the socket yet
+        seq = target.last_seq
+        self._drain()
+        if target.last_seq == seq and self._targets.get(node_id) is target:
+            self._fallback(node_id, target, 1.0)
+
+    def _fallback(self, node_id, target, loss):
+        LOG.warning("Node(%s) UDP heartbeat loss %.2f, fallback to TCP", node_id, loss)
+        self._fallbacks.inc()
+        self.revoke(node_id)
+        target.connection._udp_fallback(loss)
+
+    def _on_registry_event(self, event):
+        if event.type == Event.removed:
+            self.revoke(event.node_id)
+
+
+class HeartbeatSender(object):
+    '''
+    registrant side of the UDP heartbeats, sends to the listener address of the
+    TCP connection the port and key granted at registration
+    '''
+    def __init__(self, address, grant):
+        self.key = bytes.fromhex(grant["key"])
+        self.address = (address[0], grant["port"])
+        self.seq = 0
+        self._socket = socket.socket(socket.AF_INET6 if ":" in address[0] else socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def send(self, node_id):
+        '''
+        return False if the datagram couldn't be queued
+        '''
+        self.seq += 1
+        try:
+            self._socket.sendto(pack_heartbeat(node_id, self.seq, self.key), self.address)
+            return True
+        except (socket.error, struct.error) as e:
+            LOG.debug("UDP heartbeat not sent: %s", e)
+            return False
+
+    def close(self):
+        self._socket.close()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import tornado
+import tornado.iostream
+import tornado.tcpclient
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from .common import Command, Status, Event
+from .protocol import Framing, new_header_buffer, pack_frame, read_frame
+from .codec import DEFAULT_CODEC, CODECS, CompactCodec, JsonCodec, encode_payload, decode_payload
+
+LOG = logging.getLogger(__name__)
+
+
+class BaseWatcher(object):
+    '''
+    keep a local copy of the listener's live nodes, optionally only of one service,
+    updated by pushed ADDED/UPDATED/REMOVED events. after a reconnect the watch
+    resumes from the last seen revision. override on_event to react to changes.
+    '''
+    def __init__(self, host, port, service = None, retry_interval = 10, reconnect = True,
+                 codecs = (JsonCodec.name, CompactCodec.name)):
+        self.host = host
+        self.port = port
+        self.service = service
+        self.retry_interval = retry_interval
+        self.reconnect = reconnect
+        self.codecs = list(codecs)
+        self.tcpclient = tornado.tcpclient.TCPClient()
+        self.nodes = {}
+        self.revision = None
+        self.epoch = None
+        self.synced = False
+        self.lost_time = None # IOLoop time the watch stream was lost
+        self._stream = None
+        self._framing = Framing.delimiter
+        self._codec = DEFAULT_CODEC
+        self._header_buffer = new_header_buffer()
+
+    @gen.coroutine
+    def connect(self, delay = False):
+        try:
+            if delay == False:
+                stream = yield self.tcpclient.connect(self.host, self.port)
+                self._on_connect(stream)
+            else:
+                LOG.info("Connect to Server failed: Retry %s seconds later ...", self.retry_interval)
+                IOLoop.instance().add_timeout(IOLoop.time(IOLoop.instance()) + self.retry_interval, self.connect)
+        except Exception as e:
+            LOG.exception(e)
+            if self.reconnect == True:
+                LOG.info("Connect to Server failed: Retry %s seconds later ...", self.retry_interval)
+                IOLoop.instance().add_timeout(IOLoop.time(IOLoop.instance()) + self.retry_interval, self.connect)
+
+    def _on_connect(self, stream):
+        LOG.info("Watcher on connect")
+        self._stream = stream
+        self._stream.set_close_callback(self._on_close)
+        self._framing = Framing.delimiter
+        self._codec = DEFAULT_CODEC
+        IOLoop.instance().add_callback(self.watch)
+
+    @gen.coroutine
+    def read_message(self):
+        data = {"command": Command.error, "data": "Client received wrong message!"}
+        payload, flags = yield read_frame(self._stream, self._header_buffer)
+        if payload is not None:
+            data = decode_payload(payload, flags)
+        raise gen.Return(data)
+
+    @gen.coroutine
+    def send_message(self, data):
+        try:
+            payload, flags = encode_payload(data, self._codec)
+            LOG.debug("Send: %s", data)
+            yield self._stream.write(pack_frame(payload, self._framing, flags))
+        except Exception as e:
+            LOG.exception(e)
+
+    @gen.coroutine
+    def watch(self):
+        try:
+            data = {
+                "command": Command.watch,
+                "data": {"service": self.service, "revision": self.revision, "epoch": self.epoch},
+                "framing": [Framing.binary],
+                "codecs": self.codecs,
+            }
+            self.send_message(data)
+            data = yield self.read_message()
+            if data["command"] != Command.watch or data["data"]["status"] != Status.success:
+                LOG.error("Watcher Received Message: %s", data)
+                self._stream.close()
+                return
+            if data.get("framing") == Framing.binary:
+                self._framing = Framing.binary
+                self._codec = CODECS.get(data.get("codec"), DEFAULT_CODEC)
+            if "snapshot" in data["data"]:
+                self._apply_snapshot(data["data"]["revision"], data["data"]["snapshot"])
+            else:
+                self._apply_events(data["data"]["events"])
+            self.revision = data["data"]["revision"]
+            self.epoch = data["data"]["epoch"]
+            self.synced = True
+            self.lost_time = None
+            while True:
+                data = yield self.read_message()
+                if data["command"] == Command.watch:
+                    self._apply_events(data["data"]["events"])
+                else:
+                    LOG.warning("Watcher Received Message: %s", data)
+        except tornado.iostream.StreamClosedError:
+            LOG.info("Watcher closed")
+        except Exception as e:
+            LOG.exception(e)
+
+    def on_event(self, event_type, node_id, info):
+        pass
+
+    def _apply_snapshot(self, revision, nodes):
+        nodes = dict((info["node_id"], info) for info in nodes)
+        for node_id in list(self.nodes.keys()):
+            if node_id not in nodes:
+                info = self.nodes.pop(node_id)
+                self._emit(Event.removed, node_id, info)
+        for node_id, info in nodes.items():
+            if node_id not in self.nodes:
+                self.nodes[node_id] = info
+                self._emit(Event.added, node_id, info)
+            elif self.nodes[node_id] != info:
+                self.nodes[node_id] = info
+                self._emit(Event.updated, node_id, info)
+
+    def _apply_events(self, events):
+        for event in events:
+            if self.revision is not None and event["revision"] <= self.revision:
+                continue
+            node_id = event["node_id"]
+            if event["type"] == Event.removed:
+                info = self.nodes.pop(node_id, None)
+                if info is not None:
+                    self._emit(Event.removed, node_id, info)
+            else:
+                event_type = Event.added if node_id not in self.nodes else Event.updated
+                self.nodes[node_id] = event["info"]
+                self._emit(event_type, node_id, event["info"])
+            self.revision = event["revision"]
+
+    def _emit(self, event_type, node_id, info):
+        try:
+            self.on_event(event_type, node_id, info)
+        except Exception as e:
+            LOG.exception(e)
+
+    def close(self):
+        try:
+            self.reconnect = False
+            if self._stream:
+                self._stream.set_close_callback(None)
+                self._stream.close()
+            self.tcpclient.close()
+            LOG.info("Close Watcher!")
+        except Exception as e:
+            LOG.exception(e)
+
+    def _on_close(self):
+        try:
+            LOG.info("Watcher closed by Server!")
+            if self.synced:
+                self.synced = False
+                self.lost_time = IOLoop.current().time()
+            if self.reconnect:
+                LOG.info("Reconnect to Server ...")
+                self.connect(delay = True)
+            else:
+                self.tcpclient.close()
+        except Exception as e:
+            LOG.exception(e)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+
+from tornado_discovery.common import Command, Status
+from tornado_discovery.codec import CODECS, encode_payload, decode_payload
+
+LOG = logging.getLogger(__name__)
+
+LOOPS = 20000
+COMPRESS_THRESHOLD = 1024
+
+INFO = {
+    "node_id": "2b1f0a5c-8c3e-4f57-9d0e-6a7c1f6f2e11",
+    "http_host": "10.0.12.34",
+    "http_port": 8001,
+    "heartbeat_interval": 1,
+    "heartbeat_timeout": 10,
+}
+LARGE_INFO = dict(INFO)
+LARGE_INFO.update(("tag_%s" % i, "value-%s" % (i % 10)) for i in range(200))
+
+MESSAGES = {
+    "register": {"command": Command.register, "data": INFO, "version": 3},
+    "heartbeat_full": {"command": Command.heartbeat, "data": INFO, "version": 3},
+    "heartbeat_delta": {"command": Command.heartbeat, "delta": True, "data": {"version": 3}},
+    "heartbeat_reply": {"command": Command.heartbeat, "data": {"status": Status.success, "message": Status.success}},
+    "register_large": {"command": Command.register, "data": LARGE_INFO, "version": 3},
+}
+
+
+def bench(data, codec, compress_threshold):
+    t = time.perf_counter()
+    for _ in range(LOOPS):
+        payload, flags = encode_payload(data, codec, compress_threshold)
+    encode_time = time.perf_counter() - t
+    t = time.perf_counter()
+    for _ in range(LOOPS):
+        decode_payload(payload, flags)
+    decode_time = time.perf_counter() - t
+    assert decode_payload(payload, flags) == data
+    return encode_time / LOOPS * 1000000, decode_time / LOOPS * 1000000, len(payload)
+
+
+def main():
+    print("%-16s %-14s %12s %12s %8s" % ("message", "codec", "encode(us)", "decode(us)", "bytes"))
+    for message_name, data in MESSAGES.items():
+        for codec in CODECS.values():
+            for compress_threshold in (None, COMPRESS_THRESHOLD):
+                name = codec.name if compress_threshold is None else codec.name + "+zlib"
+                encode_us, decode_us, size = bench(data, codec, compress_threshold)
+                print("%-16s %-14s %12.2f %12.2f %8s" % (message_name, name, encode_us, decode_us, size))
+
+
+if __name__ == "__main__":
+    main()
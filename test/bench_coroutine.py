@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+'''
+coroutine overhead of the @gen.coroutine classes against the native async def
+ones in tornado_discovery.aio, one JSON line per measure:
+
+call: a chain of 3 coroutines awaiting a done future, per call
+heartbeat: registrants heartbeating back to back against an in-process
+           listener, BaseListener/BaseRegistrant vs AsyncListener/AsyncRegistrant
+
+    python3 bench_coroutine.py --registrants 100 --seconds 5
+    python3 bench_coroutine.py --uvloop   # needs uvloop installed
+'''
+
+import json
+import time
+import asyncio
+import logging
+import argparse
+
+import tornado.netutil
+from tornado import gen
+from tornado.concurrent import Future
+
+from tornado_discovery.aio import AsyncConnection, AsyncListener, AsyncRegistrant
+from tornado_discovery.common import Status
+from tornado_discovery.config import BaseConfig
+from tornado_discovery.connection import BaseConnection
+from tornado_discovery.listener import BaseListener
+from tornado_discovery.registrant import BaseRegistrant
+from tornado_discovery.registry import Registry
+
+from bench_load import BACKLOG, free_port, cpu_seconds
+
+LOG = logging.getLogger(__name__)
+
+CALLS = 200000
+
+
+def done_future():
+    future = Future()
+    future.set_result(1)
+    return future
+
+
+@gen.coroutine
+def gen_leaf(future):
+    result = yield future
+    raise gen.Return(result)
+
+
+@gen.coroutine
+def gen_middle(future):
+    result = yield gen_leaf(future)
+    raise gen.Return(result)
+
+
+@gen.coroutine
+def gen_top(future):
+    result = yield gen_middle(future)
+    raise gen.Return(result)
+
+
+async def native_leaf(future):
+    return await future
+
+
+async def native_middle(future):
+    return await native_leaf(future)
+
+
+async def native_top(future):
+    return await native_middle(future)
+
+
+async def bench_calls():
+    future = done_future()
+    results = {}
+    for name, top in (("gen", gen_top), ("native", native_top)):
+        t = time.perf_counter()
+        for _ in range(CALLS):
+            await top(future)
+        results[name] = (time.perf_counter() - t) / CALLS
+    return {
+        "bench": "coroutine_call",
+        "calls": CALLS,
+        "gen_us_per_call": round(results["gen"] * 1000000, 3),
+        "native_us_per_call": round(results["native"] * 1000000, 3),
+        "speedup": round(results["gen"] / results["native"], 2),
+    }
+
+
+async def bench_heartbeats(args, native):
+    port = free_port()
+    if native:
+        connection_cls = type("NativeConnection", (AsyncConnection, ), {"registry": Registry()})
+        listener = AsyncListener(connection_cls)
+    else:
+        connection_cls = type("GenConnection", (BaseConnection, ), {"registry": Registry()})
+        listener = BaseListener(connection_cls)
+    listener.add_sockets(tornado.netutil.bind_sockets(port, address = "127.0.0.1", backlog = BACKLOG))
+    registrants = []
+    for i in range(args.registrants):
+        config = BaseConfig()
+        config.from_dict({
+            "heartbeat_interval": 3600, # heartbeats are driven by beat()
+            "heartbeat_timeout": 3600,
+            "http_host": "127.0.0.1",
+            "http_port": 10000 + i,
+        })
+        cls = AsyncRegistrant if native else BaseRegistrant
+        registrant = cls("127.0.0.1", port, config, reconnect = False, request_timeout = 60)
+        await registrant.connect()
+        registrants.append(registrant)
+    while len(connection_cls.registry) < args.registrants or not all(r._registered for r in registrants):
+        await asyncio.sleep(0.01)
+
+    heartbeats = [0]
+    deadline = time.perf_counter() + args.seconds
+
+    async def beat(registrant):
+        while time.perf_counter() < deadline:
+            data = await registrant.request(registrant._heartbeat_data())
+            if data["data"]["status"] == Status.success:
+                heartbeats[0] += 1
+
+    cpu = cpu_seconds()
+    t = time.perf_counter()
+    await asyncio.gather(*[beat(registrant) for registrant in registrants])
+    elapsed = time.perf_counter() - t
+    cpu = cpu_seconds() - cpu
+    for registrant in registrants:
+        registrant.close()
+    listener.stop()
+    return {
+        "bench": "coroutine_heartbeat",
+        "path": "native" if native else "gen",
+        "registrants": args.registrants,
+        "seconds": args.seconds,
+        "heartbeats_per_second": round(heartbeats[0] / elapsed, 1),
+        "cpu_us_per_heartbeat": round(cpu / heartbeats[0] * 1000000, 2) if heartbeats[0] else None,
+    }
+
+
+async def run(args):
+    print(json.dumps(await bench_calls(), sort_keys = True))
+    for native in (False, True):
+        result = await bench_heartbeats(args, native)
+        result["loop"] = type(asyncio.get_event_loop()).__name__
+        print(json.dumps(result, sort_keys = True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "tornado_discovery coroutine overhead benchmark")
+    parser.add_argument("--registrants", type = int, default = 100)
+    parser.add_argument("--seconds", type = float, default = 5)
+    parser.add_argument("--uvloop", action = "store_true", help = "run on uvloop instead of the default asyncio loop")
+    args = parser.parse_args()
+    if args.uvloop:
+        import uvloop
+        uvloop.install()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.CRITICAL)
+    main()
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+'''
+load generation against BaseListener/BaseConnection, one JSON result line per run
+
+    python3 bench_load.py --registrants 10000 --processes 4 --seconds 10
+    python3 bench_load.py --registrants 2000 --in-process --output results.jsonl
+
+a registration storm (every registrant connects at once) is timed until the
+listener's registry is full, then every registrant heartbeats for --seconds,
+back to back with --interval 0 or paced at --interval seconds.
+with --compare the result is checked against the last line of a previous
+--output file with the same parameters, the exit status is 1 on a regression.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import signal
+import logging
+import argparse
+import resource
+import subprocess
+from urllib.request import urlopen
+
+import tornado.netutil
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+LOG = logging.getLogger(__name__)
+
+RTT_SAMPLES = 5000 # per process, reservoir sampled
+BACKLOG = 65535 # the registration storm overflows the default accept backlog
+
+
+def raise_nofile_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(q * (len(values) - 1)))]
+
+
+class Stats(object):
+    def __init__(self):
+        self.heartbeats = 0
+        self.failures = 0
+        self.rtts = []
+        self._seen = 0
+
+    def add_rtt(self, rtt):
+        self._seen += 1
+        if len(self.rtts) < RTT_SAMPLES:
+            self.rtts.append(rtt)
+        else:
+            i = random.randrange(self._seen)
+            if i < RTT_SAMPLES:
+                self.rtts[i] = rtt
+
+
+@gen.coroutine
+def register_all(port, count, first_port = 10000):
+    from tornado_discovery.config import BaseConfig
+    from tornado_discovery.registrant import BaseRegistrant
+
+    @gen.coroutine
+    def register(i):
+        config = BaseConfig()
+        config.from_dict({
+            "heartbeat_interval": 3600, # heartbeats are driven by heartbeat_all
+            "heartbeat_timeout": 3600,
+            "http_host": "127.0.0.1",
+            "http_port": first_port + i,
+        })
+        registrant = BaseRegistrant("127.0.0.1", port, config, reconnect = False, request_timeout = 60)
+        yield registrant.connect() # registers in the background
+        while registrant._stream is not None and not registrant._stream.closed() and not registrant._registered:
+            yield gen.sleep(0.01)
+        raise gen.Return(registrant)
+
+    registrants = yield [register(i) for i in range(count)]
+    raise gen.Return([registrant for registrant in registrants if registrant._registered])
+
+
+@gen.coroutine
+def heartbeat_all(registrants, seconds, interval, stats):
+    from tornado_discovery.common import Status
+
+    deadline = IOLoop.current().time() + seconds
+
+    @gen.coroutine
+    def beat(registrant):
+        if interval:
+            yield gen.sleep(random.random() * interval)
+        while IOLoop.current().time() < deadline:
+            t = time.perf_counter()
+            try:
+                data = yield registrant.request(registrant._heartbeat_data())
+                if data["data"]["status"] == Status.success:
+                    stats.heartbeats += 1
+                    stats.add_rtt(time.perf_counter() - t)
+                else:
+                    stats.failures += 1
+            except Exception:
+                stats.failures += 1
+            if interval:
+                yield gen.sleep(max(0, interval - (time.perf_counter() - t)))
+
+    yield [beat(registrant) for registrant in registrants]
+
+
+def run_listener(port, metrics_port):
+    from tornado_discovery.connection import BaseConnection
+    from tornado_discovery.listener import BaseListener
+
+    def collect(metrics):
+        metrics.gauge("process_cpu_seconds_total").set(cpu_seconds())
+        metrics.gauge("process_resident_memory_bytes").set(rss_bytes())
+
+    raise_nofile_limit()
+    listener = BaseListener(BaseConnection)
+    listener.add_sockets(tornado.netutil.bind_sockets(port, address = "127.0.0.1", backlog = BACKLOG))
+    listener.listen_metrics(metrics_port, address = "127.0.0.1")
+    BaseConnection.metrics.add_collector(collect)
+    BaseConnection.get_instruments()
+    IOLoop.current().start()
+
+
+def run_client(port, count, first_port, seconds, interval):
+    '''
+    register, print "ready", wait for a line on stdin, heartbeat and print the stats
+    '''
+    @gen.coroutine
+    def main():
+        registrants = yield register_all(port, count, first_port)
+        sys.stdout.write("ready\n")
+        sys.stdout.flush()
+        yield IOLoop.current().run_in_executor(None, sys.stdin.readline)
+        stats = Stats()
+        yield heartbeat_all(registrants, seconds, interval, stats)
+        for registrant in registrants:
+            registrant.close()
+        sys.stdout.write(json.dumps({"heartbeats": stats.heartbeats, "failures": stats.failures, "rtts": stats.rtts}) + "\n")
+        sys.stdout.flush()
+
+    raise_nofile_limit()
+    IOLoop.current().run_sync(main)
+
+
+def read_metrics(metrics_port):
+    '''
+    return the unlabeled samples of the listener's /metrics
+    '''
+    result = {}
+    body = urlopen("http://127.0.0.1:%s/metrics" % metrics_port, timeout = 10).read().decode("utf-8")
+    for line in body.splitlines():
+        if line and not line.startswith("#") and "{" not in line:
+            name, value = line.split(" ", 1)
+            result[name] = float(value)
+    return result
+
+
+def bench_processes(args):
+    port = free_port()
+    metrics_port = free_port()
+    listener = subprocess.Popen([sys.executable, __file__, "listener", str(port), str(metrics_port)], start_new_session = True)
+    clients = []
+    try:
+        for _ in range(50):
+            try:
+                idle = read_metrics(metrics_port)
+                break
+            except IOError:
+                time.sleep(0.1)
+        per_process = [args.registrants // args.processes + (1 if i < args.registrants % args.processes else 0)
+                       for i in range(args.processes)]
+        start = time.perf_counter()
+        for i, count in enumerate(per_process):
+            clients.append(subprocess.Popen(
+                [sys.executable, __file__, "client", str(port), str(count), str(10000 + sum(per_process[:i])),
+                 str(args.seconds), str(args.interval)],
+                stdin = subprocess.PIPE, stdout = subprocess.PIPE, universal_newlines = True
+            ))
+        storm_seconds = None
+        while time.perf_counter() - start < args.timeout:
+            registered = read_metrics(metrics_port)
+            if registered["discovery_listener_registry_nodes"] >= args.registrants:
+                storm_seconds = time.perf_counter() - start
+                break
+            time.sleep(0.05)
+        for client in clients:
+            client.stdout.readline() # ready
+        before = read_metrics(metrics_port)
+        t = time.perf_counter()
+        for client in clients:
+            client.stdin.write("go\n")
+            client.stdin.flush()
+        stats = Stats()
+        for client in clients:
+            result = json.loads(client.stdout.readline())
+            stats.heartbeats += result["heartbeats"]
+            stats.failures += result["failures"]
+            stats.rtts.extend(result["rtts"])
+        after = read_metrics(metrics_port)
+        elapsed = time.perf_counter() - t
+    finally:
+        for client in clients:
+            client.kill()
+        os.killpg(listener.pid, signal.SIGTERM)
+        listener.wait()
+    return {
+        "registration_storm_seconds": round(storm_seconds, 3) if storm_seconds is not None else None,
+        "heartbeats": stats.heartbeats,
+        "failures": stats.failures,
+        "rtts": stats.rtts,
+        "listener_cpu_seconds": after["process_cpu_seconds_total"] - before["process_cpu_seconds_total"],
+        "elapsed_seconds": elapsed,
+        "memory_per_connection_bytes": (before["process_resident_memory_bytes"] - idle["process_resident_memory_bytes"]) / args.registrants,
+    }
+
+
+def bench_in_process(args):
+    '''
+    listener and registrants share one process and IOLoop, cpu and memory cover both sides
+    '''
+    from tornado_discovery.connection import BaseConnection
+    from tornado_discovery.listener import BaseListener
+
+    @gen.coroutine
+    def main():
+        port = free_port()
+        listener = BaseListener(BaseConnection)
+        listener.add_sockets(tornado.netutil.bind_sockets(port, address = "127.0.0.1", backlog = BACKLOG))
+        idle_rss = rss_bytes()
+        start = time.perf_counter()
+        registrants = yield register_all(port, args.registrants)
+        storm_seconds = time.perf_counter() - start if len(BaseConnection.registry) >= args.registrants else None
+        rss = rss_bytes()
+        cpu = cpu_seconds()
+        t = time.perf_counter()
+        stats = Stats()
+        yield heartbeat_all(registrants, args.seconds, args.interval, stats)
+        cpu = cpu_seconds() - cpu
+        elapsed = time.perf_counter() - t
+        for registrant in registrants:
+            registrant.close()
+        listener.stop()
+        raise gen.Return({
+            "registration_storm_seconds": round(storm_seconds, 3) if storm_seconds is not None else None,
+            "heartbeats": stats.heartbeats,
+            "failures": stats.failures,
+            "rtts": stats.rtts,
+            "listener_cpu_seconds": cpu,
+            "elapsed_seconds": elapsed,
+            "memory_per_connection_bytes": (rss - idle_rss) / args.registrants,
+        })
+
+    raise_nofile_limit()
+    return IOLoop.current().run_sync(main)
+
+
+# higher is better: 1, lower is better: -1
+COMPARED = {
+    "heartbeats_per_second": 1,
+    "heartbeat_rtt_p50_ms": -1,
+    "heartbeat_rtt_p99_ms": -1,
+    "registration_storm_seconds": -1,
+    "memory_per_connection_bytes": -1,
+}
+PARAMETERS = ("mode", "registrants", "processes", "seconds", "interval")
+
+
+def compare(result, path, tolerance):
+    '''
+    return the regressions of result against the last matching run in path
+    '''
+    baseline = None
+    with open(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                data = json.loads(line)
+                if all(data.get(key) == result[key] for key in PARAMETERS):
+                    baseline = data
+    regressions = []
+    if baseline is None:
+        LOG.warning("No baseline with the same parameters in %s", path)
+        return regressions
+    for key, direction in COMPARED.items():
+        old, new = baseline.get(key), result.get(key)
+        if old and new is not None and (new - old) / float(old) * direction < -tolerance:
+            regressions.append({"metric": key, "baseline": old, "result": new})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "tornado_discovery load benchmark")
+    parser.add_argument("--registrants", type = int, default = 1000)
+    parser.add_argument("--processes", type = int, default = 4, help = "registrant processes")
+    parser.add_argument("--seconds", type = float, default = 5, help = "heartbeat phase duration")
+    parser.add_argument("--interval", type = float, default = 0, help = "heartbeat interval, 0 for back to back")
+    parser.add_argument("--timeout", type = float, default = 120, help = "registration storm timeout")
+    parser.add_argument("--in-process", action = "store_true", help = "run listener and registrants in this process")
+    parser.add_argument("--output", help = "append the JSON result line to this file")
+    parser.add_argument("--compare", help = "JSON lines file of previous results to check against")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "allowed relative change")
+    args = parser.parse_args()
+
+    result = bench_in_process(args) if args.in_process else bench_processes(args)
+    rtts = result.pop("rtts")
+    result.update({
+        "bench": "load",
+        "mode": "in_process" if args.in_process else "processes",
+        "registrants": args.registrants,
+        "processes": 1 if args.in_process else args.processes,
+        "seconds": args.seconds,
+        "interval": args.interval,
+        "heartbeats_per_second": round(result["heartbeats"] / args.seconds, 1),
+        "heartbeat_rtt_p50_ms": round(percentile(rtts, 0.5) * 1000, 3) if rtts else None,
+        "heartbeat_rtt_p99_ms": round(percentile(rtts, 0.99) * 1000, 3) if rtts else None,
+        "listener_cpu_percent": round(result.pop("listener_cpu_seconds") / result.pop("elapsed_seconds") * 100, 1),
+        "memory_per_connection_bytes": int(result["memory_per_connection_bytes"]),
+        "timestamp": int(time.time()),
+    })
+    line = json.dumps(result, sort_keys = True)
+    print(line)
+    regressions = compare(result, args.compare, args.tolerance) if args.compare else []
+    if args.output:
+        with open(args.output, "a") as fp:
+            fp.write(line + "\n")
+    for regression in regressions:
+        print(json.dumps(dict(regression, bench = "load_regression"), sort_keys = True))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.ERROR)
+    if len(sys.argv) > 1 and sys.argv[1] == "listener":
+        run_listener(int(sys.argv[2]), int(sys.argv[3]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "client":
+        run_client(int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]), float(sys.argv[5]), float(sys.argv[6]))
+    else:
+        sys.exit(main())
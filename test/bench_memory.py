@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import gc
+import json
+import tracemalloc
+from types import MappingProxyType
+
+from tornado_discovery.info import NodeInfo
+from tornado_discovery.registry import RegistryEntry
+from tornado_discovery.connection import BaseConnection
+
+NODES = 100000
+
+
+class DictEntry(object):
+    '''
+    RegistryEntry without __slots__
+    '''
+    __init__ = RegistryEntry.__init__
+
+
+class DictConnectionState(object):
+    pass
+
+
+class SlotConnectionState(object):
+    __slots__ = BaseConnection.__slots__
+
+
+def payload(i):
+    return json.dumps({
+        "node_id": "2b1f0a5c-8c3e-4f57-9d0e-%012d" % i,
+        "http_host": "10.0.%s.%s" % (i // 250 % 250, i % 250),
+        "http_port": 8000 + i % 100,
+        "heartbeat_interval": 1,
+        "heartbeat_timeout": 10,
+        "service": "service-%s" % (i % 50),
+        "load": i % 100,
+    }).encode("utf-8")
+
+
+def node(data, compact):
+    '''
+    what the listener keeps per node: the connection state, the info, the
+    registry entry and its immutable view
+    '''
+    if compact:
+        info = NodeInfo.from_dict(data)
+        state = SlotConnectionState()
+        entry = RegistryEntry(info["node_id"], info)
+        entry.view = MappingProxyType(info.copy())
+    else:
+        info = data
+        state = DictConnectionState()
+        entry = DictEntry(info["node_id"], info)
+        entry.view = MappingProxyType(dict(info))
+    for name in BaseConnection.__slots__:
+        setattr(state, name, None)
+    state.info = info
+    return state, entry
+
+
+def bench(compact):
+    payloads = [payload(i) for i in range(NODES)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    nodes = [node(json.loads(data.decode("utf-8")), compact) for data in payloads]
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del nodes
+    return used
+
+
+def main():
+    legacy = bench(False)
+    compact = bench(True)
+    print(json.dumps({
+        "bench": "memory_per_node",
+        "nodes": NODES,
+        "dict_bytes_per_node": legacy // NODES,
+        "compact_bytes_per_node": compact // NODES,
+        "saving_bytes_per_node": (legacy - compact) // NODES,
+        "saving_percent": round((legacy - compact) * 100.0 / legacy, 1),
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import subprocess
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+LOG = logging.getLogger(__name__)
+
+PORT = 16101
+WORKERS = (1, 2, 4)
+CLIENT_PROCESSES = 4
+CONNECTIONS = 50 # per client process
+SECONDS = 5
+
+
+def run_listener(port, num_processes):
+    from tornado_discovery.connection import BaseConnection
+    from tornado_discovery.listener import BaseListener
+    listener = BaseListener(BaseConnection)
+    listener.listen_multiprocess(port, address = "127.0.0.1", num_processes = num_processes, reuse_port = True)
+    IOLoop.current().start()
+
+
+def run_client(port, connections, seconds):
+    from tornado_discovery.common import Status
+    from tornado_discovery.config import BaseConfig
+    from tornado_discovery.registrant import BaseRegistrant
+
+    result = {"heartbeats": 0}
+
+    @gen.coroutine
+    def beat(i, deadline):
+        config = BaseConfig()
+        config.from_dict({"heartbeat_interval": 3600, "heartbeat_timeout": 60, "http_host": "127.0.0.1", "http_port": 10000 + i})
+        registrant = BaseRegistrant("127.0.0.1", port, config, reconnect = False)
+        yield registrant.connect()
+        yield registrant.register_service()
+        while IOLoop.current().time() < deadline:
+            data = yield registrant.request(registrant._heartbeat_data())
+            if data["data"]["status"] == Status.success:
+                result["heartbeats"] += 1
+        registrant.close()
+
+    @gen.coroutine
+    def main():
+        deadline = IOLoop.current().time() + seconds
+        yield [beat(i, deadline) for i in range(connections)]
+
+    IOLoop.current().run_sync(main)
+    print(result["heartbeats"])
+
+
+def bench(num_processes):
+    listener = subprocess.Popen([sys.executable, __file__, "listener", str(PORT), str(num_processes)], start_new_session = True)
+    try:
+        time.sleep(1.5)
+        clients = [
+            subprocess.Popen([sys.executable, __file__, "client", str(PORT), str(CONNECTIONS), str(SECONDS)], stdout = subprocess.PIPE)
+            for _ in range(CLIENT_PROCESSES)
+        ]
+        heartbeats = sum(int(client.communicate()[0].strip() or 0) for client in clients)
+    finally:
+        os.killpg(listener.pid, signal.SIGTERM)
+        listener.wait()
+    return {
+        "bench": "multiprocess_heartbeat_throughput",
+        "workers": num_processes,
+        "connections": CLIENT_PROCESSES * CONNECTIONS,
+        "seconds": SECONDS,
+        "heartbeats_per_second": round(heartbeats / float(SECONDS), 1),
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.ERROR)
+    if len(sys.argv) > 1 and sys.argv[1] == "listener":
+        run_listener(int(sys.argv[2]), int(sys.argv[3]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "client":
+        run_client(int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4]))
+    else:
+        for num_processes in WORKERS:
+            print(json.dumps(bench(num_processes)))
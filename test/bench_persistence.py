@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from tornado_discovery.common import Command
+from tornado_discovery.protocol import Framing, pack_frame
+from tornado_discovery.codec import CODECS, CompactCodec, encode_payload
+from tornado_discovery.registry import Registry
+from tornado_discovery.timing_wheel import TimingWheel
+from tornado_discovery.persistence import RegistryStore
+
+LOG = logging.getLogger(__name__)
+
+NODES = 100000
+UPDATES = 20000
+
+
+def node_info(i):
+    return {
+        "node_id": "node-%06d" % i,
+        "http_host": "10.0.%s.%s" % (i // 250 % 250, i % 250),
+        "http_port": 8000 + i % 100,
+        "heartbeat_interval": 1,
+        "heartbeat_timeout": 10,
+        "service": "service-%s" % (i % 50),
+    }
+
+
+@gen.coroutine
+def bench(path):
+    connection = object()
+    registry = Registry()
+    store = RegistryStore(registry, path, snapshot_interval = 3600, timing_wheel = TimingWheel())
+    store.start()
+
+    # write-ahead log: register everything, then update a part of it
+    t = time.perf_counter()
+    for i in range(NODES):
+        registry.register("node-%06d" % i, node_info(i), connection)
+    for i in range(UPDATES):
+        info = node_info(i)
+        info["load"] = i
+        registry.update(info["node_id"], info)
+    store._flush()
+    log_time = time.perf_counter() - t
+    log_bytes = os.path.getsize(store.log_path)
+
+    # warm restart from snapshot + log, before compaction
+    t = time.perf_counter()
+    restored = RegistryStore(Registry(), path, timing_wheel = TimingWheel()).restore()
+    restore_log_time = time.perf_counter() - t
+
+    t = time.perf_counter()
+    store.snapshot()
+    snapshot_time = time.perf_counter() - t
+    snapshot_bytes = os.path.getsize(store.snapshot_path)
+    store.stop()
+
+    t = time.perf_counter()
+    restored_snapshot = RegistryStore(Registry(), path, timing_wheel = TimingWheel()).restore()
+    restore_snapshot_time = time.perf_counter() - t
+
+    # without persistence the registry is refilled by every node registering again
+    codec = CODECS[CompactCodec.name]
+    resync_bytes = 0
+    for i in range(NODES):
+        payload, flags = encode_payload({"command": Command.register, "data": node_info(i), "version": 1}, codec)
+        resync_bytes += len(pack_frame(payload, Framing.binary, flags))
+
+    raise gen.Return({
+        "bench": "registry_persistence",
+        "nodes": NODES,
+        "updates": UPDATES,
+        "log_append_per_second": round((NODES + UPDATES) / log_time, 1),
+        "log_bytes": log_bytes,
+        "restore_from_log_seconds": round(restore_log_time, 3),
+        "snapshot_seconds": round(snapshot_time, 3),
+        "snapshot_bytes": snapshot_bytes,
+        "restore_from_snapshot_seconds": round(restore_snapshot_time, 3),
+        "restored_nodes": min(restored, restored_snapshot),
+        "cold_resync_bytes": resync_bytes,
+    })
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.ERROR)
+    path = tempfile.mkdtemp(prefix = "tornado_discovery_bench_")
+    try:
+        print(json.dumps(IOLoop.current().run_sync(lambda: bench(path))))
+    finally:
+        shutil.rmtree(path)
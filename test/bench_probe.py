@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+'''
+active probing of a large fleet against local stub http servers: --nodes
+registry entries spread over --servers stub endpoints, --failing of them
+answering 503. probes are counted in 100ms windows, one JSON line per mode:
+
+tcp: a TCP connect per probe
+http: a GET of /health per probe on the pooled keep-alive connections
+
+    python3 bench_probe.py --nodes 10000 --interval 5 --concurrency 100
+'''
+
+import json
+import time
+import logging
+import argparse
+
+import tornado.web
+import tornado.netutil
+import tornado.httpserver
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from tornado_discovery.common import Status, ProbeMode
+from tornado_discovery.metrics import Metrics
+from tornado_discovery.probe import Prober, ConnectionPool
+from tornado_discovery.registry import Registry
+
+from bench_load import BACKLOG, raise_nofile_limit, free_port, cpu_seconds
+
+LOG = logging.getLogger(__name__)
+
+WINDOW = 0.1 # seconds
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def initialize(self, code):
+        self.code = code
+
+    def get(self):
+        self.set_status(self.code)
+        self.write("ok" if self.code == 200 else "failing")
+
+
+def start_servers(args):
+    ports = []
+    for i in range(args.servers):
+        port = free_port()
+        application = tornado.web.Application([(r"/health", HealthHandler, {"code": 503 if i < args.failing else 200})])
+        server = tornado.httpserver.HTTPServer(application)
+        server.add_sockets(tornado.netutil.bind_sockets(port, address = "127.0.0.1", backlog = BACKLOG))
+        ports.append(port)
+    return ports
+
+
+@gen.coroutine
+def scenario(args, ports, mode):
+    metrics = Metrics()
+    registry = Registry()
+    for i in range(args.nodes):
+        # every node is local: its entry has a connection
+        registry.register("node-%s" % i, {"http_host": "127.0.0.1", "http_port": ports[i % len(ports)]}, connection = True)
+    prober = Prober(
+        registry, mode = mode, path = "/health", interval = args.interval, timeout = args.timeout,
+        concurrency = args.concurrency, pool = ConnectionPool(max_idle = args.concurrency), metrics = metrics
+    )
+    windows = []
+    in_flight = [0]
+    last = [0]
+
+    def sample():
+        probes = sum(counter.value for counter in prober._results.values())
+        windows.append(probes - last[0])
+        last[0] = probes
+
+    def watch():
+        in_flight[0] = max(in_flight[0], prober._active)
+
+    cpu = cpu_seconds()
+    start = time.perf_counter()
+    prober.start()
+    periodic = PeriodicCallback(sample, WINDOW * 1000)
+    periodic.start()
+    watcher = PeriodicCallback(watch, 1)
+    watcher.start()
+    yield gen.sleep(args.seconds)
+    periodic.stop()
+    watcher.stop()
+    elapsed = time.perf_counter() - start
+    cpu = cpu_seconds() - cpu
+    statuses = {Status.green: 0, Status.yellow: 0, Status.red: 0, None: 0}
+    for entry in registry:
+        statuses[entry.info.get("status")] += 1
+    results = dict((result, counter.value) for result, counter in prober._results.items())
+    prober.stop()
+    # the first interval is the ramp up of the random phases
+    steady = windows[int(args.interval / WINDOW):] or windows
+    raise gen.Return({
+        "bench": "probe",
+        "mode": mode,
+        "nodes": args.nodes,
+        "servers": args.servers,
+        "interval": args.interval,
+        "concurrency": args.concurrency,
+        "probes_per_second": round(sum(results.values()) / elapsed, 1),
+        "expected_per_second": round(args.nodes / float(args.interval), 1),
+        "results": results,
+        "reused_connections": prober._reused.value,
+        "max_in_flight": in_flight[0],
+        # probes per window once every node has its phase, 1.0 is perfectly spread
+        "peak_to_mean": round(max(steady) / (sum(steady) / float(len(steady))), 2) if sum(steady) else None,
+        "green": statuses[Status.green],
+        "yellow": statuses[Status.yellow],
+        "red": statuses[Status.red],
+        "unknown": statuses[None],
+        "cpu_percent": round(cpu / elapsed * 100, 1),
+        "window_seconds": WINDOW,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "tornado_discovery active probing benchmark")
+    parser.add_argument("--nodes", type = int, default = 10000)
+    parser.add_argument("--servers", type = int, default = 20, help = "stub http endpoints shared by the nodes")
+    parser.add_argument("--failing", type = int, default = 2, help = "stub endpoints answering 503")
+    parser.add_argument("--interval", type = float, default = 5)
+    parser.add_argument("--timeout", type = float, default = 2)
+    parser.add_argument("--concurrency", type = int, default = 100)
+    parser.add_argument("--seconds", type = float, default = 15)
+    args = parser.parse_args()
+
+    raise_nofile_limit()
+    ports = start_servers(args)
+    for mode in (ProbeMode.tcp, ProbeMode.http):
+        result = IOLoop.current().run_sync(lambda: scenario(args, ports, mode))
+        print(json.dumps(result, sort_keys = True))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.CRITICAL)
+    main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+'''
+reconnect storm: every registrant is registered, the listener goes away for
+--downtime seconds and comes back on the same port, the recovery is observed
+in 100ms windows for --seconds. it runs once per scenario, one JSON line each:
+
+lockstep: fixed retry_interval without jitter and no admission control, the
+          old behaviour, the fleet comes back in waves
+jitter: exponential backoff with full jitter, no admission control
+protected: exponential backoff with full jitter and admission control, the
+           default --rate is below the reconnect rate of the fleet, so
+           refused_rate and refused_handshakes show the admission at work
+
+    python3 bench_reconnect_storm.py --registrants 1000 --rate 200 --max-handshakes 50
+'''
+
+import json
+import time
+import logging
+import argparse
+
+import tornado.netutil
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from tornado_discovery.common import Command
+from tornado_discovery.config import BaseConfig
+from tornado_discovery.connection import BaseConnection
+from tornado_discovery.listener import BaseListener
+from tornado_discovery.metrics import Metrics
+from tornado_discovery.registrant import BaseRegistrant
+from tornado_discovery.registry import Registry
+
+from bench_load import BACKLOG, raise_nofile_limit, free_port, cpu_seconds
+
+LOG = logging.getLogger(__name__)
+
+WINDOW = 0.1 # seconds
+
+
+SCENARIOS = ("lockstep", "jitter", "protected")
+
+
+def start_listener(connection_cls, port, args, scenario_name):
+    listener = BaseListener(connection_cls)
+    listener.add_sockets(tornado.netutil.bind_sockets(port, address = "127.0.0.1", backlog = BACKLOG))
+    if scenario_name == "protected":
+        listener.enable_admission_control(
+            rate = args.rate, burst = args.rate // 10 or 1, max_handshakes = args.max_handshakes, retry_after = args.retry_after
+        )
+    return listener
+
+
+def stop_listener(listener):
+    listener.stop()
+    for connection in list(BaseConnection.clients):
+        connection._stream.close()
+
+
+@gen.coroutine
+def scenario(args, scenario_name):
+    port = free_port()
+    connection_cls = type("StormConnection", (BaseConnection, ), {"registry": Registry(), "metrics": Metrics()})
+    listener = start_listener(connection_cls, port, args, scenario_name)
+    registrants = []
+    for i in range(args.registrants):
+        config = BaseConfig()
+        config.from_dict({
+            "heartbeat_interval": args.heartbeat_interval,
+            "heartbeat_timeout": args.heartbeat_interval * 10,
+            "http_host": "127.0.0.1",
+            "http_port": 10000 + i,
+        })
+        if scenario_name != "lockstep":
+            registrant = BaseRegistrant(
+                "127.0.0.1", port, config, retry_interval = args.retry_interval,
+                max_retry_interval = args.max_retry_interval, request_timeout = 30
+            )
+        else:
+            registrant = BaseRegistrant(
+                "127.0.0.1", port, config, retry_interval = args.retry_interval,
+                max_retry_interval = args.retry_interval, jitter = False, request_timeout = 30
+            )
+        registrant.connect()
+        registrants.append(registrant)
+    while len(connection_cls.registry) < args.registrants:
+        yield gen.sleep(0.05)
+    yield gen.sleep(args.heartbeat_interval * 2)
+
+    stop_listener(listener)
+    admission = listener.admission
+    # the counters are shared by the admission of the restarted listener
+    refused = (admission.rejected_rate.value, admission.rejected_handshakes.value) if admission else (0, 0)
+    yield gen.sleep(args.downtime)
+    instruments = connection_cls.get_instruments()
+    windows = []
+    last = [instruments.accepted.value, instruments.requests[Command.register].value, instruments.requests[Command.heartbeat].value]
+
+    def sample():
+        current = [instruments.accepted.value, instruments.requests[Command.register].value, instruments.requests[Command.heartbeat].value]
+        windows.append([b - a for a, b in zip(last, current)] + [len(connection_cls.registry)])
+        last[:] = current
+
+    cpu = cpu_seconds()
+    start = time.perf_counter()
+    listener = start_listener(connection_cls, port, args, scenario_name)
+    admission = listener.admission
+    periodic = PeriodicCallback(sample, WINDOW * 1000)
+    periodic.start()
+    recovery_seconds = None
+    while time.perf_counter() - start < args.seconds:
+        if recovery_seconds is None and len(connection_cls.registry) >= args.registrants:
+            recovery_seconds = time.perf_counter() - start
+        yield gen.sleep(0.01)
+    periodic.stop()
+    cpu = cpu_seconds() - cpu
+    elapsed = time.perf_counter() - start
+
+    for registrant in registrants:
+        registrant.reconnect = False
+        registrant._stop_heartbeat()
+    stop_listener(listener)
+    yield gen.sleep(0.5)
+    settled = [window for window in windows if window[3] >= args.registrants]
+    heartbeats = [window[2] for window in settled]
+    raise gen.Return({
+        "bench": "reconnect_storm",
+        "scenario": scenario_name,
+        "registrants": args.registrants,
+        "downtime": args.downtime,
+        "retry_interval": args.retry_interval,
+        "recovery_seconds": round(recovery_seconds, 3) if recovery_seconds is not None else None,
+        "accepted": sum(window[0] for window in windows),
+        "register_requests": sum(window[1] for window in windows),
+        "peak_accepts_per_window": max(window[0] for window in windows),
+        "peak_registers_per_window": max(window[1] for window in windows),
+        "refused_rate": admission.rejected_rate.value - refused[0] if admission else 0,
+        "refused_handshakes": admission.rejected_handshakes.value - refused[1] if admission else 0,
+        # heartbeat burstiness once recovered, 1.0 is perfectly spread
+        "heartbeat_peak_to_mean": round(max(heartbeats) / (sum(heartbeats) / float(len(heartbeats))), 2) if sum(heartbeats) else None,
+        "cpu_percent": round(cpu / elapsed * 100, 1),
+        "window_seconds": WINDOW,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "tornado_discovery reconnect storm benchmark")
+    parser.add_argument("--registrants", type = int, default = 1000)
+    parser.add_argument("--downtime", type = float, default = 2, help = "seconds the listener is away")
+    parser.add_argument("--seconds", type = float, default = 15, help = "observation after the restart")
+    parser.add_argument("--heartbeat-interval", type = float, default = 1)
+    parser.add_argument("--retry-interval", type = float, default = 1)
+    parser.add_argument("--max-retry-interval", type = float, default = 8)
+    parser.add_argument("--rate", type = int, default = 200, help = "admitted registrations per second")
+    parser.add_argument("--max-handshakes", type = int, default = 50)
+    parser.add_argument("--retry-after", type = float, default = 0.5)
+    args = parser.parse_args()
+
+    raise_nofile_limit()
+    for scenario_name in SCENARIOS:
+        result = IOLoop.current().run_sync(lambda: scenario(args, scenario_name))
+        print(json.dumps(result, sort_keys = True))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.CRITICAL)
+    main()
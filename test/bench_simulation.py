@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+'''
+churn scenario on the virtual clock of tornado_discovery.simulation, the
+listener and every registrant run in-process over in-memory streams, so
+--minutes of virtual time cost only the cpu of the callbacks:
+
+--nodes register, every minute --churn of them leave, half closing their
+connection and half hanging without heartbeats, as many new ones join, and
+the listener restarts at --restart-at minutes for --downtime seconds.
+
+it checks that the registry converges to the live nodes after the restart and
+at the end, that every hanging node is removed by its heartbeat_timeout at most
+one timing wheel tick late and that no live node times out. one JSON line, the
+exit status is 1 when a check fails or the cpu exceeds --max-cpu-seconds, so it
+works as a regression gate.
+
+    python3 bench_simulation.py --nodes 2000 --minutes 12 --restart-at 10
+    python3 bench_simulation.py --nodes 500 --heartbeat-interval 5 --heartbeat-timeout 15 --seed 7
+    python3 bench_simulation.py --max-cpu-seconds 120   # as a gate
+
+the cpu is about the one of the same traffic over TCP, each heartbeat runs both
+ends of the protocol, so 100000 nodes take cpu minutes, not wall clock hours.
+'''
+
+import sys
+import json
+import time
+import logging
+import argparse
+
+from tornado import gen
+
+from tornado_discovery.common import Command
+from tornado_discovery.config import BaseConfig
+from tornado_discovery.connection import BaseConnection
+from tornado_discovery.metrics import Metrics
+from tornado_discovery.registrant import BaseRegistrant
+from tornado_discovery.registry import Registry
+from tornado_discovery.simulation import Simulation
+
+from bench_load import cpu_seconds
+
+LOG = logging.getLogger(__name__)
+
+HOST = "listener"
+PORT = 8000
+
+
+class Fleet(object):
+    def __init__(self, simulation, args):
+        self.simulation = simulation
+        self.args = args
+        self.alive = {} # node_id: registrant
+        self.hanging = {} # node_id: virtual time it stopped heartbeating, its connection open
+        self.hung = 0
+        self.crashed = 0
+        self.joined = 0
+        self._count = 0
+
+    def join(self):
+        i = self._count
+        self._count += 1
+        node_id = "node-%s" % i
+        config = BaseConfig()
+        config.from_dict({
+            "node_id": node_id,
+            "heartbeat_interval": self.args.heartbeat_interval,
+            "heartbeat_timeout": self.args.heartbeat_timeout,
+            "http_host": "10.%s.%s.%s" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+            "http_port": 8080,
+        })
+        registrant = self.simulation.registrant(
+            BaseRegistrant, config.get("http_host"), HOST, PORT, config,
+            retry_interval = self.args.retry_interval, max_retry_interval = self.args.max_retry_interval
+        )
+        registrant.connect()
+        self.alive[node_id] = registrant
+        self.joined += 1
+
+    def leave(self, node_id):
+        registrant = self.alive.pop(node_id, None)
+        if registrant is None:
+            return
+        registrant.reconnect = False
+        registrant._stop_heartbeat()
+        if self.simulation.random.random() < 0.5:
+            # hangs: the connection stays open, only the heartbeat_timeout removes it
+            self.hanging[node_id] = self.simulation.now
+            self.hung += 1
+        else:
+            if registrant._stream is not None:
+                registrant._stream.close()
+            self.crashed += 1
+
+    def churn_minute(self):
+        '''
+        spread the departures and arrivals of the next minute over it
+        '''
+        count = int(round(len(self.alive) * self.args.churn))
+        io_loop = self.simulation.loop
+        random = self.simulation.random
+        for node_id in random.sample(sorted(self.alive), count):
+            io_loop.call_later(random.uniform(0, 60), self.leave, node_id)
+        for _ in range(count):
+            io_loop.call_later(random.uniform(0, 60), self.join)
+
+
+def start_listener(simulation, metrics, args):
+    connection_cls = type("SimulatedConnection", (BaseConnection, ), {
+        "registry": Registry(), "metrics": metrics, "timing_wheel_tick": args.tick,
+    })
+    return simulation.listener(connection_cls, HOST, PORT)
+
+
+def converged(registry, fleet, strict = False):
+    '''
+    every live node registered, and nothing else but the nodes hanging for less
+    than their heartbeat_timeout plus a timing wheel tick, none when strict
+    '''
+    if not all(node_id in registry for node_id in fleet.alive):
+        return False
+    if strict:
+        return len(registry) == len(fleet.alive)
+    expired = fleet.simulation.now - fleet.args.heartbeat_timeout - fleet.args.tick
+    for entry in registry:
+        if entry.node_id not in fleet.alive and fleet.hanging.get(entry.node_id, expired) <= expired:
+            return False
+    return True
+
+
+@gen.coroutine
+def scenario(simulation, args):
+    metrics = Metrics()
+    listener = start_listener(simulation, metrics, args)
+    fleet = Fleet(simulation, args)
+    for _ in range(args.nodes):
+        fleet.join()
+    registered = yield simulation.wait_until(lambda: converged(listener.connection_cls.registry, fleet), 600)
+    result = {"initial_registration_seconds": round(registered, 3) if registered is not None else None}
+
+    start = simulation.now
+    minute = 0
+    restart_convergence = None
+    while minute < args.minutes:
+        fleet.churn_minute()
+        if minute == args.restart_at:
+            yield gen.sleep(simulation.random.uniform(0, 60 - args.downtime))
+            simulation.stop_listener(HOST, PORT)
+            # the hanging nodes lose their connection with the listener
+            fleet.hanging.clear()
+            yield gen.sleep(args.downtime)
+            listener = start_listener(simulation, metrics, args)
+            restart_convergence = yield simulation.wait_until(
+                lambda: converged(listener.connection_cls.registry, fleet), args.max_retry_interval * 4
+            )
+        minute += 1
+        yield gen.sleep(start + minute * 60 - simulation.now)
+
+    # no more churn, the last hanging nodes time out
+    final_convergence = yield simulation.wait_until(
+        lambda: converged(listener.connection_cls.registry, fleet, strict = True), args.heartbeat_timeout + args.tick * 2
+    )
+    lateness = [late for _, late in simulation.timeouts]
+    live_timeouts = [node_id for node_id, _ in simulation.timeouts if node_id in fleet.alive]
+    result.update({
+        "restart_convergence_seconds": round(restart_convergence, 3) if restart_convergence is not None else None,
+        "final_convergence_seconds": round(final_convergence, 3) if final_convergence is not None else None,
+        "registry_nodes": len(listener.connection_cls.registry),
+        "alive": len(fleet.alive),
+        "joined": fleet.joined,
+        "crashed": fleet.crashed,
+        "hung": fleet.hung,
+        "timeouts": len(simulation.timeouts),
+        "live_timeouts": len(live_timeouts),
+        "timeout_late_max": round(max(lateness), 3) if lateness else None,
+        "timeout_late_mean": round(sum(lateness) / len(lateness), 3) if lateness else None,
+        "heartbeats": listener.connection_cls.get_instruments().requests[Command.heartbeat].value,
+    })
+    for registrant in fleet.alive.values():
+        registrant.reconnect = False
+        registrant._stop_heartbeat()
+    simulation.stop_listener(HOST, PORT)
+    yield gen.sleep(1)
+    raise gen.Return(result)
+
+
+def check(result, args):
+    '''
+    the failed checks of result
+    '''
+    failures = []
+    if result["restart_convergence_seconds"] is None and args.restart_at < args.minutes:
+        failures.append("registry didn't converge after the restart")
+    if result["final_convergence_seconds"] is None:
+        failures.append("registry didn't converge at the end")
+    if result["live_timeouts"]:
+        failures.append("%s live nodes timed out" % result["live_timeouts"])
+    if result["timeout_late_max"] is not None and not (0 <= result["timeout_late_max"] <= args.tick + 0.01):
+        failures.append("heartbeat timeout %ss late, tick is %ss" % (result["timeout_late_max"], args.tick))
+    if args.max_cpu_seconds is not None and result["cpu_seconds"] > args.max_cpu_seconds:
+        failures.append("cpu %ss over %ss" % (result["cpu_seconds"], args.max_cpu_seconds))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "tornado_discovery churn simulation on a virtual clock")
+    parser.add_argument("--nodes", type = int, default = 2000)
+    parser.add_argument("--minutes", type = int, default = 12)
+    parser.add_argument("--churn", type = float, default = 0.05, help = "nodes replaced per minute")
+    parser.add_argument("--restart-at", type = int, default = 10, help = "minute the listener restarts")
+    parser.add_argument("--downtime", type = float, default = 5)
+    parser.add_argument("--heartbeat-interval", type = float, default = 30)
+    parser.add_argument("--heartbeat-timeout", type = float, default = 90)
+    parser.add_argument("--retry-interval", type = float, default = 1)
+    parser.add_argument("--max-retry-interval", type = float, default = 30)
+    parser.add_argument("--tick", type = float, default = 1.0, help = "timing wheel tick")
+    parser.add_argument("--latency", type = float, default = 0.001, help = "one way, seconds")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--max-cpu-seconds", type = float, help = "fail above it")
+    args = parser.parse_args()
+
+    simulation = Simulation(seed = args.seed, latency = args.latency)
+    cpu = cpu_seconds()
+    t = time.perf_counter()
+    result = simulation.run(scenario, simulation, args)
+    result["cpu_seconds"] = round(cpu_seconds() - cpu, 3)
+    result["wall_seconds"] = round(time.perf_counter() - t, 3)
+    result["virtual_seconds"] = round(simulation.now, 3)
+    simulation.close()
+    result.update({"bench": "simulation", "nodes": args.nodes, "minutes": args.minutes, "churn": args.churn, "seed": args.seed})
+    failures = check(result, args)
+    result["ok"] = not failures
+    result["failures"] = failures
+    print(json.dumps(result, sort_keys = True))
+    sys.exit(0 if result["ok"] else 1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.CRITICAL)
+    main()
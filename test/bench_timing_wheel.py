@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+
+from tornado.ioloop import IOLoop
+
+from tornado_discovery.timing_wheel import TimingWheel
+
+LOG = logging.getLogger(__name__)
+
+CONNECTIONS = 50000
+ROUNDS = 10
+HEARTBEAT_TIMEOUT = 10
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self._heartbeat_timeout = None
+
+    def _remove_connection(self):
+        pass
+
+
+def bench_ioloop_timeouts(connections):
+    io_loop = IOLoop.current()
+    t = time.perf_counter()
+    for _ in range(ROUNDS):
+        for c in connections:
+            if c._heartbeat_timeout:
+                io_loop.remove_timeout(c._heartbeat_timeout)
+            c._heartbeat_timeout = io_loop.add_timeout(io_loop.time() + HEARTBEAT_TIMEOUT, c._remove_connection)
+    use_time = time.perf_counter() - t
+    scheduled = len(getattr(getattr(io_loop, "asyncio_loop", None), "_scheduled", []))
+    for c in connections:
+        io_loop.remove_timeout(c._heartbeat_timeout)
+    return use_time, scheduled
+
+
+def bench_timing_wheel(connections):
+    io_loop = IOLoop.current()
+    wheel = TimingWheel(tick = 1.0)
+    t = time.perf_counter()
+    for _ in range(ROUNDS):
+        for c in connections:
+            wheel.schedule(c, io_loop.time() + HEARTBEAT_TIMEOUT, c._remove_connection)
+    use_time = time.perf_counter() - t
+    t = time.perf_counter()
+    wheel.sweep(io_loop.time() + HEARTBEAT_TIMEOUT + 1)
+    sweep_time = time.perf_counter() - t
+    wheel.stop()
+    return use_time, sweep_time
+
+
+def main():
+    connections = [FakeConnection() for _ in range(CONNECTIONS)]
+    use_time, scheduled = bench_ioloop_timeouts(connections)
+    beats = CONNECTIONS * ROUNDS
+    print("ioloop timeouts: %s heartbeats, %.3fs, %.0f beats/s, %s entries in timeout heap" % (beats, use_time, beats / use_time, scheduled))
+    use_time, sweep_time = bench_timing_wheel(connections)
+    print("timing wheel:    %s heartbeats, %.3fs, %.0f beats/s, expire all in %.3fs" % (beats, use_time, beats / use_time, sweep_time))
+
+
+if __name__ == "__main__":
+    IOLoop.current().run_sync(main)
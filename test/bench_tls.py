@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+'''
+mass reconnect over TLS: --registrants registered against an in-process
+listener with a self-signed certificate, every connection is dropped at once
+and the fleet reconnects, --rounds times. it runs once with full handshakes and
+once resuming the TLS sessions, one JSON line each, the cpu is the whole
+process, both ends of every handshake.
+
+    python3 bench_tls.py --registrants 1000 --rounds 3
+    python3 bench_tls.py --tls12
+    python3 bench_tls.py --certfile cert.pem --keyfile key.pem   # instead of a generated RSA 2048 one
+'''
+
+import os
+import ssl
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+
+import tornado.netutil
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from tornado_discovery.config import BaseConfig
+from tornado_discovery.connection import BaseConnection
+from tornado_discovery.listener import BaseListener
+from tornado_discovery.metrics import Metrics
+from tornado_discovery.registrant import BaseRegistrant
+from tornado_discovery.registry import Registry
+from tornado_discovery.tls import server_context
+
+from bench_load import BACKLOG, raise_nofile_limit, free_port, cpu_seconds
+
+LOG = logging.getLogger(__name__)
+
+
+def self_signed(path):
+    certfile = os.path.join(path, "cert.pem")
+    keyfile = os.path.join(path, "key.pem")
+    subprocess.check_call([
+        "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+        "-subj", "/CN=localhost", "-keyout", keyfile, "-out", certfile,
+    ], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+@gen.coroutine
+def scenario(args, certfile, keyfile, resumption):
+    port = free_port()
+    metrics = Metrics()
+    connection_cls = type("TlsConnection", (BaseConnection, ), {"registry": Registry(), "metrics": metrics})
+    context = server_context({"certfile": certfile, "keyfile": keyfile})
+    listener = BaseListener(connection_cls, ssl_options = context)
+    listener.add_sockets(tornado.netutil.bind_sockets(port, address = "127.0.0.1", backlog = BACKLOG))
+    client = ssl.create_default_context(cafile = certfile)
+    if args.tls12:
+        # TLS 1.2 resumption skips the key exchange, TLS 1.3 resumption still does (EC)DHE
+        client.maximum_version = ssl.TLSVersion.TLSv1_2
+    registrants = []
+    for i in range(args.registrants):
+        config = BaseConfig()
+        config.from_dict({
+            "heartbeat_interval": 3600, # only reconnects are measured
+            "heartbeat_timeout": 3600,
+            "http_host": "127.0.0.1",
+            "http_port": 10000 + i,
+        })
+        registrant = BaseRegistrant(
+            "127.0.0.1", port, config, ssl_options = client, server_hostname = "localhost",
+            retry_interval = 0.05, max_retry_interval = 0.5, request_timeout = 60, session_resumption = resumption
+        )
+        registrant.connect()
+        registrants.append(registrant)
+    while len(connection_cls.registry) < args.registrants or not all(r._registered for r in registrants):
+        yield gen.sleep(0.05)
+
+    handshakes = connection_cls.get_instruments().tls_handshakes
+    before = dict((result, counter.value) for result, counter in handshakes.items())
+    recoveries = []
+    cpu = cpu_seconds()
+    for _ in range(args.rounds):
+        for registrant in registrants:
+            registrant._registered = False
+        for connection in list(BaseConnection.clients):
+            connection._stream.close()
+        start = time.perf_counter()
+        while len(connection_cls.registry) < args.registrants or not all(r._registered for r in registrants):
+            yield gen.sleep(0.01)
+        recoveries.append(time.perf_counter() - start)
+    cpu = cpu_seconds() - cpu
+
+    for registrant in registrants:
+        registrant.reconnect = False
+        registrant._stop_heartbeat()
+    listener.stop()
+    for connection in list(BaseConnection.clients):
+        connection._stream.close()
+    yield gen.sleep(0.5)
+    counts = dict((result, counter.value - before[result]) for result, counter in handshakes.items())
+    reconnects = float(args.registrants * args.rounds)
+    raise gen.Return({
+        "bench": "tls_reconnect",
+        "session_resumption": resumption,
+        "tls_version": "TLSv1.2" if args.tls12 else "TLSv1.3",
+        "registrants": args.registrants,
+        "rounds": args.rounds,
+        "full_handshakes": counts["full"],
+        "resumed_handshakes": counts["resumed"],
+        "failed_handshakes": counts["failed"],
+        "recovery_seconds": round(sum(recoveries) / len(recoveries), 3),
+        "cpu_seconds": round(cpu, 3),
+        "cpu_us_per_reconnect": round(cpu / reconnects * 1000000, 1),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "tornado_discovery TLS reconnect benchmark")
+    parser.add_argument("--registrants", type = int, default = 1000)
+    parser.add_argument("--rounds", type = int, default = 3, help = "mass reconnects measured")
+    parser.add_argument("--tls12", action = "store_true", help = "TLS 1.2 instead of 1.3")
+    parser.add_argument("--certfile")
+    parser.add_argument("--keyfile")
+    args = parser.parse_args()
+
+    raise_nofile_limit()
+    path = None
+    certfile, keyfile = args.certfile, args.keyfile
+    if certfile is None:
+        path = tempfile.mkdtemp(prefix = "tornado_discovery_tls_")
+        certfile, keyfile = self_signed(path)
+    try:
+        for resumption in (False, True):
+            result = IOLoop.current().run_sync(lambda: scenario(args, certfile, keyfile, resumption))
+            print(json.dumps(result, sort_keys = True))
+    finally:
+        if path is not None:
+            shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.CRITICAL)
+    main()
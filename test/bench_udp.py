@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+'''
+heartbeats over TCP vs UDP datagrams: --registrants registered against an
+in-process listener heartbeat every --heartbeat-interval seconds for --seconds,
+one JSON line per transport. the cpu is the whole process, listener and
+registrants, per heartbeat renewed by the listener. a node sent back to TCP
+asks for UDP again after --udp-retry-interval seconds, udp_grants counts the
+grants within --seconds and udp_nodes the nodes on UDP at the end.
+
+    python3 bench_udp.py --registrants 1000 --heartbeat-interval 0.5 --seconds 10
+'''
+
+import json
+import time
+import logging
+import argparse
+
+import tornado.netutil
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from tornado_discovery.common import Command
+from tornado_discovery.config import BaseConfig
+from tornado_discovery.connection import BaseConnection
+from tornado_discovery.listener import BaseListener
+from tornado_discovery.metrics import Metrics
+from tornado_discovery.registrant import BaseRegistrant
+from tornado_discovery.registry import Registry
+
+from bench_load import BACKLOG, raise_nofile_limit, free_port, cpu_seconds
+
+LOG = logging.getLogger(__name__)
+
+
+@gen.coroutine
+def scenario(args, udp):
+    port = free_port()
+    metrics = Metrics()
+    connection_cls = type("UdpConnection", (BaseConnection, ), {"registry": Registry(), "metrics": metrics})
+    listener = BaseListener(connection_cls)
+    listener.add_sockets(tornado.netutil.bind_sockets(port, address = "127.0.0.1", backlog = BACKLOG))
+    receiver = listener.listen_udp(0, address = "127.0.0.1", batch = args.batch) if udp else None
+    registrants = []
+    for i in range(args.registrants):
+        config = BaseConfig()
+        config.from_dict({
+            "heartbeat_interval": args.heartbeat_interval,
+            "heartbeat_timeout": args.heartbeat_interval * 10,
+            "http_host": "127.0.0.1",
+            "http_port": 10000 + i,
+        })
+        registrant = BaseRegistrant(
+            "127.0.0.1", port, config, reconnect = False,
+            udp_heartbeat = udp, udp_retry_interval = args.udp_retry_interval
+        )
+        registrant.connect()
+        registrants.append(registrant)
+    while len(connection_cls.registry) < args.registrants or not all(r._registered for r in registrants):
+        yield gen.sleep(0.05)
+    # past the first heartbeat, the node_id granted at registration goes over TCP
+    yield gen.sleep(args.heartbeat_interval * 2)
+
+    instruments = connection_cls.get_instruments()
+    tcp = instruments.requests[Command.heartbeat].value
+    datagrams = receiver._datagrams["accepted"].value if udp else 0
+    reads = receiver._reads.value if udp else 0
+    grants = receiver._grants.value if udp else 0
+    cpu = cpu_seconds()
+    start = time.perf_counter()
+    yield gen.sleep(args.seconds)
+    elapsed = time.perf_counter() - start
+    cpu = cpu_seconds() - cpu
+    tcp = instruments.requests[Command.heartbeat].value - tcp
+    datagrams = receiver._datagrams["accepted"].value - datagrams if udp else 0
+    reads = receiver._reads.value - reads if udp else 0
+    grants = receiver._grants.value - grants if udp else 0
+    heartbeats = tcp + datagrams
+    result = {
+        "bench": "udp_heartbeat",
+        "transport": "UDP" if udp else "TCP",
+        "registrants": args.registrants,
+        "heartbeat_interval": args.heartbeat_interval,
+        "alive": len(connection_cls.registry),
+        "heartbeats_per_second": round(heartbeats / elapsed, 1),
+        "tcp_heartbeats": tcp,
+        "udp_heartbeats": datagrams,
+        "datagrams_per_read": round(datagrams / float(reads), 2) if reads else None,
+        "fallbacks": receiver._fallbacks.value if udp else 0,
+        "udp_grants": grants,
+        "udp_nodes": sum(1 for r in registrants if r._udp is not None),
+        "cpu_percent": round(cpu / elapsed * 100, 1),
+        "cpu_us_per_heartbeat": round(cpu / heartbeats * 1000000, 2) if heartbeats else None,
+    }
+    for registrant in registrants:
+        registrant.reconnect = False
+        registrant._stop_heartbeat()
+        registrant._close_udp()
+    listener.stop()
+    if receiver is not None:
+        receiver.stop()
+    for connection in list(BaseConnection.clients):
+        connection._stream.close()
+    yield gen.sleep(0.5)
+    raise gen.Return(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "tornado_discovery UDP heartbeat benchmark")
+    parser.add_argument("--registrants", type = int, default = 1000)
+    parser.add_argument("--heartbeat-interval", type = float, default = 0.5)
+    parser.add_argument("--seconds", type = float, default = 10)
+    parser.add_argument("--udp-retry-interval", type = float, default = 2, help = "seconds on TCP after a fallback")
+    parser.add_argument("--batch", type = int, default = 64, help = "datagrams drained per readable event")
+    args = parser.parse_args()
+
+    raise_nofile_limit()
+    for udp in (False, True):
+        result = IOLoop.current().run_sync(lambda: scenario(args, udp))
+        print(json.dumps(result, sort_keys = True))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.CRITICAL)
+    main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+from tornado_discovery.common import Command, Status
+from tornado_discovery.config import BaseConfig
+from tornado_discovery.connection import BaseConnection
+from tornado_discovery.listener import BaseListener
+from tornado_discovery.metrics import Metrics
+from tornado_discovery.registrant import BaseRegistrant
+from tornado_discovery.registry import Registry
+
+LOG = logging.getLogger(__name__)
+
+
+def registrant(port, http_port):
+    config = BaseConfig()
+    config.from_dict({"heartbeat_interval": 0.5, "heartbeat_timeout": 5, "http_host": "127.0.0.1", "http_port": http_port})
+    return BaseRegistrant("127.0.0.1", port, config, retry_interval = 0.1, max_retry_interval = 0.5)
+
+
+@gen.coroutine
+def wait_until(condition, timeout):
+    deadline = IOLoop.current().time() + timeout
+    while not condition():
+        if IOLoop.current().time() > deadline:
+            raise gen.Return(False)
+        yield gen.sleep(0.02)
+    raise gen.Return(True)
+
+
+@gen.coroutine
+def refused_register_retried():
+    sock, port = bind_unused_port()
+    connection_cls = type("AdmissionConnection", (BaseConnection, ), {"registry": Registry(), "metrics": Metrics()})
+    listener = BaseListener(connection_cls)
+    listener.add_sockets([sock])
+    # one registration per second, the first one takes the only token
+    admission = listener.enable_admission_control(rate = 1, burst = 1, retry_after = 0.2)
+    first = registrant(port, 9000)
+    second = registrant(port, 9001)
+    replies = []
+    dispatch = second._dispatch
+
+    def record(data):
+        replies.append(data)
+        dispatch(data)
+
+    second._dispatch = record
+    try:
+        first.connect()
+        assert (yield wait_until(lambda: first._registered, 5))
+        second.connect()
+        assert (yield wait_until(lambda: second._registered, 5))
+
+        # refused once, the retry waits for the bucket to admit it
+        statuses = [data["data"]["status"] for data in replies if data.get("command") == Command.register]
+        assert statuses == [Status.retry, Status.success], replies
+        assert replies[0]["data"]["retry_after"] >= 0.2
+        assert admission.rejected_rate.value == 1
+        assert second.config.get("node_id") in connection_cls.registry
+        assert len(connection_cls.registry) == 2
+    finally:
+        for r in (first, second):
+            r.reconnect = False
+            r._stop_heartbeat()
+        listener.stop()
+        for connection in list(BaseConnection.clients):
+            connection._stream.close()
+        yield gen.sleep(0.1)
+
+
+def test_refused_register_is_retried():
+    IOLoop.current().run_sync(refused_register_retried, timeout = 15)
+
+
+if __name__ == "__main__":
+    test_refused_register_is_retried()
+    print("ok")
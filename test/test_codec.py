@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from tornado_discovery.codec import CODECS, encode_payload, decode_payload
+
+LOG = logging.getLogger(__name__)
+
+VALUES = [
+    0, -1, 127, -128, 128, 2 ** 31, -2 ** 31 - 1, 2 ** 63, -2 ** 63 - 1,
+    int("9" * 255), int("9" * 256), int("7" * 300), -int("1" * 300),
+    1.5, "", "x" * 255, "x" * 256, None, True, False, [1, [2, "a"]], {"a": {"b": [None]}},
+]
+
+
+def test_roundtrip():
+    for codec in CODECS.values():
+        for value in VALUES:
+            data = {"command": "HEARTBEAT", "data": {"value": value}}
+            payload, flags = encode_payload(data, codec)
+            assert decode_payload(payload, flags) == data, (codec.name, value)
+
+
+def test_300_digits_int():
+    value = int("1234567890" * 30)
+    for codec in CODECS.values():
+        payload, flags = encode_payload({"data": value}, codec)
+        assert decode_payload(payload, flags) == {"data": value}, codec.name
+
+
+if __name__ == "__main__":
+    test_roundtrip()
+    test_300_digits_int()
+    print("ok")
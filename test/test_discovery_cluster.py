@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import json
+import logging
+
+import tornado.ioloop
+
+from tornado_discovery.connection import BaseConnection
+from tornado_discovery.listener import BaseListener
+from tornado_discovery.registry import Registry
+from tornado_discovery.config import BaseConfig
+from tornado_discovery.registrant import BaseRegistrant
+
+import logger
+
+LOG = logging.getLogger(__name__)
+
+PORTS = (6001, 6002, 6003)
+
+
+def print_registries(connection_classes):
+    for port, connection_cls in zip(PORTS, connection_classes):
+        LOG.info("Listener(%s) nodes: %s, connected: %s",
+                 port,
+                 len(connection_cls.registry),
+                 sum(1 for entry in connection_cls.registry if entry.connection is not None))
+
+
+if __name__ == "__main__":
+    logger.config_logging(file_name = "test_discovery_cluster.log",
+                          log_level = "INFO",
+                          dir_name = "logs",
+                          day_rotate = False,
+                          when = "D",
+                          interval = 1,
+                          max_size = 20,
+                          backup_count = 5,
+                          console = True)
+
+    LOG.debug("test start")
+
+    try:
+        # three replicated listeners on localhost, each with its own registry
+        listeners = []
+        connection_classes = []
+        for port in PORTS:
+            connection_cls = type("Connection%s" % port, (BaseConnection, ), {"registry": Registry()})
+            listener = BaseListener(connection_cls)
+            listener.listen(port)
+            listener.enable_replication([("127.0.0.1", p) for p in PORTS if p != port], sync_interval = 5, peer_grace = 10)
+            listeners.append(listener)
+            connection_classes.append(connection_cls)
+        # registrants spread over the listeners, failing over to the others
+        registrants = []
+        for i in range(6):
+            config = BaseConfig()
+            config.from_dict({"heartbeat_interval": 1, "heartbeat_timeout": 10, "http_host": "127.0.0.1", "http_port": 8001 + i})
+            endpoints = [("127.0.0.1", PORTS[(i + n) % len(PORTS)]) for n in range(len(PORTS))]
+            registrant = BaseRegistrant(endpoints[0][0], endpoints[0][1], config, retry_interval = 1, endpoints = endpoints)
+            tornado.ioloop.IOLoop.instance().add_callback(registrant.connect)
+            registrants.append(registrant)
+        # stop the first listener, its nodes fail over and every registry converges
+        def stop_first_listener():
+            LOG.info("Stop Listener(%s)", PORTS[0])
+            listeners[0].stop()
+            listeners[0].replicator.stop()
+            for client in list(BaseConnection.clients):
+                if isinstance(client, connection_classes[0]):
+                    client._stream.close()
+            connection_classes[0].registry = Registry()
+        tornado.ioloop.IOLoop.instance().add_timeout(time.time() + 5, stop_first_listener)
+        tornado.ioloop.PeriodicCallback(lambda: print_registries(connection_classes), 2000).start()
+        tornado.ioloop.IOLoop.instance().start()
+    except Exception as e:
+        LOG.exception(e)
+
+    LOG.debug("test end")